@@ -0,0 +1,351 @@
+# Compressed bitmaps of message index positions.
+#
+# This is a pure-Python take on "roaring" bitmaps: the integers are split
+# into chunks of 65536 by their high bits, and each chunk is stored either
+# as a sorted array of 16-bit values (when sparse) or as a Python long used
+# as a bitset (when dense). Dense chunks make AND/OR/ANDNOT run at C speed,
+# sparse chunks keep small sets small.
+#
+# Bitmaps are updated copy-on-write: chunks and the chunk table are
+# replaced, never changed in place, so a thread reading a bitmap while
+# another updates it sees it either before or after each change.
+#
+import array
+import binascii
+import bisect
+
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+# Chunks with more members than this are stored as bitsets
+ARRAY_MAX = 4096
+
+# For each byte value, the positions of the bits which are set
+BYTE_BITS = [[b for b in range(0, 8) if (v >> b) & 1] for v in range(0, 256)]
+
+
+def _array(values=()):
+    return array.array('H', values)
+
+
+def _is_array(c):
+    return isinstance(c, array.array)
+
+
+def _bits_to_bytes(bits):
+    """Convert a bitset to a little-endian bytearray."""
+    hexed = '%x' % bits
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    data = bytearray(binascii.unhexlify(hexed))
+    data.reverse()
+    return data
+
+
+def _array_to_bits(values):
+    # Setting one byte per value and parsing the lot as a binary number
+    # is much faster than or-ing the bits together one by one.
+    digits = bytearray('0') * CHUNK_SIZE
+    for v in values:
+        digits[v] = '1'
+    digits.reverse()
+    return int(str(digits), 2)
+
+
+def _bits_to_array(bits):
+    values = []
+    append = values.append
+    pos = 0
+    for b in _bits_to_bytes(bits):
+        if b:
+            for i in BYTE_BITS[b]:
+                append(pos + i)
+        pos += 8
+    return _array(values)
+
+
+def _count(c):
+    if _is_array(c):
+        return len(c)
+    return bin(c).count('1')
+
+
+def _normalize(c):
+    """Pick the cheapest representation of a chunk, None if empty."""
+    if _is_array(c):
+        if len(c) > ARRAY_MAX:
+            return _array_to_bits(c)
+        return c or None
+    if not c:
+        return None
+    if _count(c) <= ARRAY_MAX:
+        return _bits_to_array(c)
+    return c
+
+
+def _chunk_filter(values, bits, keep):
+    data = _bits_to_bytes(bits)
+    dlen = len(data)
+    return _array(v for v in values
+                  if (((v >> 3) < dlen and (data[v >> 3] >> (v & 7)) & 1)
+                      == keep))
+
+
+def _chunk_and(a, b):
+    if _is_array(a):
+        if _is_array(b):
+            return _array(sorted(set(a).intersection(b)))
+        return _chunk_filter(a, b, 1)
+    elif _is_array(b):
+        return _chunk_filter(b, a, 1)
+    return a & b
+
+
+def _chunk_or(a, b):
+    if _is_array(a) and _is_array(b):
+        if len(a) + len(b) <= ARRAY_MAX:
+            return _array(sorted(set(a).union(b)))
+    if _is_array(a):
+        a = _array_to_bits(a)
+    if _is_array(b):
+        b = _array_to_bits(b)
+    return a | b
+
+
+def _chunk_sub(a, b):
+    if _is_array(a):
+        if _is_array(b):
+            return _array(sorted(set(a).difference(b)))
+        return _chunk_filter(a, b, 0)
+    elif _is_array(b):
+        b = _array_to_bits(b)
+    return a & ~b
+
+
+class Bitmap(object):
+    """
+    A compressed, set-like collection of non-negative integers.
+
+    >>> b = Bitmap([5, 1, 70000])
+    >>> list(b), len(b), 5 in b, 6 in b
+    ([1, 5, 70000], 3, True, False)
+    >>> list(b & Bitmap.Range(0, 10)), list(b - set([1]))
+    ([1, 5], [5, 70000])
+    >>> b |= Bitmap.Range(0, 10000)
+    >>> len(b), len(b & Bitmap.Range(9990, 70001))
+    (10001, 11)
+    >>> b.discard(5); b.add(3); 5 in b, len(b - Bitmap.Range(0, 9999))
+    (False, 2)
+    >>> set([1, 2]) & Bitmap([2, 3])
+    Bitmap([2])
+    """
+    __hash__ = None
+
+    def __init__(self, values=None):
+        self._chunks = {}
+        if values is not None:
+            self.update(values)
+
+    @classmethod
+    def Range(cls, start, end):
+        """Create a bitmap of all the integers from start to end-1."""
+        bm = cls()
+        while start < end:
+            high, low = start >> CHUNK_BITS, start & CHUNK_MASK
+            top = min(end - (high << CHUNK_BITS), CHUNK_SIZE)
+            bits = ((1 << top) - 1) & ~((1 << low) - 1)
+            bm._chunks[high] = _normalize(bits)
+            start = (high + 1) << CHUNK_BITS
+        return bm
+
+    @classmethod
+    def _share(cls, c):
+        # Arrays are mutable, so results must never share them.
+        return _is_array(c) and _array(c) or c
+
+    def _coerce(self, other):
+        if isinstance(other, Bitmap):
+            return other
+        return Bitmap(other)
+
+    def _combine(self, other, op, keep_left, keep_right):
+        other = self._coerce(other)
+        chunks, ochunks = self._chunks, other._chunks
+        result = Bitmap()
+        for high, c in chunks.iteritems():
+            oc = ochunks.get(high)
+            if oc is None:
+                if keep_left:
+                    result._chunks[high] = self._share(c)
+            else:
+                c = _normalize(op(c, oc))
+                if c is not None:
+                    result._chunks[high] = c
+        if keep_right:
+            for high, oc in ochunks.iteritems():
+                if high not in chunks:
+                    result._chunks[high] = self._share(oc)
+        return result
+
+    def __and__(self, other):
+        return self._combine(other, _chunk_and, False, False)
+
+    def __or__(self, other):
+        return self._combine(other, _chunk_or, True, True)
+
+    def __sub__(self, other):
+        return self._combine(other, _chunk_sub, True, False)
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def __rsub__(self, other):
+        return self._coerce(other) - self
+
+    def __iand__(self, other):
+        self._chunks = (self & other)._chunks
+        return self
+
+    def __ior__(self, other):
+        self._chunks = (self | other)._chunks
+        return self
+
+    def __isub__(self, other):
+        self._chunks = (self - other)._chunks
+        return self
+
+    intersection = __and__
+    union = __or__
+    difference = __sub__
+
+    def _set_chunk(self, high, c):
+        if c is not None and high in self._chunks:
+            self._chunks[high] = c
+        else:
+            chunks = dict(self._chunks)
+            if c is None:
+                chunks.pop(high, None)
+            else:
+                chunks[high] = c
+            self._chunks = chunks
+
+    def update(self, values):
+        if isinstance(values, Bitmap):
+            self |= values
+            return
+        # Sorting lets us slice the values into chunks at C speed
+        values = sorted(values)
+        chunks = dict(self._chunks)
+        pos = 0
+        while pos < len(values):
+            high = values[pos] >> CHUNK_BITS
+            end = bisect.bisect_left(values, (high + 1) << CHUNK_BITS, pos)
+            low = [v & CHUNK_MASK for v in values[pos:end]]
+            if len(low) > ARRAY_MAX:
+                low = _array_to_bits(low)
+            else:
+                low = _array(sorted(set(low)))
+            c = chunks.get(high)
+            if c is None:
+                chunks[high] = _normalize(low)
+            else:
+                chunks[high] = _normalize(_chunk_or(c, low))
+            pos = end
+        self._chunks = chunks
+
+    def add(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        c = self._chunks.get(high)
+        if c is None:
+            self._set_chunk(high, _array([low]))
+        elif _is_array(c):
+            pos = bisect.bisect_left(c, low)
+            if pos >= len(c) or c[pos] != low:
+                self._set_chunk(high, _normalize(
+                    c[:pos] + _array([low]) + c[pos:]))
+        else:
+            self._chunks[high] = c | (1 << low)
+
+    def discard(self, value):
+        high, low = value >> CHUNK_BITS, value & CHUNK_MASK
+        c = self._chunks.get(high)
+        if c is None:
+            return
+        elif _is_array(c):
+            pos = bisect.bisect_left(c, low)
+            if pos >= len(c) or c[pos] != low:
+                return
+            c = c[:pos] + c[pos + 1:]
+        else:
+            c = c & ~(1 << low)
+        self._set_chunk(high, _normalize(c))
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+        self.discard(value)
+
+    def copy(self):
+        bm = Bitmap()
+        bm._chunks = dict((h, self._share(c))
+                          for h, c in self._chunks.iteritems())
+        return bm
+
+    def nbytes(self):
+        """Estimate how many bytes of memory the bitmap uses."""
+        total = 0
+        for c in self._chunks.itervalues():
+            total += 64 + (_is_array(c) and 2 * len(c) or c.bit_length() // 8)
+        return total
+
+    def __contains__(self, value):
+        try:
+            c = self._chunks.get(value >> CHUNK_BITS)
+        except TypeError:
+            return False
+        if c is None:
+            return False
+        low = value & CHUNK_MASK
+        if _is_array(c):
+            pos = bisect.bisect_left(c, low)
+            return pos < len(c) and c[pos] == low
+        return bool((c >> low) & 1)
+
+    def __iter__(self):
+        chunks = self._chunks
+        for high in sorted(chunks.keys()):
+            c = chunks[high]
+            if not _is_array(c):
+                c = _bits_to_array(c)
+            base = high << CHUNK_BITS
+            for low in c:
+                yield base + low
+
+    def __len__(self):
+        return sum(_count(c) for c in self._chunks.itervalues())
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Bitmap, set, frozenset)):
+            return False
+        other = self._coerce(other)
+        return (sorted(self._chunks.keys()) == sorted(other._chunks.keys())
+                and not (self - other) and not (other - self))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return 'Bitmap(%s)' % list(self)
+
+
+# If 'python bitmap.py' is executed, start the doctest unittest
+if __name__ == "__main__":
+    import doctest
+    import sys
+    if doctest.testmod().failed:
+        sys.exit(1)
@@ -0,0 +1,137 @@
+# Copy-on-write columns of per-message values.
+#
+# The index keeps a few values for every message (its conversation, its
+# sort keys, its facets) in columns which searches read through snapshots
+# while the indexer keeps changing them. Copying a whole column for each
+# snapshot would cost O(messages), so the values are stored in chunks
+# which copies share: copying a column only copies the chunk table, and
+# whichever side changes a shared chunk first replaces it with its own
+# copy, much like Bitmap replaces its chunks.
+#
+import array
+import itertools
+
+
+CHUNK_BITS = 12
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+class Column(object):
+    """
+    A list of values indexed by message, which is cheap to copy.
+
+    >>> col = Column(range(0, 5000), typecode='l')
+    >>> snap = col.copy()
+    >>> col[1] = 10; col.append(5000)
+    >>> col[1], snap[1], col[-1], snap[-1], len(col), len(snap)
+    (10, 1, 5000, 4999, 5001, 5000)
+    >>> snap[5000]
+    Traceback (most recent call last):
+      ...
+    IndexError: array index out of range
+    >>> col = Column(['a']); col.extend(['b', 'c']); list(col)
+    ['a', 'b', 'c']
+    >>> import cPickle
+    >>> list(cPickle.loads(cPickle.dumps(snap, 2)))[4997:]
+    [4997, 4998, 4999]
+    """
+    def __init__(self, values=(), typecode=None):
+        self.typecode = typecode
+        self._chunks = []
+        self._owned = set()
+        self._len = 0
+        self.extend(values)
+
+    def __getstate__(self):
+        values = self._new_chunk()
+        for chunk in self._chunks:
+            values.extend(chunk)
+        if self.typecode:
+            # Arrays pickle as lists of numbers, their buffers much faster
+            values = values.tostring()
+        return {'typecode': self.typecode, 'values': values}
+
+    def __setstate__(self, state):
+        values = state['values']
+        if state['typecode'] and isinstance(values, str):
+            values = array.array(state['typecode'])
+            values.fromstring(state['values'])
+        self.__init__(values, typecode=state['typecode'])
+
+    def _new_chunk(self, values=()):
+        if self.typecode:
+            if (isinstance(values, array.array) and
+                    values.typecode == self.typecode):
+                # Much faster than copying them one by one
+                return values[:]
+            return array.array(self.typecode, values)
+        return list(values)
+
+    def _writable(self, n):
+        # Chunks we have not copied since the last copy() may be shared
+        chunk = self._chunks[n]
+        if n not in self._owned:
+            chunk = self._chunks[n] = self._new_chunk(chunk)
+            self._owned.add(n)
+        return chunk
+
+    def _position(self, i):
+        if i < 0:
+            i += self._len
+            if i < 0:
+                raise IndexError('column index out of range')
+        return i
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(list(self._chunks))
+
+    def __getitem__(self, i):
+        i = self._position(i)
+        return self._chunks[i >> CHUNK_BITS][i & CHUNK_MASK]
+
+    def __setitem__(self, i, value):
+        i = self._position(i)
+        if i >= self._len:
+            raise IndexError('column index out of range')
+        self._writable(i >> CHUNK_BITS)[i & CHUNK_MASK] = value
+
+    def append(self, value):
+        n = self._len >> CHUNK_BITS
+        if n == len(self._chunks):
+            self._chunks.append(self._new_chunk())
+            self._owned.add(n)
+        self._writable(n).append(value)
+        self._len += 1
+
+    def extend(self, values):
+        if not isinstance(values, (list, array.array)):
+            values = list(values)
+        pos = 0
+        while pos < len(values) and self._len & CHUNK_MASK:
+            self.append(values[pos])
+            pos += 1
+        for pos in range(pos, len(values), CHUNK_SIZE):
+            chunk = self._new_chunk(values[pos:pos + CHUNK_SIZE])
+            self._owned.add(len(self._chunks))
+            self._chunks.append(chunk)
+            self._len += len(chunk)
+
+    def copy(self):
+        """A copy which later changes to either column do not affect."""
+        col = Column(typecode=self.typecode)
+        col._chunks = list(self._chunks)
+        col._len = self._len
+        self._owned = set()
+        return col
+
+
+# If 'python column.py' is executed, start the doctest unittest
+if __name__ == "__main__":
+    import doctest
+    import sys
+    if doctest.testmod().failed:
+        sys.exit(1)
@@ -962,35 +962,31 @@ class ConfigManager(ConfigDict):
         return (mailbox_id == local_mailbox_id)
 
     def load_pickle(self, pfn):
-        fd = None
+        fd = open(os.path.join(self.workdir, pfn), 'rb')
         try:
-            fd = open(os.path.join(self.workdir, pfn), 'r')
-            if self.prefs.obfuscate_index:
-                lines = []
-                decrypt_and_parse_lines(fd, lambda l: lines.append(l), self,
-                                        newlines=True)
-                return cPickle.loads(str(''.join(lines)))
-            else:
-                return cPickle.load(fd)
+            data = fd.read()
         finally:
-            if fd:
-                fd.close()
+            fd.close()
+        if self.prefs.obfuscate_index:
+            from mailpile.crypto.symencrypt import SymmetricEncrypter
+            encrypter = SymmetricEncrypter(self.prefs.obfuscate_index)
+            # Pickles saved before obfuscate_index was set are plain
+            if data.startswith((encrypter.MAGIC, encrypter.BEGIN_DATA)):
+                data = encrypter.decrypt(data)
+        return cPickle.loads(data)
 
     def save_pickle(self, obj, pfn):
-        if self.prefs.obfuscate_index and not True:
-            # FIXME: Encryption disabled for now, openssl hangs.
+        # Written aside and renamed, so a crash can not leave half a pickle
+        fn = os.path.join(self.workdir, pfn)
+        newfn = '%s.new' % fn
+        if self.prefs.obfuscate_index:
             from mailpile.crypto.symencrypt import EncryptedFile
-            fd = EncryptedFile(os.path.join(self.workdir, pfn),
-                               self.prefs.obfuscate_index,
-                               mode='wb')
+            fd = EncryptedFile(newfn, self.prefs.obfuscate_index, mode='wb')
         else:
-            fd = open(os.path.join(self.workdir, pfn), 'wb')
-
-        # We deliberately use protocol 0, which is compatible with text
-        # mode file I/O. This allows the decrypt_and_parse_lines logic
-        # in load_pickle to operate without a hitch.
-        cPickle.dump(obj, fd, protocol=0)
+            fd = open(newfn, 'wb')
+        cPickle.dump(obj, fd, protocol=cPickle.HIGHEST_PROTOCOL)
         fd.close()
+        os.rename(newfn, fn)
 
     def open_mailbox(self, session, mailbox_id):
         try:
@@ -1083,6 +1079,9 @@ class ConfigManager(ConfigDict):
     def mailindex_file(self):
         return os.path.join(self.workdir, 'mailpile.idx')
 
+    def tombstones_file(self):
+        return os.path.join(self.workdir, 'mailpile.dead')
+
     def postinglist_dir(self, prefix):
         d = os.path.join(self.workdir, 'search')
         if not os.path.exists(d):
@@ -1130,8 +1129,13 @@ class ConfigManager(ConfigDict):
 
     def prepare_workers(config, session=None, daemons=False):
         # Set globals from config first...
+        import mailpile.postinglist
+        import mailpile.search
         import mailpile.util
         mailpile.util.APPEND_FD_CACHE_SIZE = config.sys.fd_cache_size
+        mailpile.postinglist.GLOBAL_HITS_CACHE_KB = (
+            config.sys.postinglist_cache_kb)
+        mailpile.search.SEARCH_RESULT_CACHE_KB = config.sys.search_cache_kb
 
         # Make sure we have a silent background session
         if not config.background:
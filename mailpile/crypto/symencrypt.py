@@ -1,81 +1,150 @@
+import hashlib
 import os
-import sys
-import fcntl
-import random
+import struct
 from subprocess import Popen, PIPE
-from datetime import datetime
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from mailpile.util import sha512b64 as genkey
 
 
+CHUNK_HEADER = struct.Struct('>I')
+CHUNK_FINAL = 0x80000000
+CHUNK_AAD = struct.Struct('>Q?')
+CHUNK_NONCE_LEN = 12
+CHUNK_TAG_LEN = 16
+SALT_LEN = 16
+
+
 class SymmetricEncrypter:
     """
-    Symmetric encryption/decryption. Currently wraps OpenSSL's command line.
+    Symmetric encryption/decryption, in-process and in chunks.
+
+    Encrypted data is a header (MAGIC and a random salt) followed by
+    chunks, each of which is its length, a random nonce and the AES-GCM
+    ciphertext. The key is derived from the secret and the salt with
+    PBKDF2. Each chunk is authenticated along with its number and
+    whether it is the last one, so chunks cannot be altered, reordered
+    or cut off the end. As every chunk stands alone, encrypted files can
+    be appended to and read from the middle.
+
+    >>> s = SymmetricEncrypter('secret')
+    >>> data = s.encrypt('Hello world! ' * 10000)
+    >>> data.startswith(s.MAGIC), s.decrypt(data) == 'Hello world! ' * 10000
+    (True, True)
+    >>> len(list(s.chunks(data))), s.decrypt(data, first=1)[:12]
+    (2, 'lo world! He')
+    >>> SymmetricEncrypter('wrong').decrypt(data)
+    Traceback (most recent call last):
+      ...
+    ValueError: Encrypted data failed authentication.
+    >>> s.decrypt(data[:len(s.encrypt('Hello'))])
+    Traceback (most recent call last):
+      ...
+    ValueError: Truncated encrypted stream.
+
+    Data encrypted by older versions (ASCII armored, using the openssl
+    command line tool) can still be decrypted if openssl is installed.
     """
+    MAGIC = "\x89MPE1\n"
     BEGIN_DATA = "-----BEGIN MAILPILE ENCRYPTED DATA-----"
     END_DATA = "-----END MAILPILE ENCRYPTED DATA-----"
-    DEFAULT_CIPHER = "aes-256-gcm"
+    CHUNK_SIZE = 64 * 1024
+    KDF_ITERATIONS = 20000
+    KEYS = {}
 
     def __init__(self, secret=None):
-        self.available = None
-        self.binary = 'openssl'
-        self.handles = {}
-        self.pipes = {}
-        self.fds = ["stdout", "stderr"]
-        self.errors = []
-        self.statuscallbacks = {}
         self.secret = secret
 
-    def run(self, args=[], output=None, passphrase=None, debug=False):
-        self.pipes = {}
-        args.insert(0, self.binary)
+    def _aead(self, salt):
+        secret = self.secret
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        aead = self.KEYS.get((secret, salt))
+        if aead is None:
+            if len(self.KEYS) > 100:
+                self.KEYS.clear()
+            aead = self.KEYS[(secret, salt)] = AESGCM(hashlib.pbkdf2_hmac(
+                'sha256', secret, salt, self.KDF_ITERATIONS, 32))
+        return aead
 
-        if debug:
-            print "Running openssl as: %s" % " ".join(args)
+    def header(self, salt=None):
+        salt = salt or os.urandom(SALT_LEN)
+        return self.MAGIC + salt, salt
 
-        proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    def parse_header(self, data):
+        if not data.startswith(self.MAGIC):
+            raise ValueError("Not a valid encrypted stream.")
+        hlen = len(self.MAGIC) + SALT_LEN
+        if len(data) < hlen:
+            raise ValueError("Truncated encrypted stream.")
+        return data[len(self.MAGIC):hlen], hlen
 
-        self.handles["stdout"] = proc.stdout
-        self.handles["stderr"] = proc.stderr
-        self.handles["stdin"] = proc.stdin
+    def encrypt_chunk(self, salt, chunk, data, final=False):
+        nonce = os.urandom(CHUNK_NONCE_LEN)
+        ciphertext = self._aead(salt).encrypt(nonce, data,
+                                              CHUNK_AAD.pack(chunk, final))
+        clen = len(nonce) + len(ciphertext)
+        return ''.join([CHUNK_HEADER.pack(clen | (final and CHUNK_FINAL)),
+                        nonce, ciphertext])
 
-        if passphrase:
-            self.handles["stdin"].write(passphrase + "\n")
+    def decrypt_chunk(self, salt, chunk, final, data):
+        try:
+            return self._aead(salt).decrypt(data[:CHUNK_NONCE_LEN],
+                                            data[CHUNK_NONCE_LEN:],
+                                            CHUNK_AAD.pack(chunk, final))
+        except InvalidTag:
+            raise ValueError("Encrypted data failed authentication.")
 
-        if output:
-            self.handles["stdin"].write(output)
+    def parse_chunk(self, data, pos):
+        """
+        Parse the chunk header at pos, returning whether it is the last
+        chunk and where its encrypted data starts and ends.
+        """
+        if pos + CHUNK_HEADER.size > len(data):
+            raise ValueError("Truncated encrypted stream.")
+        clen = CHUNK_HEADER.unpack(data[pos:pos + CHUNK_HEADER.size])[0]
+        final = bool(clen & CHUNK_FINAL)
+        clen &= ~CHUNK_FINAL
+        if clen < CHUNK_NONCE_LEN + CHUNK_TAG_LEN:
+            raise ValueError("Not a valid encrypted stream.")
+        start = pos + CHUNK_HEADER.size
+        if start + clen > len(data):
+            raise ValueError("Truncated encrypted stream.")
+        return final, start, start + clen
 
-        self.handles["stdin"].close()
+    def encrypt(self, data, salt=None):
+        header, salt = self.header(salt=salt)
+        output = [header]
+        positions = range(0, len(data), self.CHUNK_SIZE) or [0]
+        for chunk, pos in enumerate(positions):
+            output.append(self.encrypt_chunk(
+                salt, chunk, data[pos:pos + self.CHUNK_SIZE],
+                final=(chunk == len(positions) - 1)))
+        return ''.join(output)
 
-        retvals = dict([(fd, "") for fd in self.fds])
-        while True:
-            proc.poll()
-            for fd in self.fds:
-                try:
-                    buf = self.handles[fd].read()
-                except IOError:
-                    continue
-                if buf == "":
-                    continue
-                retvals[fd] += buf
-            if proc.returncode is not None:
-                break
+    def chunks(self, data, first=0):
+        """
+        Iterate through the decrypted chunks of a stream, skipping the
+        first few without decrypting them. A stream which was cut short
+        raises ValueError once the chunks run out. Anything after the
+        final chunk is from an append which never finished, and ignored.
+        """
+        salt, pos = self.parse_header(data)
+        chunk, final = 0, False
+        while not final:
+            final, start, pos = self.parse_chunk(data, pos)
+            if chunk >= first:
+                yield self.decrypt_chunk(salt, chunk, final, data[start:pos])
+            chunk += 1
 
-        return proc.returncode, retvals
+    def decrypt(self, data, first=0):
+        if data.startswith(self.BEGIN_DATA):
+            return self.decrypt_openssl(data)
+        return ''.join(self.chunks(data, first=first))
 
-    def encrypt(self, data, cipher=None):
-        if not cipher:
-            cipher = self.DEFAULT_CIPHER
-        nonce = genkey(str(random.getrandbits(512)))[:32].strip()
-        enckey = genkey(self.secret, nonce)[:32].strip()
-        params = ["enc", "-e", "-a", "-%s" % cipher,
-                  "-pass", "stdin"]
-        retval, res = self.run(params, output=data, passphrase=enckey)
-        ret = "%s\ncipher: %s\nnonce: %s\n\n%s\n%s" % (
-            self.BEGIN_DATA, cipher, nonce, res["stdout"], self.END_DATA)
-        return ret
-
-    def decrypt(self, data):
+    def decrypt_openssl(self, data):
         try:
             head, enc, tail = data.split("\n\n")
             head = [h.strip() for h in head.split("\n")]
@@ -96,61 +165,142 @@ class SymmetricEncrypter:
         except:
             raise ValueError("Message contained invalid parameter.")
 
-        cipher = headers.get('cipher', self.DEFAULT_CIPHER)
+        cipher = headers.get('cipher', 'aes-256-gcm')
         nonce = headers.get('nonce')
         if not nonce:
             raise ValueError("Encryption nonce not known.")
 
         enckey = genkey(self.secret, nonce)[:32].strip()
-        params = ["enc", "-d", "-a", "-%s" % cipher, "-pass", "stdin"]
-        retval, res = self.run(params, output=enc, passphrase=enckey)
-        return res["stdout"]
+        proc = Popen(["openssl", "enc", "-d", "-a", "-%s" % cipher,
+                      "-pass", "stdin"],
+                     stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        return proc.communicate(input=enckey + "\n" + enc)[0]
 
     def decrypt_fd(self, lines, fd):
-        for line in fd:
-            lines.append(line)
-            if line.startswith(self.END_DATA):
-                break
-
-        ret = self.decrypt("".join(lines))
-        return ret.split("\n")
+        if lines and lines[0].startswith(self.BEGIN_DATA):
+            for line in fd:
+                lines.append(line)
+                if line.startswith(self.END_DATA):
+                    break
+            return self.decrypt_openssl("".join(lines)).split("\n")
+        else:
+            lines.append(fd.read())
+            return self.decrypt("".join(lines)).splitlines(True)
 
 
 class EncryptedFile(object):
+    """
+    A file of encrypted chunks. Writes are buffered and encrypted a chunk
+    at a time, the last chunk being written on close.
+
+    A file opened for appending gets new chunks after its final one, and
+    only once they are all written is the old final chunk re-encrypted
+    as an ordinary one, in place. Until then readers still stop at the
+    old final chunk, so an append which fails half way loses nothing.
+
+    >>> import tempfile
+    >>> fn = os.path.join(tempfile.mkdtemp(), 'test.enc')
+    >>> fd = EncryptedFile(fn, 'secret')
+    >>> fd.write('Hello'); fd.close()
+    >>> fd = EncryptedFile(fn, 'secret', mode='a')
+    >>> fd.write(' world!'); fd.close()
+    >>> EncryptedFile(fn, 'secret', mode='r').read()
+    'Hello world!'
+
+    Appends spanning chunks, and appends which never finish:
+
+    >>> fd = EncryptedFile(fn, 'secret', mode='a')
+    >>> fd.write('x' * 100000); fd.close()
+    >>> fd = EncryptedFile(fn, 'secret', mode='a')
+    >>> fd.write('y' * 200000); fd.fd.flush()
+    >>> data = EncryptedFile(fn, 'secret', mode='r').read()
+    >>> len(data), data.startswith('Hello world!x'), data.endswith('xx')
+    (100012, True, True)
+    >>> fd = EncryptedFile(fn, 'secret', mode='a')
+    >>> fd.write('z'); fd.close()
+    >>> data = EncryptedFile(fn, 'secret', mode='r').read()
+    >>> len(data), data.endswith('xxz')
+    (100013, True)
+    """
     def __init__(self, filename, secret, mode="w"):
         self.encrypter = SymmetricEncrypter(secret)
         self.filename = filename
-        self.fd = open(filename, mode)
-        self.data = ""
+        self.chunk = 0
+        self.data = []
+        self.size = 0
+        self.last = None
+        if 'r' in mode:
+            self.fd = open(filename, 'rb')
+        elif 'a' in mode and os.path.exists(filename):
+            self._open_append()
+        else:
+            self.fd = open(filename, 'wb')
+            header, self.salt = self.encrypter.header()
+            self.fd.write(header)
+
+    def _open_append(self):
+        # Find the final chunk, which close() marks as an ordinary one
+        # once the appended chunks are safely written after it.
+        self.fd = open(self.filename, 'r+b')
+        data = self.fd.read()
+        self.salt, pos = self.encrypter.parse_header(data)
+        final = False
+        while not final:
+            last = pos
+            final, start, pos = self.encrypter.parse_chunk(data, pos)
+            self.chunk += 1
+        self.last = (last, self.chunk - 1, self.encrypter.decrypt_chunk(
+            self.salt, self.chunk - 1, True, data[start:pos]))
+        # Drop whatever an append which never finished left behind
+        self.fd.seek(pos)
+        self.fd.truncate()
+
+    def _write_chunk(self, data, final=False):
+        self.fd.write(self.encrypter.encrypt_chunk(self.salt, self.chunk,
+                                                   data, final=final))
+        self.chunk += 1
 
     def write(self, data):
-        self.data += data
+        self.data.append(data)
+        self.size += len(data)
+        if self.size > self.encrypter.CHUNK_SIZE:
+            # Always keep something back for the final chunk
+            data = ''.join(self.data)
+            full = (len(data) - 1) // self.encrypter.CHUNK_SIZE
+            full *= self.encrypter.CHUNK_SIZE
+            for pos in range(0, full, self.encrypter.CHUNK_SIZE):
+                self._write_chunk(data[pos:pos + self.encrypter.CHUNK_SIZE])
+            self.data = [data[full:]]
+            self.size = len(data) - full
+
+    def flush(self):
+        # Buffered data only goes out on close, with the final chunk
+        self.fd.flush()
 
     def read(self):
         return self.encrypter.decrypt(self.fd.read())
 
     def close(self):
-        self.fd.write(self.encrypter.encrypt(self.data))
+        appended = (self.last is None or self.size or
+                    self.chunk > self.last[1] + 1)
+        if appended and not self.fd.closed and ('w' in self.fd.mode or
+                                                '+' in self.fd.mode):
+            self._write_chunk(''.join(self.data), final=True)
+            self.data, self.size = [], 0
+            if self.last is not None:
+                self.fd.flush()
+                os.fsync(self.fd.fileno())
+                pos, chunk, data = self.last
+                self.fd.seek(pos)
+                self.fd.write(self.encrypter.encrypt_chunk(self.salt, chunk,
+                                                           data))
+                self.last = None
         self.fd.close()
 
 
+# If 'python symencrypt.py' is executed, start the doctest unittest
 if __name__ == "__main__":
-    s = SymmetricEncrypter("d3944bfea1e882dfc2e4878fa8905c6a2c")
-    teststr = "Hello! This is a longish thing." * 50
-    print "Example encrypted format:"
-    print s.encrypt(teststr)
-    if teststr == s.decrypt(s.encrypt(teststr)):
-        print "Basic decryption worked"
-    else:
-        print "Encryption test failed"
-
-    t0 = datetime.now()
-    enc = s.encrypt(teststr)
-    print "Speed test:"
-    for i in range(5000):
-        s.decrypt(enc)
-        if i % 50 == 0:
-            print "\r %-3d%% %s>" % (int(i / 50.0), "-" * (i//100)),
-            sys.stdout.flush()
-    t1 = datetime.now()
-    print "\n5000 decrypt ops took %s => %s/op" % ((t1-t0), (t1-t0)/5000)
+    import doctest
+    import sys
+    if doctest.testmod().failed:
+        sys.exit(1)
@@ -15,6 +15,10 @@ CONFIG_RULES = {
         'history_length': (_('History length (lines, <0=no save)'), int,  100),
         'http_port':      (_('Listening port for web UI'), int,         33411),
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
+        'postinglist_cache_kb': (_('Posting list cache size in KB'), int, 8192),
+        'optimize_workers': (_('Processes used to optimize, 0=auto'), int, 0),
+        'search_cache_kb': (_('Search result cache size in KB'), int,   4096),
+        'facets_ms':      (_('Time limit for counting facets (ms)'), int, 500),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
         'debug':          (_('Debugging flags'), str,                      ''),
@@ -50,6 +54,10 @@ CONFIG_RULES = {
         'obfuscate_index': (_('Key to use to scramble the index'), str,    ''),
         'index_encrypted': (_('Make encrypted content searchable'),
                             bool, False),
+        'index_positions': (_('Index word positions for "phrase" searches'),
+                            bool, False),
+        'index_terms':     (_('Keep a term dictionary for wildcard searches'),
+                            bool, True),
         'rescan_command':  (_('Command run before rescanning'), str,       ''),
         'default_email':   (_('Default outgoing e-mail address'), 'email', ''),
         'default_route':   (_('Default outgoing mail route'),
@@ -430,6 +430,7 @@ class Email(object):
                                                 msg_subj, '', [])
             idx.set_conversation_ids(msg_info[idx.MSG_MID], msg,
                                      subject_threading=False)
+            idx.publish_changes()
             return cls(idx, msg_idx)
         else:
             msg_info = idx.edit_msg_info(idx.BOGUS_METADATA[:],
@@ -130,17 +130,30 @@ def get_meta_kw_extractors():
 ##[ Pluggable search terms ]##################################################
 
 SEARCH_TERMS = {}
+SEARCH_TERM_COSTS = {}
 
 
 def get_search_term(term, default=None):
     return SEARCH_TERMS.get(term, default)
 
 
-def register_search_term(term, function):
-    global SEARCH_TERMS
+def get_search_term_cost(term, default=None):
+    return SEARCH_TERM_COSTS.get(term, default)
+
+
+def register_search_term(term, function, cost=None):
+    """
+    Register a search term. The optional cost function estimates how many
+    messages the term will match, so the query planner can order terms:
+    it is called like the search function, but with a function which
+    counts the matches of a keyword instead of one returning them.
+    """
+    global SEARCH_TERMS, SEARCH_TERM_COSTS
     if term in SEARCH_TERMS:
         raise PluginError('Already registered: %s' % term)
     SEARCH_TERMS[term] = function
+    if cost is not None:
+        SEARCH_TERM_COSTS[term] = cost
 
 
 ##[ Pluggable keyword filters ]###############################################
@@ -1,4 +1,5 @@
 from gettext import gettext as _
+import itertools
 
 import mailpile.plugins
 from mailpile.commands import Command, Action
@@ -393,7 +394,9 @@ class AddressSearch(VCardCommand):
         # for matching senders or recipients, give medium priority.
         matches = {}
         addresses = []
-        for msg_idx in index.INDEX_SORT['date_fwd'][-2500:]:
+        latest = itertools.islice(index.INDEX_SORT['date'].ordered(
+            reverse=True), 2500)
+        for msg_idx in reversed(list(latest)):
             msg_info = index.get_msg_at_idx_pos(msg_idx)
             tags = set(msg_info[index.MSG_TAGS].split(','))
             frm = msg_info[index.MSG_FROM]
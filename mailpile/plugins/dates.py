@@ -1,37 +1,13 @@
-import time
+import calendar
 import datetime
+import time
 from gettext import gettext as _
 
 import mailpile.plugins
 
 
-##[ Keywords ]################################################################
-
-def meta_kw_extractor(index, msg_mid, msg, msg_size, msg_ts):
-    mdate = datetime.date.fromtimestamp(msg_ts)
-    keywords = [
-        '%s:year' % mdate.year,
-        '%s:month' % mdate.month,
-        '%s:day' % mdate.day,
-        '%s-%s:yearmonth' % (mdate.year, mdate.month),
-        '%s-%s-%s:date' % (mdate.year, mdate.month, mdate.day)
-    ]
-    return keywords
-
-mailpile.plugins.register_meta_kw_extractor('dates', meta_kw_extractor)
-
-
 ##[ Search terms ]############################################################
 
-def _adjust(d):
-    if d[2] > 31:
-        d[1] += 1
-        d[2] -= 31
-    if d[1] > 12:
-        d[0] += 1
-        d[1] -= 12
-
-
 def _mk_date(ts):
     mdate = datetime.date.fromtimestamp(ts)
     return '%d-%d-%d' % (mdate.year, mdate.month, mdate.day)
@@ -43,7 +19,29 @@ _date_offsets = {
 }
 
 
-def search(config, idx, term, hits):
+def _day(date, last):
+    """
+    Parse a (partial) date: the first day it covers, or for the end of a
+    range, the day after the last one.
+    """
+    if date in _date_offsets:
+        date = _mk_date(time.time() - _date_offsets[date]*24*3600)
+    parts = [int(p) for p in date.split('-')][:3]
+    year, month, day = parts[0], 1, 1
+    if len(parts) == 1 and last:
+        month, day = 12, 31
+    elif len(parts) > 1:
+        month = parts[1]
+        day = (len(parts) > 2) and parts[2] or (last and 31 or 1)
+    day = datetime.date(year, month,
+                        min(day, calendar.monthrange(year, month)[1]))
+    if last:
+        day += datetime.timedelta(days=1)
+    return day
+
+
+def _range(term):
+    """Convert a date range to timestamps, from first to last second."""
     try:
         word = term.split(':', 1)[1].lower()
         if '..' in term:
@@ -51,53 +49,24 @@ def search(config, idx, term, hits):
         else:
             start = end = word
 
-        if start in _date_offsets:
-            start = _mk_date(time.time() - _date_offsets[start]*24*3600)
-        if end in _date_offsets:
-            end = _mk_date(time.time() - _date_offsets[end]*24*3600)
-
-        start = [int(p) for p in start.split('-')][:3]
-        end = [int(p) for p in end.split('-')[:3]]
-        while len(start) < 3:
-            start.append(1)
-        if len(end) == 1:
-            end.extend([12, 31])
-        elif len(end) == 2:
-            end.append(31)
-        if not start <= end:
+        start = _day(start, False)
+        end = _day(end, True)
+        if not start < end:
             raise ValueError()
 
-        terms = []
-        while start <= end:
-            # Move forward one year?
-            if start[1:] == [1, 1]:
-                ny = [start[0], 12, 31]
-                if ny <= end:
-                    terms.append('%d:year' % start[0])
-                    start[0] += 1
-                    continue
-
-            # Move forward one month?
-            if start[2] == 1:
-                nm = [start[0], start[1], 31]
-                if nm <= end:
-                    terms.append('%d-%d:yearmonth' % (start[0], start[1]))
-                    start[1] += 1
-                    _adjust(start)
-                    continue
-
-            # Move forward one day...
-            terms.append('%d-%d-%d:date' % tuple(start))
-            start[2] += 1
-            _adjust(start)
-
-        rt = []
-        for t in terms:
-            rt.extend(hits(t))
-        return rt
+        return (int(time.mktime(start.timetuple())),
+                int(time.mktime(end.timetuple())) - 1)
     except:
         raise ValueError('Invalid date range: %s' % term)
 
 
-mailpile.plugins.register_search_term('dates', search)
-mailpile.plugins.register_search_term('date', search)
+def search(config, idx, term, hits):
+    return hits.range('date', *_range(term))
+
+
+def cost(config, idx, term, count):
+    return idx.count_range('date', *_range(term))
+
+
+mailpile.plugins.register_search_term('dates', search, cost=cost)
+mailpile.plugins.register_search_term('date', search, cost=cost)
@@ -9,9 +9,9 @@ from mailpile.plugins.contacts import *
 
 ##[ Search terms ]############################################################
 
-def search(config, idx, term, hits):
+def _terms(config, term):
     group = config._vcards.get(term.split(':', 1)[1])
-    rt, emails = [], []
+    emails = []
     if group and group.kind == 'group':
         for email, attrs in group.get('EMAIL', []):
             group = config._vcards.get(email.lower(), None)
@@ -20,12 +20,21 @@ def search(config, idx, term, hits):
             else:
                 emails.append(email.lower())
     fromto = term.startswith('group:') and 'from' or 'to'
-    for email in set(emails):
-        rt.extend(hits('%s:%s' % (email, fromto)))
+    return ['%s:%s' % (email, fromto) for email in set(emails)]
+
+
+def search(config, idx, term, hits):
+    rt = []
+    for t in _terms(config, term):
+        rt.extend(hits(t))
     return rt
 
-mailpile.plugins.register_search_term('group', search)
-mailpile.plugins.register_search_term('togroup', search)
+
+def cost(config, idx, term, count):
+    return sum(count(t) for t in _terms(config, term))
+
+mailpile.plugins.register_search_term('group', search, cost=cost)
+mailpile.plugins.register_search_term('togroup', search, cost=cost)
 
 
 ##[ Commands ]################################################################
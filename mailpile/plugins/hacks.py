@@ -3,6 +3,7 @@ from gettext import gettext as _
 import mailpile.plugins
 from mailpile.commands import Command
 from mailpile.mailutils import *
+from mailpile.postinglist import PostingList
 from mailpile.search import *
 from mailpile.util import *
 from mailpile.vcard import *
@@ -47,6 +48,8 @@ class FixIndex(Hacks):
                         bad_info = index.get_msg_at_idx_pos(bad_idx)
                         bad_info[index.MSG_PTRS] = good_info[index.MSG_PTRS]
                         index.set_msg_at_idx_pos(bad_idx, bad_info)
+                    # The bad entries are now just duplicates
+                    index.bury_messages(session, bad)
 
         session.ui.mark('Done!')
         return True
@@ -83,4 +86,13 @@ This is Python inside of Mailpile inside of Python.
         return 'That was fun!'
 
 
-mailpile.plugins.register_commands(Hacks, FixIndex, PyCLI)
+class CacheStats(Hacks):
+    """Report hit rates and sizes of the search caches"""
+    SYNOPSIS = (None, 'hacks/cachestats', None, None)
+
+    def command(self):
+        return {'postinglists': PostingList.CacheStats(),
+                'searches': CachedSearchResultSet.CacheStats()}
+
+
+mailpile.plugins.register_commands(Hacks, FixIndex, PyCLI, CacheStats)
@@ -60,6 +60,14 @@ class Search(Command):
                                                  *args, **kwargs)
 
     def _do_search(self, search=None):
+        session, idx, start, num = self._parse_search(search=search)
+        session.order = session.order or session.config.prefs.default_order
+        session.results = idx.sorted_results(
+            session, idx.search(session, session.searched).as_bitmap(),
+            session.order, count=start + num)
+        return session, idx, start, num
+
+    def _parse_search(self, search=None):
         session, idx = self.session, self._idx()
         session.searched = search or []
         args = self.args[:]
@@ -90,16 +98,32 @@ class Search(Command):
         else:
             start = 0
 
+        # Quoted phrases are searched for as a unit
+        phrases, phrase = [], None
+        for arg in args:
+            if phrase is not None:
+                phrase.append(arg)
+            elif arg.lstrip('+-').startswith('"'):
+                phrase = [arg]
+            else:
+                phrases.append(arg)
+            if phrase and (len(' '.join(phrase).lstrip('+-')) > 1
+                           and phrase[-1].endswith('"')):
+                phrases.append(' '.join(phrase))
+                phrase = None
+        if phrase:
+            phrases.append(' '.join(phrase) + '"')
+        args = phrases
+
         # FIXME: Is this dumb?
         for arg in args:
-            if ':' in arg or (arg and arg[0] in ('-', '+')):
+            if arg.lstrip('+-').startswith('"'):
+                session.searched.append(arg.lower())
+            elif (':' in arg or '*' in arg or
+                    (arg and arg[0] in ('-', '+'))):
                 session.searched.append(arg.lower())
             else:
                 session.searched.extend(re.findall(WORD_REGEXP, arg.lower()))
-
-        session.order = session.order or session.config.prefs.default_order
-        session.results = list(idx.search(session, session.searched).as_set())
-        idx.sort_results(session, session.results, session.order)
         return session, idx, start, num
 
     def command(self, search=None):
@@ -235,6 +259,75 @@ class View(Search):
             return results
 
 
+class Facets(Search):
+    """Count search results by tag, year, sender and mailbox"""
+    SYNOPSIS = (None, 'search/facets', 'search/facets', '<terms>')
+    ORDER = ('Searching', 6)
+    HTTP_CALLABLE = ('GET', )
+    HTTP_QUERY_VARS = {
+        'q': 'search terms',
+        'facet': 'facets to count: tag, year, from or mailbox'
+    }
+    FACETS = ['tag'] + list(MailIndex.FACET_COLUMNS)
+    FACET_MAX = 50
+
+    class CommandResult(Command.CommandResult):
+        def as_text(self):
+            if not self.result:
+                return 'No results'
+            text = []
+            for facet in self.result['facets']:
+                text.append('%s:' % facet['facet'])
+                for value in facet['values']:
+                    text.append('%8d %s' % (value['count'], value['name']))
+                if facet['more']:
+                    text.append('%8s (%d more)' % ('', facet['more']))
+            if not self.result['complete']:
+                text.append(_('(Counting took too long, counts are partial)'))
+            return '\n'.join(text)
+
+    def _facet_value(self, facet, value, count):
+        config = self.session.config
+        if facet == 'tag':
+            tag = config.get_tag(value)
+            name = tag and tag.name or value
+            term = 'in:%s' % (tag and tag.slug or value)
+        elif facet == 'mailbox':
+            name = config.sys.mailbox.get(value, value)
+            term = 'mailbox:%s' % value
+        elif facet == 'year':
+            name = '%s' % value
+            term = 'date:%s' % value
+        else:
+            name = value
+            term = '%s:%s' % (facet, value)
+        return {'name': name, 'term': term, 'count': count}
+
+    def command(self):
+        session, idx, start, num = self._parse_search()
+        wanted = [f for f in self.data.get('facet', []) if f in self.FACETS]
+        facets, complete = idx.facets(session,
+                                      idx.search(session, session.searched),
+                                      wanted=wanted or self.FACETS)
+        result = {
+            'search_terms': session.searched,
+            'complete': complete,
+            'facets': []
+        }
+        for facet in (wanted or self.FACETS):
+            counts = facets.get(facet, {})
+            values = sorted(counts.keys(), key=lambda v: (-counts[v], v))
+            if facet == 'year':
+                values.sort(reverse=True)
+            result['facets'].append({
+                'facet': facet,
+                'values': [self._facet_value(facet, v, counts[v])
+                           for v in values[:self.FACET_MAX]],
+                'more': max(0, len(values) - self.FACET_MAX)
+            })
+        return result
+
+
 class Extract(Command):
     """Extract attachment(s) to file(s)"""
     SYNOPSIS = ('e', 'extract', 'message/download', '<msgs> <att> [><fn>]')
@@ -297,7 +390,7 @@ class Extract(Command):
         return results
 
 
-mailpile.plugins.register_commands(Extract, Next, Order, Previous,
+mailpile.plugins.register_commands(Extract, Facets, Next, Order, Previous,
                                    Search, View)
 
 
@@ -311,7 +404,8 @@ def mailbox_search(config, idx, term, hits):
         mailbox_id = None
 
     mailboxes = [m for m in config.sys.mailbox.keys()
-                 if word in config.sys.mailbox[m].lower() or mailbox_id == m]
+                 if (word in config.sys.mailbox[m].lower()
+                     or mailbox_id == b36(int(m, 36)))]
     rt = []
     for mbox_id in mailboxes:
         mbox_id = (('0' * MBX_ID_LEN) + mbox_id)[-MBX_ID_LEN:]
@@ -1,22 +1,8 @@
-import math
-import time
-import datetime
 from gettext import gettext as _
 
 import mailpile.plugins
 
 
-##[ Keywords ]################################################################
-
-def meta_kw_extractor(index, msg_mid, msg, msg_size, msg_ts):
-    """Create a search term with the floored log2 size of the message."""
-    if msg_size <= 0:
-        return []
-    return ['%s:ln2sz' % int(math.log(msg_size, 2))]
-
-mailpile.plugins.register_meta_kw_extractor('sizes', meta_kw_extractor)
-
-
 ##[ Search terms ]############################################################
 
 
@@ -33,52 +19,63 @@ _range_keywords = [
 ]
 
 
-def _mk_logsize(size, default_unit=0):
-    if not size:
-        return 0
-    unit = 0
+def _mk_size(size, default_unit=0):
+    """Parse a size like 100k or 2mb into bytes, also returning the unit."""
+    unit = default_unit
     size = size.lower()
     if size[-1].isdigit():  # ends with a number
-        unit = default_unit
+        pass
     elif len(size) >= 2 and size[-2] in _size_units and size[-1] == 'b':
         unit = _size_units[size[-2]]
         size = size[:-2]
     elif size[-1] in _size_units:
         unit = _size_units[size[-1]]
         size = size[:-1]
-    try:
-        return int(math.log(float(size), 2) + unit)
-    except ValueError:
-        return 1 + unit
+    return int(float(size) * (1 << unit)), unit
 
 
-def search(config, idx, term, hits):
+def _range(term):
+    """
+    Convert a size range to KB (the index does not know better), either
+    end may be left out. A single size such as size:5m matches messages
+    from that size up to one more of the unit, 5 to 6 MB.
+    """
     try:
         word = term.split(':', 1)[1].lower()
 
         for range_keyword in _range_keywords:
             if range_keyword in term:
                 start, end = word.split(range_keyword)
+                single = False
                 break
         else:
             start = end = word
+            single = True
 
-        # if no unit is setup in the start term, use the unit from the end term
-        end_unit_size = end.lower()[-1]
+        low = high = None
         end_unit = 0
-        if end_unit_size in _size_units:
-            end_unit = _size_units[end_unit_size]
-
-        start = _mk_logsize(start, end_unit)
-        end = _mk_logsize(end)
-        terms = ['%s:ln2sz' % sz for sz in range(start, end+1)]
-
-        rt = []
-        for t in terms:
-            rt.extend(hits(t))
-        return rt
+        if end:
+            high, end_unit = _mk_size(end)
+            if single:
+                high += (1 << end_unit) - 1
+            high //= 1024
+        if start:
+            # if no unit is setup in the start term, use the unit from
+            # the end term
+            low = _mk_size(start, end_unit)[0] // 1024
+        if low is None and high is None:
+            raise ValueError()
+        return low, high
     except:
         raise ValueError('Invalid size: %s' % term)
 
 
-mailpile.plugins.register_search_term('size', search)
+def search(config, idx, term, hits):
+    return hits.range('size', *_range(term))
+
+
+def cost(config, idx, term, count):
+    return idx.count_range('size', *_range(term))
+
+
+mailpile.plugins.register_search_term('size', search, cost=cost)
@@ -4,6 +4,7 @@ import mailpile.plugins
 import mailpile.config
 from mailpile.commands import Command
 from mailpile.urlmap import UrlMap
+from mailpile.bitmap import Bitmap
 from mailpile.util import *
 
 from mailpile.plugins.search import Search
@@ -150,7 +151,7 @@ def GetTagInfo(cfg, tn, stats=False, unread=None):
         stats_all = len(cfg.index.TAGS.get(tid, []))
         info['stats'] = {
             'all': stats_all,
-            'new': len(cfg.index.TAGS.get(tid, set()) & unread),
+            'new': len(cfg.index.TAGS.get(tid, Bitmap()) & unread),
             'not': len(cfg.index.INDEX) - stats_all
         }
     return info
@@ -362,9 +363,9 @@ class ListTags(TagCommand):
         wanted.extend([t.lower() for t in self.data.get('only', [])])
         unwanted.extend([t.lower() for t in self.data.get('not', [])])
 
-        unread_messages = set()
+        unread_messages = Bitmap()
         for tag in self.session.config.get_tags(type='unread'):
-            unread_messages |= idx.TAGS.get(tag._key, set())
+            unread_messages |= idx.TAGS.get(tag._key, Bitmap())
 
         for tag in self.session.config.get_tags(**search):
             if wanted and tag.slug.lower() not in wanted:
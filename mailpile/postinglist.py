@@ -1,91 +1,821 @@
+import collections
+import cStringIO
+import fnmatch
+import heapq
+import mmap
+import multiprocessing
 import os
 import random
+import re
+import struct
 import threading
+import time
+import zlib
 from gettext import gettext as _
 
 import mailpile.util
+from mailpile.bitmap import Bitmap
 from mailpile.util import *
 
 
 GLOBAL_POSTING_LIST = None
 
-GLOBAL_POSTING_LOCK = threading.Lock()
+GLOBAL_POSTING_LOCK = threading.RLock()
 GLOBAL_OPTIMIZE_LOCK = threading.Lock()
 
+# Posting list files are only ever written to under the lock of their
+# directory (the first character of the prefix), per workdir.
+GLOBAL_DIRECTORY_LOCKS = {}
+
+# What the optimize worker processes inherit from their parent.
+GLOBAL_OPTIMIZE_STATE = None
+
+# An in-memory directory of which posting list files exist (per workdir),
+# so finding the file for a signature does not require any stat() calls.
+GLOBAL_POSTING_FILES = {}
+
+# Read-only memory maps of posting list files, shared by all threads and
+# dropped whenever a file is written to.
+GLOBAL_POSTING_MMAPS = {}
+
+# Bloom filters of which signatures each posting list file contains, so
+# searches for absent terms can skip the file entirely.
+GLOBAL_POSTING_BLOOMS = {}
+
+# A bounded LRU cache of decoded posting lists (Bitmaps of hits), keyed
+# by workdir and signature. Memory use is estimated and capped, and the
+# generation counter lets readers detect if the files changed under them.
+GLOBAL_HITS_CACHE = collections.OrderedDict()
+GLOBAL_HITS_CACHE_KB = 8192
+GLOBAL_HITS_CACHE_STATS = {'hits': 0, 'misses': 0, 'bytes': 0,
+                           'generation': 0}
+GLOBAL_HITS_CACHE_LOCK = threading.Lock()
+
+# Journal records waiting to be written, per journal file: a list of
+# records, their total size and when the oldest was buffered. Buffers are
+# flushed when they grow too big or too old, and before the metadata index
+# or mailbox state is saved, so a crash can only lose postings for mail
+# which will be indexed again anyway.
+GLOBAL_JOURNAL_BUFFER = {}
+GLOBAL_JOURNAL_BUFFER_KB = 256
+GLOBAL_JOURNAL_BUFFER_SECONDS = 10
+
+# The last sequence number written to each journal file.
+GLOBAL_JOURNAL_SEQ = {}
+
+# The sorted term dictionary of each workdir (memory mapped), the terms
+# added since it was last rewritten, and those of them which have not yet
+# been appended to the small file of new terms.
+GLOBAL_TERMS = {}
+GLOBAL_TERMS_PENDING = {}
+GLOBAL_TERMS_UNSAVED = {}
+GLOBAL_TERMS_LOCK = threading.RLock()
+
+
+# Posting lists are stored as binary records: a marker byte (which never
+# occurs in the legacy tab-separated text format), a small header with the
+# signature, number of IDs and payload length, and then the payload itself:
+# the sorted message IDs, delta encoded as varints.
+RECORD_MARKER = '\x00'
+
+# Word positions are stored as postings of their own, one integer per
+# occurrence: POSITION_BASE | msg_idx << POSITION_BITS | position. The
+# base keeps them clear of message IDs (and thus tombstones).
+POSITION_BITS = 16
+POSITION_BASE = 1 << 48
+
+
+def varint_encode(value, output):
+    """
+    Append a varint-encoded integer to a bytearray.
+
+    >>> o = bytearray(); varint_encode(300, o); str(o)
+    '\\xac\\x02'
+    """
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def varint_decode(data, pos):
+    """
+    Decode a single varint from a string, returning (value, new position).
+
+    >>> varint_decode('\\x05\\xac\\x02', 1)
+    (300, 3)
+    """
+    value = shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not (b & 0x80):
+            return value, pos
+        shift += 7
+
+
+def encode_record(sig, mail_ids):
+    """
+    Encode a signature and a collection of integer message IDs as a
+    binary posting list record.
+
+    >>> r = encode_record('sig', [5, 1, 300])
+    >>> r
+    '\\x00\\x03sig\\x03\\x04\\x01\\x04\\xa7\\x02'
+    """
+    payload = bytearray()
+    last = 0
+    for mail_id in sorted(mail_ids):
+        varint_encode(mail_id - last, payload)
+        last = mail_id
+    header = bytearray(RECORD_MARKER)
+    varint_encode(len(sig), header)
+    header.extend(str(sig))
+    varint_encode(len(mail_ids), header)
+    varint_encode(len(payload), header)
+    return str(header + payload)
+
+
+def decode_ids(data):
+    """
+    Decode a delta + varint encoded payload into a list of integers.
+
+    >>> decode_ids('\\x01\\x04\\xa7\\x02')
+    [1, 5, 300]
+    """
+    ids = []
+    append = ids.append
+    last = value = shift = 0
+    for b in bytearray(data):
+        if b & 0x80:
+            value |= (b & 0x7f) << shift
+            shift += 7
+        else:
+            last += value | (b << shift)
+            append(last)
+            value = shift = 0
+    return ids
+
+
+def decode_positions(data, msg_idxs, limit):
+    """
+    Decode the word positions of the given messages from a payload,
+    stopping at the first value at or above limit.
+
+    >>> p = POSITION_BASE
+    >>> data = encode_record('s', [p + 1, p + 65537, p + 65538, p + 131074])
+    >>> [v - p for v in decode_positions(data[5:], set([1, 2]), p + 131072)]
+    [65537, 65538]
+    """
+    found = []
+    append = found.append
+    last = value = shift = 0
+    for b in bytearray(data):
+        if b & 0x80:
+            value |= (b & 0x7f) << shift
+            shift += 7
+        else:
+            last += value | (b << shift)
+            value = shift = 0
+            if last >= limit:
+                break
+            if ((last - POSITION_BASE) >> POSITION_BITS) in msg_idxs:
+                append(last)
+    return found
+
+
+def parse_records(data, callback, text_parser=None):
+    """
+    Parse a string of binary posting list records, calling the callback
+    with the signature and a list of IDs for each record. Any legacy
+    text lines found in between records are passed to text_parser (or
+    ignored, if no text_parser is given).
+
+    Parsing stops at an incomplete record (a write in progress) and the
+    number of bytes consumed is returned.
+
+    >>> r = encode_record('sig', [1, 2])
+    >>> out = []
+    >>> parse_records(r + r[:-1], lambda s, ids: out.append((s, ids)))
+    9
+    >>> out
+    [('sig', [1, 2])]
+    """
+    pos, end = 0, len(data)
+    while pos < end:
+        if data[pos] == RECORD_MARKER:
+            try:
+                slen, p = varint_decode(data, pos + 1)
+                sig = data[p:p + slen]
+                count, p = varint_decode(data, p + slen)
+                plen, p = varint_decode(data, p)
+            except IndexError:
+                break
+            if p + plen > end:
+                break
+            callback(sig, decode_ids(data[p:p + plen]))
+            pos = p + plen
+        else:
+            # Legacy text (or encrypted) data: everything up to the next
+            # line which starts with a record marker.
+            nxt = data.find('\n' + RECORD_MARKER, pos)
+            nxt = (nxt < 0) and end or (nxt + 1)
+            if text_parser is not None:
+                text_parser(data[pos:nxt])
+            pos = nxt
+    return pos
+
+
+def record_sigs(data):
+    """
+    Return the signatures of all the binary records in a string, skipping
+    over the payloads without decoding them.
+
+    >>> record_sigs(encode_record('abc', [1]) + encode_record('de', [2]))
+    ['abc', 'de']
+    """
+    sigs = []
+    pos, end = 0, len(data)
+    while pos < end and data[pos] == RECORD_MARKER:
+        try:
+            slen, p = varint_decode(data, pos + 1)
+            sigs.append(data[p:p + slen])
+            count, p = varint_decode(data, p + slen)
+            plen, p = varint_decode(data, p)
+        except IndexError:
+            break
+        pos = p + plen
+    return sigs
+
+
+# The journal of recent postings starts with a magic number, followed by
+# frames: a header with a checksum, the payload length and a sequence
+# number, and then the payload, which is a batch of posting list records.
+JOURNAL_MAGIC = '\x89MPJ'
+JOURNAL_FRAME = struct.Struct('>IIQ')
+
+
+def encode_frame(seq, payload):
+    """
+    Encode a checksummed journal frame.
+
+    >>> len(encode_frame(1, 'abc')) == JOURNAL_FRAME.size + 3
+    True
+    """
+    header = struct.pack('>IQ', len(payload), seq)
+    crc = zlib.crc32(header + payload) & 0xffffffff
+    return struct.pack('>I', crc) + header + payload
+
+
+def parse_frames(data):
+    """
+    Parse a journal, returning a list of (sequence, payload) tuples and
+    the number of bytes which were valid. Parsing stops at the first
+    frame which is incomplete, corrupt or out of sequence.
+
+    >>> j = JOURNAL_MAGIC + encode_frame(1, 'ab') + encode_frame(2, 'cd')
+    >>> parse_frames(j)
+    ([(1, 'ab'), (2, 'cd')], 40)
+    >>> parse_frames(j[:-1])
+    ([(1, 'ab')], 22)
+    >>> parse_frames(j[:-1] + 'x')
+    ([(1, 'ab')], 22)
+    >>> parse_frames(j + encode_frame(2, 'ef'))
+    ([(1, 'ab'), (2, 'cd')], 40)
+    """
+    if not data.startswith(JOURNAL_MAGIC):
+        return [], 0
+    frames = []
+    pos, end = len(JOURNAL_MAGIC), len(data)
+    while pos + JOURNAL_FRAME.size <= end:
+        crc, plen, seq = JOURNAL_FRAME.unpack_from(data, pos)
+        start = pos + JOURNAL_FRAME.size
+        if start + plen > end:
+            break
+        if zlib.crc32(data[pos + 4:start + plen]) & 0xffffffff != crc:
+            break
+        if frames and seq <= frames[-1][0]:
+            break
+        frames.append((seq, data[start:start + plen]))
+        pos = start + plen
+    return frames, pos
+
+
+class BloomFilter(object):
+    """
+    A simple Bloom filter, answering "definitely not here" for keys which
+    were never added.
+
+    >>> bf = BloomFilter(['hello', 'world'])
+    >>> 'hello' in bf, 'world' in bf, 'nothere' in bf
+    (True, True, False)
+    >>> bf.add('nothere')
+    >>> 'nothere' in bf
+    True
+    """
+    HASHES = 4
+    BITS_PER_KEY = 10
+    MIN_KEYS = 256
+
+    def __init__(self, keys=None):
+        keys = keys or []
+        # Leave room for the file to grow through appends
+        self.size = self.BITS_PER_KEY * max(self.MIN_KEYS, 2 * len(keys))
+        self.bits = bytearray((self.size + 7) // 8)
+        for key in keys:
+            self.add(key)
+
+    def _positions(self, key):
+        h = hash(key)
+        h1, h2 = h & 0xffffffff, ((h >> 32) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.size for i in range(0, self.HASHES)]
+
+    def add(self, key):
+        for bit in self._positions(key):
+            self.bits[bit >> 3] |= (1 << (bit & 7))
+
+    def __contains__(self, key):
+        for bit in self._positions(key):
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+
+TERMS_MAGIC = '\x89MPT'
+TERMS_FOOTER = struct.Struct('>III')
+
+
+class TermDictionary(object):
+    """
+    A sorted dictionary of the terms in the search index and their
+    (approximate) document frequencies, for prefix and wildcard searches.
+    Posting lists are keyed by a hash of the term, so this is the only
+    place the terms themselves are kept; their signatures are WordSig().
+
+    Terms are front-coded: each only stores the suffix which differs from
+    the term before it. Every BLOCK terms the coding restarts with a whole
+    term, and an index of where the blocks start lets lookups binary search
+    a memory-mapped file instead of loading it.
+
+    >>> td = TermDictionary(TermDictionary.Encode([
+    ...     ('invite', 1), ('invoice', 3), ('invoices', 2), ('zebra', 1)],
+    ...     block=2))
+    >>> list(td.iterate('invoic'))
+    [('invoice', 3), ('invoices', 2)]
+    >>> td.get('zebra'), td.get('zebr'), len(td), len(list(td))
+    (1, None, 4, 4)
+    >>> list(TermDictionary.MergeItems(td, [('invoice', 1), ('x', 1)]))[1:]
+    [('invoice', 4), ('invoices', 2), ('x', 1), ('zebra', 1)]
+    """
+    BLOCK = 32
+    FILE = 'kw-terms.dat'
+    NEW_FILE = 'kw-terms-new.dat'
+
+    # Rewrite the dictionary during a rescan once this many terms are new
+    MERGE_TERMS = 50000
+
+    # Wildcards expand into an OR of at most this many terms
+    EXPAND_MAX = 250
+
+    def __init__(self, data=''):
+        self.data = data
+        if data[:len(TERMS_MAGIC)] == TERMS_MAGIC:
+            self.count, blocks, self.end = TERMS_FOOTER.unpack(
+                data[-TERMS_FOOTER.size:])
+            self.blocks = struct.unpack('>%dI' % blocks,
+                                        data[self.end:self.end + 4 * blocks])
+        else:
+            self.count, self.blocks, self.end = 0, (), 0
+
+    @classmethod
+    def Encode(cls, items, block=None):
+        """Encode sorted (term, document frequency) pairs."""
+        block = block or cls.BLOCK
+        output, blocks = bytearray(TERMS_MAGIC), []
+        count, last = 0, ''
+        for term, df in items:
+            if count % block == 0:
+                blocks.append(len(output))
+                last = ''
+            shared = len(os.path.commonprefix([last, term]))
+            varint_encode(shared, output)
+            varint_encode(len(term) - shared, output)
+            output.extend(term[shared:])
+            varint_encode(df, output)
+            last = term
+            count += 1
+        end = len(output)
+        output.extend(struct.pack('>%dI' % len(blocks), *blocks))
+        output.extend(TERMS_FOOTER.pack(count, len(blocks), end))
+        return str(output)
+
+    @classmethod
+    def MergeItems(cls, *iterables):
+        """Merge sorted (term, df) iterables, adding up the frequencies."""
+        term = df = None
+        for t, d in heapq.merge(*iterables):
+            if t == term:
+                df += d
+            else:
+                if term is not None:
+                    yield term, df
+                term, df = t, d
+        if term is not None:
+            yield term, df
+
+    def _read(self, block):
+        data, pos = self.data, self.blocks[block]
+        if block + 1 < len(self.blocks):
+            end = self.blocks[block + 1]
+        else:
+            end = self.end
+        term = ''
+        while pos < end:
+            shared, pos = varint_decode(data, pos)
+            slen, pos = varint_decode(data, pos)
+            term = term[:shared] + data[pos:pos + slen]
+            df, pos = varint_decode(data, pos + slen)
+            yield term, df
+
+    def _first(self, block):
+        for term, df in self._read(block):
+            return term
+
+    def iterate(self, prefix=''):
+        """Iterate in order through the terms starting with a prefix."""
+        # Find the last block which starts before the prefix
+        lo, hi = 0, len(self.blocks)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._first(mid) < prefix:
+                lo = mid
+            else:
+                hi = mid
+        for block in range(lo, len(self.blocks)):
+            for term, df in self._read(block):
+                if term.startswith(prefix):
+                    yield term, df
+                elif term > prefix:
+                    return
+
+    def get(self, term):
+        for t, df in self.iterate(term):
+            return (t == term) and df or None
+        return None
+
+    def __iter__(self):
+        return self.iterate()
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def Enabled(cls, config):
+        # A list of every word in the mail would defeat obfuscation.
+        return (config.prefs.index_terms and
+                not config.prefs.obfuscate_index)
+
+    @classmethod
+    def _Load(cls, workdir):
+        if workdir not in GLOBAL_TERMS:
+            data = ''
+            try:
+                fd = open(os.path.join(workdir, cls.FILE), 'rb')
+                try:
+                    if os.fstat(fd.fileno()).st_size:
+                        data = mmap.mmap(fd.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+                finally:
+                    fd.close()
+            except (IOError, OSError, ValueError):
+                pass
+            GLOBAL_TERMS[workdir] = cls(data)
+            GLOBAL_TERMS_PENDING[workdir] = cls._LoadNew(workdir)
+        return GLOBAL_TERMS[workdir], GLOBAL_TERMS_PENDING[workdir]
+
+    @classmethod
+    def _LoadNew(cls, workdir):
+        pending, pos = {}, 0
+        filename = os.path.join(workdir, cls.NEW_FILE)
+        try:
+            fd = open(filename, 'rb')
+            try:
+                data = fd.read()
+            finally:
+                fd.close()
+        except (IOError, OSError):
+            return pending
+        try:
+            while pos < len(data):
+                slen, p = varint_decode(data, pos)
+                term = data[p:p + slen]
+                df, p = varint_decode(data, p + slen)
+                pending[term] = pending.get(term, 0) + df
+                pos = p
+        except IndexError:
+            # Torn write: drop it, so later appends are not misaligned
+            fd = open(filename, 'r+b')
+            fd.truncate(pos)
+            fd.close()
+        return pending
+
+    @classmethod
+    def _Remove(cls, workdir):
+        for fn in (cls.FILE, cls.NEW_FILE):
+            fn = os.path.join(workdir, fn)
+            if os.path.exists(fn):
+                os.remove(fn)
+        for d in (GLOBAL_TERMS, GLOBAL_TERMS_PENDING, GLOBAL_TERMS_UNSAVED):
+            d.pop(workdir, None)
+
+    @classmethod
+    def Add(cls, session, postings):
+        """Record the terms of a list of (word, mail_ids) postings."""
+        workdir = session.config.workdir
+        try:
+            GLOBAL_TERMS_LOCK.acquire()
+            pending = cls._Load(workdir)[1]
+            unsaved = GLOBAL_TERMS_UNSAVED.setdefault(workdir, {})
+            for word, mail_ids in postings:
+                if '\t' in word:
+                    continue
+                if isinstance(word, unicode):
+                    word = word.encode('utf-8')
+                pending[word] = pending.get(word, 0) + len(mail_ids)
+                unsaved[word] = unsaved.get(word, 0) + len(mail_ids)
+        finally:
+            GLOBAL_TERMS_LOCK.release()
+
+    @classmethod
+    def Flush(cls):
+        """Append any unsaved new terms to the new-terms files."""
+        try:
+            GLOBAL_TERMS_LOCK.acquire()
+            for workdir in GLOBAL_TERMS_UNSAVED.keys():
+                output = bytearray()
+                for term, df in GLOBAL_TERMS_UNSAVED[workdir].iteritems():
+                    varint_encode(len(term), output)
+                    output.extend(term)
+                    varint_encode(df, output)
+                fd = open(os.path.join(workdir, cls.NEW_FILE), 'ab')
+                try:
+                    fd.write(output)
+                finally:
+                    fd.close()
+                del GLOBAL_TERMS_UNSAVED[workdir]
+        finally:
+            GLOBAL_TERMS_LOCK.release()
+
+    @classmethod
+    def Merge(cls, session, force=False):
+        """
+        Rewrite the dictionary to include the new terms, if there are
+        enough of them (or force is set). Returns how many were merged.
+        """
+        workdir = session.config.workdir
+        try:
+            GLOBAL_TERMS_LOCK.acquire()
+            if not cls.Enabled(session.config):
+                cls._Remove(workdir)
+                return 0
+            terms, pending = cls._Load(workdir)
+            if not pending or (len(pending) < cls.MERGE_TERMS
+                               and not force):
+                return 0
+            filename = os.path.join(workdir, cls.FILE)
+            fd = open(filename + '.tmp', 'wb')
+            try:
+                fd.write(cls.Encode(cls.MergeItems(
+                    terms, sorted(pending.iteritems()))))
+                fd.flush()
+                os.fsync(fd.fileno())
+            finally:
+                fd.close()
+            os.rename(filename + '.tmp', filename)
+            if os.path.exists(os.path.join(workdir, cls.NEW_FILE)):
+                os.remove(os.path.join(workdir, cls.NEW_FILE))
+            # Readers may still be using the old map, so it is not closed
+            # here; it goes away with the last reference to it.
+            merged = len(pending)
+            for d in (GLOBAL_TERMS, GLOBAL_TERMS_PENDING,
+                      GLOBAL_TERMS_UNSAVED):
+                d.pop(workdir, None)
+            return merged
+        finally:
+            GLOBAL_TERMS_LOCK.release()
+
+    @classmethod
+    def Expand(cls, session, pattern, limit=None):
+        """
+        Expand a pattern using * and ? wildcards into the most frequent
+        matching terms. Returns (terms, truncated), or (None, False) if
+        the dictionary is disabled. Terms with a suffix (like foo:from)
+        only match patterns which have one too. Patterns which do not
+        start with a literal prefix have to scan the whole dictionary.
+        """
+        if not cls.Enabled(session.config):
+            return None, False
+        if isinstance(pattern, unicode):
+            pattern = pattern.encode('utf-8')
+        prefix = re.split('[*?]', pattern, 1)[0]
+        match = re.compile(fnmatch.translate(pattern)).match
+        suffixed = ':' in pattern
+        try:
+            GLOBAL_TERMS_LOCK.acquire()
+            terms, pending = cls._Load(session.config.workdir)
+            pending = sorted((t, df) for t, df in pending.iteritems()
+                             if t.startswith(prefix))
+        finally:
+            GLOBAL_TERMS_LOCK.release()
+
+        found = []
+        for term, df in cls.MergeItems(terms.iterate(prefix), pending):
+            if (suffixed or ':' not in term) and match(term):
+                found.append((df, term))
+        limit = limit or cls.EXPAND_MAX
+        found.sort(key=lambda f: (-f[0], f[1]))
+        return [term for df, term in found[:limit]], (len(found) > limit)
+
 
 class PostingList(object):
-    """A posting list is a map of search terms to message IDs."""
+    """A posting list is a map of search terms to (integer) message IDs."""
 
     CHARACTERS = 'abcdefghijklmnopqrstuvwxyz0123456789+_'
 
     MAX_SIZE = 60    # perftest gives: 75% below 500ms, 50% below 100ms
     HASH_LEN = 24
 
+    @classmethod
+    def _ListFiles(cls, postinglist_dir):
+        return dict((fn, os.path.getsize(os.path.join(postinglist_dir, fn)))
+                    for fn in os.listdir(postinglist_dir)
+                    if not fn.endswith('.new'))
+
     @classmethod
     def _Optimize(cls, session, idx, force=False):
         flush_append_cache()
 
-        postinglist_kb = session.config.sys.postinglist_kb
+        dead = (idx is not None) and idx.TOMBSTONES or None
+        workers = session.config.sys.optimize_workers
+        if workers < 1:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(cls.CHARACTERS))
 
-        # Pass 1: Compact all files that are 90% or more of our target size
-        for c in cls.CHARACTERS:
-            postinglist_dir = session.config.postinglist_dir(c)
-            for fn in sorted(os.listdir(postinglist_dir)):
+        if workers > 1 and hasattr(os, 'fork'):
+            filecount = cls._OptimizeParallel(session, dead, force, workers)
+        else:
+            filecount = 0
+            for c in cls.CHARACTERS:
                 if mailpile.util.QUITTING:
                     break
-                filesize = os.path.getsize(os.path.join(postinglist_dir, fn))
-                if force or (filesize > 900 * postinglist_kb):
-                    session.ui.mark('Pass 1: Compacting >%s<' % fn)
-                    play_nice_with_threads()
-                    try:
-                        GLOBAL_POSTING_LOCK.acquire()
-                        # FIXME: Remove invalid and deleted messages from
-                        #        posting lists.
-                        cls(session, fn, sig=fn).save()
-                    finally:
-                        GLOBAL_POSTING_LOCK.release()
+                filecount += cls._OptimizeDir(session, c, dead, force)
 
-        # Pass 2: While mergable pair exists: merge them!
         flush_append_cache()
-        for c in cls.CHARACTERS:
-            postinglist_dir = session.config.postinglist_dir(c)
-            files = [n for n in os.listdir(postinglist_dir) if len(n) > 1]
-            files.sort(key=lambda a: -len(a))
-            for fn in files:
+        session.ui.mark('Optimized %s posting lists' % filecount)
+        return filecount
+
+    @classmethod
+    def _OptimizeParallel(cls, session, dead, force, workers):
+        """
+        Optimize the posting list directories in a pool of worker
+        processes. While a worker has a directory, we hold its lock so
+        nothing else writes to it, and afterwards we reload our view of
+        the directory from disk.
+        """
+        global GLOBAL_OPTIMIZE_STATE
+        GLOBAL_OPTIMIZE_STATE = (session, dead, force)
+
+        # No writes may be in flight, or buffered, when the workers fork.
+        # Writers take their directory lock before the posting lock, and
+        # only ever try the fd cache's owner locks without waiting.
+        locks = [cls.DirLock(session, c) for c in cls.CHARACTERS]
+        locks += [GLOBAL_POSTING_LOCK, mailpile.util.APPEND_FD_CACHE_LOCK]
+        for lock in locks:
+            lock.acquire()
+        try:
+            flush_append_cache(lock=False)
+            pool = multiprocessing.Pool(workers, _optimize_worker_init)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+            GLOBAL_OPTIMIZE_STATE = None
+
+        filecount = 0
+        queue, pending = list(cls.CHARACTERS), {}
+        try:
+            while queue or pending:
+                while (queue and len(pending) < workers
+                        and not mailpile.util.QUITTING):
+                    c = queue.pop(0)
+                    lock = cls.DirLock(session, c)
+                    lock.acquire()
+                    # The worker only sees what is on disk
+                    for fn in list(cls.Directory(session)):
+                        if fn.startswith(c):
+                            uncache_fd(cls.SaveFile(session, fn))
+                    pending[c] = (lock, pool.apply_async(_optimize_worker,
+                                                         (c, )))
                 if mailpile.util.QUITTING:
-                    break
-                size = os.path.getsize(os.path.join(postinglist_dir, fn))
-                fnp = fn[:-1]
-                while not os.path.exists(os.path.join(postinglist_dir, fnp)):
-                    fnp = fnp[:-1]
-                size += os.path.getsize(os.path.join(postinglist_dir, fnp))
-                if (size < (1024 * postinglist_kb - (cls.HASH_LEN * 6))):
-                    session.ui.mark('Pass 2: Merging %s into %s' % (fn, fnp))
-                    play_nice_with_threads()
-                    fd = None
+                    queue = []
+                done = [c for c in pending if pending[c][1].ready()]
+                if not done:
+                    time.sleep(0.05)
+                for c in done:
+                    lock, result = pending.pop(c)
                     try:
-                        GLOBAL_POSTING_LOCK.acquire()
-                        fd = cached_open(os.path.join(postinglist_dir,
-                                                      fn), 'r')
-                        fdp = cached_open(os.path.join(postinglist_dir,
-                                                       fnp), 'a')
-                        for line in fd:
-                            fdp.write(line)
-                    except:
-                        flush_append_cache()
-                        raise
+                        filecount += result.get()
+                        session.ui.mark('Optimized directory %s' % c)
                     finally:
-                        if fd:
-                            fd.close()
-                        os.remove(os.path.join(postinglist_dir, fn))
-                        GLOBAL_POSTING_LOCK.release()
+                        cls._Reload(session, c)
+                        lock.release()
+        finally:
+            for c, (lock, result) in pending.iteritems():
+                lock.release()
+            pool.terminate()
+            pool.join()
+        return filecount
+
+    @classmethod
+    def _OptimizeDir(cls, session, c, dead, force, blooms=True):
+        postinglist_kb = session.config.sys.postinglist_kb
+        postinglist_dir = session.config.postinglist_dir(c)
+
+        # Compaction rewrites each file without holding the directory
+        # lock, which is only taken briefly to swap in the new data (see
+        # save), so indexing and searching proceed while we work.
+
+        # Pass 1: Compact all files that are 90% or more of our target
+        for fn, filesize in sorted(cls._ListFiles(postinglist_dir
+                                                  ).iteritems()):
+            if mailpile.util.QUITTING:
+                break
+            if force or (filesize > 900 * postinglist_kb):
+                session.ui.mark('Pass 1: Compacting >%s<' % fn)
+                play_nice_with_threads()
+                pls = cls(session, fn, sig=fn)
+                if dead is not None:
+                    pls.purge(dead)
+                pls.save()
 
+        # Pass 2: While mergable pair exists: merge them!
         flush_append_cache()
-        filecount = 0
-        for c in cls.CHARACTERS:
-            filecount += len(os.listdir(session.config.postinglist_dir(c)))
-        session.ui.mark('Optimized %s posting lists' % filecount)
-        return filecount
+        sizes = cls._ListFiles(postinglist_dir)
+        files = [n for n in sizes if len(n) > 1]
+        files.sort(key=lambda a: -len(a))
+        for fn in files:
+            if mailpile.util.QUITTING:
+                break
+            fnp = fn[:-1]
+            while fnp and fnp not in sizes:
+                fnp = fnp[:-1]
+            if not fnp:
+                # Compaction may have emptied out the shorter prefixes
+                continue
+            size = sizes[fn] + sizes[fnp]
+            if (size < (1024 * postinglist_kb - (cls.HASH_LEN * 6))):
+                session.ui.mark('Pass 2: Merging %s into %s' % (fn, fnp))
+                play_nice_with_threads()
+                cls.Lock(cls.DirLock(session, fn), cls._Merge,
+                         session, postinglist_dir, fn, fnp)
+                sizes[fnp] = size
+                del sizes[fn]
+
+        # Make sure every file has an up-to-date Bloom filter
+        if blooms:
+            for fn in sizes:
+                cls._Bloom(session, fn)
+
+        return len(sizes)
+
+    @classmethod
+    def _Reload(cls, session, c):
+        """Forget everything we know about a directory's files."""
+        files = cls.Directory(session)
+        for fn in [f for f in list(files) if f.startswith(c)]:
+            files.discard(fn)
+            cls._Changed(session, fn)
+        files |= set(cls._ListFiles(session.config.postinglist_dir(c)))
+        cls._Uncache(session, c)
+
+    @classmethod
+    def _Merge(cls, session, postinglist_dir, fn, fnp):
+        fd = None
+        try:
+            fd = cached_open(os.path.join(postinglist_dir, fn), 'r')
+            fdp = cached_open(os.path.join(postinglist_dir, fnp), 'a',
+                              lock=cls.DirLock(session, fnp))
+            fdp.write(fd.read())
+            cls._Changed(session, fnp)
+        except:
+            flush_append_cache()
+            raise
+        finally:
+            if fd:
+                fd.close()
+            uncache_fd(os.path.join(postinglist_dir, fn))
+            os.remove(os.path.join(postinglist_dir, fn))
+            cls._RemoveFile(session, fn)
 
     @classmethod
     def _Append(cls, session, word, mail_ids, compact=True, sig=None):
@@ -106,7 +836,42 @@ class PostingList(object):
             pls.save()
         else:
             # Quick and dirty append is the default.
-            fd.write('%s\t%s\n' % (sig, '\t'.join(mail_ids)))
+            fd.write(encode_record(sig, mail_ids))
+            cls._Changed(session, fn, postings=[(sig, mail_ids)])
+
+    @classmethod
+    def _AppendBatch(cls, session, postings, compact=True):
+        """
+        Append many (sig, mail_ids) postings at once. The postings are
+        grouped by the file they belong in, so each file is opened and
+        written to only once.
+        """
+        directories = {}
+        for sig, mail_ids in sorted(postings):
+            directories.setdefault(sig[:1], []).append((sig, mail_ids))
+        for c, postings in sorted(directories.iteritems()):
+            cls.Lock(cls.DirLock(session, c), cls._AppendDir,
+                     session, postings, compact)
+
+    @classmethod
+    def _AppendDir(cls, session, postings, compact):
+        batches = {}
+        for sig, mail_ids in postings:
+            prefix = cls.FindFile(session, sig) or sig[:1]
+            batches.setdefault(prefix, []).append((sig, mail_ids))
+        for prefix, batch in sorted(batches.iteritems()):
+            fd = cached_open(cls.SaveFile(session, prefix), 'a',
+                             lock=cls.DirLock(session, prefix))
+            fd.write(''.join(encode_record(sig, mail_ids)
+                             for sig, mail_ids in batch))
+            cls._AddFile(session, prefix)
+            cls._Changed(session, prefix, postings=batch)
+            if (compact
+                    and (random.randint(0, 50) == 1)
+                    and (fd.tell() > ((1024 * session.config.sys.postinglist_kb)
+                                      - (cls.HASH_LEN * 6)))):
+                # As in _Append, split out hot-spots once in a while.
+                cls(session, prefix, sig=prefix).save()
 
     @classmethod
     def Lock(cls, lock, method, *args, **kwargs):
@@ -121,8 +886,22 @@ class PostingList(object):
         return cls.Lock(GLOBAL_OPTIMIZE_LOCK, cls._Optimize, *args, **kwargs)
 
     @classmethod
-    def Append(cls, *args, **kwargs):
-        return cls.Lock(GLOBAL_POSTING_LOCK, cls._Append, *args, **kwargs)
+    def Append(cls, session, word, mail_ids, compact=True, sig=None):
+        sig = sig or cls.WordSig(word, session.config)
+        return cls.Lock(cls.DirLock(session, sig), cls._Append,
+                        session, word, mail_ids, compact=compact, sig=sig)
+
+    @classmethod
+    def AppendBatch(cls, *args, **kwargs):
+        return cls._AppendBatch(*args, **kwargs)
+
+    @classmethod
+    def DirLock(cls, session, prefix):
+        key = (session.config.workdir, prefix[:1])
+        lock = GLOBAL_DIRECTORY_LOCKS.get(key)
+        if lock is None:
+            lock = GLOBAL_DIRECTORY_LOCKS.setdefault(key, threading.RLock())
+        return lock
 
     @classmethod
     def WordSig(cls, word, config):
@@ -134,15 +913,313 @@ class PostingList(object):
         return os.path.join(session.config.postinglist_dir(prefix), prefix)
 
     @classmethod
-    def GetFile(cls, session, sig, mode='r'):
+    def Directory(cls, session):
+        workdir = session.config.workdir
+        files = GLOBAL_POSTING_FILES.get(workdir)
+        if files is None:
+            GLOBAL_POSTING_LOCK.acquire()
+            try:
+                files = GLOBAL_POSTING_FILES.get(workdir)
+                if files is None:
+                    files = set()
+                    for c in cls.CHARACTERS:
+                        files |= set(cls._ListFiles(
+                            session.config.postinglist_dir(c)).keys())
+                    GLOBAL_POSTING_FILES[workdir] = files
+            finally:
+                GLOBAL_POSTING_LOCK.release()
+        return files
+
+    @classmethod
+    def _AddFile(cls, session, prefix):
+        cls.Directory(session).add(prefix)
+
+    @classmethod
+    def _RemoveFile(cls, session, prefix):
+        cls.Directory(session).discard(prefix)
+        cls._Changed(session, prefix)
+
+    @classmethod
+    def _Changed(cls, session, prefix, sigs=None, postings=None):
+        """
+        Note that a file has changed: records for the given sigs (or the
+        given (sig, mail_ids) postings) were appended, or if neither is
+        specified, the file was rewritten or removed.
+        """
+        if postings is not None:
+            sigs = [sig for sig, mail_ids in postings]
+        filename = cls.SaveFile(session, prefix)
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            # Readers which loaded a map or Bloom filter before this must
+            # not cache it after, so the generation changes along with it.
+            GLOBAL_HITS_CACHE_STATS['generation'] += 1
+            GLOBAL_POSTING_MMAPS.pop(filename, None)
+            bloom = GLOBAL_POSTING_BLOOMS.get(filename)
+            if bloom is not None and sigs is not None:
+                for sig in sigs:
+                    bloom.add(sig)
+            else:
+                GLOBAL_POSTING_BLOOMS.pop(filename, None)
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+        cls._Uncache(session, prefix, sigs=sigs, postings=postings)
+
+    @classmethod
+    def _Generation(cls):
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            return GLOBAL_HITS_CACHE_STATS['generation']
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+    @classmethod
+    def _CacheIfCurrent(cls, cache, key, value, generation):
+        """Cache a value, unless files changed since it was loaded."""
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            if generation == GLOBAL_HITS_CACHE_STATS['generation']:
+                cache[key] = value
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+    @classmethod
+    def _Uncache(cls, session, prefix, sigs=None, postings=None):
+        workdir = session.config.workdir
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            GLOBAL_HITS_CACHE_STATS['generation'] += 1
+            if postings is not None:
+                # Appends just patch any cached hits in place
+                for sig, mail_ids in postings:
+                    entry = GLOBAL_HITS_CACHE.get((workdir, sig))
+                    if entry is not None:
+                        entry[0].update(mail_ids)
+                        size = entry[0].nbytes()
+                        GLOBAL_HITS_CACHE_STATS['bytes'] += size - entry[1]
+                        entry[1] = size
+                return
+            if sigs is None:
+                sigs = [k[1] for k in GLOBAL_HITS_CACHE
+                        if k[0] == workdir and k[1].startswith(prefix)]
+            for sig in sigs:
+                entry = GLOBAL_HITS_CACHE.pop((workdir, sig), None)
+                if entry is not None:
+                    GLOBAL_HITS_CACHE_STATS['bytes'] -= entry[1]
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+    @classmethod
+    def CacheStats(cls):
+        """Return statistics about the cache of decoded posting lists."""
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            stats = dict(GLOBAL_HITS_CACHE_STATS)
+            stats['entries'] = len(GLOBAL_HITS_CACHE)
+            stats['max_bytes'] = 1024 * GLOBAL_HITS_CACHE_KB
+            return stats
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+    @classmethod
+    def _Bloom(cls, session, prefix, sigs=None):
+        """
+        Return the Bloom filter for a posting list file, building it from
+        the given signatures or the file itself if necessary. Returns None
+        if the file cannot be summarized (legacy format).
+        """
+        filename = cls.SaveFile(session, prefix)
+        bloom = GLOBAL_POSTING_BLOOMS.get(filename)
+        if sigs is not None:
+            bloom = GLOBAL_POSTING_BLOOMS[filename] = BloomFilter(sigs)
+        elif bloom is None:
+            generation = cls._Generation()
+            mm = cls._Map(session, prefix)
+            if mm is None:
+                return None
+            bloom = BloomFilter(record_sigs(mm))
+            cls._CacheIfCurrent(GLOBAL_POSTING_BLOOMS, filename, bloom,
+                                generation)
+        return bloom
+
+    @classmethod
+    def _Map(cls, session, prefix):
+        """
+        Return a (shared) read-only memory map of a posting list file, or
+        None if the file is empty or not in the binary format.
+        """
+        filename = cls.SaveFile(session, prefix)
+        try:
+            return GLOBAL_POSTING_MMAPS[filename]
+        except KeyError:
+            pass
+        generation = cls._Generation()
+        mm = None
+        try:
+            # Note: cached_open flushes any pending appends for us
+            fd = cached_open(filename, 'r')
+            try:
+                mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                if mm[0] != RECORD_MARKER:
+                    mm = None
+            finally:
+                fd.close()
+        except (IOError, OSError, ValueError):
+            pass
+        cls._CacheIfCurrent(GLOBAL_POSTING_MMAPS, filename, mm, generation)
+        return mm
+
+    @classmethod
+    def FindFile(cls, session, sig):
+        files = cls.Directory(session)
         sig = sig[:cls.HASH_LEN]
-        while len(sig) > 0:
-            fn = cls.SaveFile(session, sig)
+        while sig and sig not in files:
+            sig = sig[:-1]
+        return sig or None
+
+    @classmethod
+    def Hits(cls, session, sig):
+        """
+        Return a Bitmap of message IDs for a signature. Recently used
+        posting lists are kept in a memory-bounded LRU cache.
+        """
+        key = (session.config.workdir, sig)
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            entry = GLOBAL_HITS_CACHE.pop(key, None)
+            if entry is not None:
+                GLOBAL_HITS_CACHE[key] = entry
+                GLOBAL_HITS_CACHE_STATS['hits'] += 1
+                return entry[0].copy()
+            GLOBAL_HITS_CACHE_STATS['misses'] += 1
+            generation = GLOBAL_HITS_CACHE_STATS['generation']
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+        hits = cls._ReadHits(session, sig)
+
+        size = hits.nbytes() + len(sig) + 64
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            # If files changed while we were reading, our result may
+            # already be stale and must not be cached.
+            max_bytes = 1024 * GLOBAL_HITS_CACHE_KB
+            if (generation == GLOBAL_HITS_CACHE_STATS['generation']
+                    and size <= max_bytes // 4):
+                GLOBAL_HITS_CACHE[key] = [hits.copy(), size]
+                GLOBAL_HITS_CACHE_STATS['bytes'] += size
+                while GLOBAL_HITS_CACHE_STATS['bytes'] > max_bytes:
+                    k, old = GLOBAL_HITS_CACHE.popitem(last=False)
+                    GLOBAL_HITS_CACHE_STATS['bytes'] -= old[1]
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+        return hits
+
+    @classmethod
+    def _ReadHits(cls, session, sig):
+        """
+        Read the hits for a signature from disk. This slices the relevant
+        records straight out of a memory map of the file where possible,
+        instead of loading and parsing the whole file.
+        """
+        prefix = cls.FindFile(session, sig)
+        if prefix is None:
+            return Bitmap()
+        bloom = cls._Bloom(session, prefix)
+        if bloom is not None and sig not in bloom:
+            return Bitmap()
+
+        mm = cls._Map(session, prefix)
+        if mm is None:
+            return Bitmap(cls(session, sig, sig=sig).hits())
+
+        hits = Bitmap()
+        for count, p, plen in cls._FindRecords(mm, sig):
+            ids = decode_ids(mm[p:p + plen])
+            if len(ids) == count:
+                hits.update(ids)
+        return hits
+
+    @classmethod
+    def _FindRecords(cls, mm, sig):
+        """Yield (count, offset, length) for each record of a signature."""
+        header = RECORD_MARKER + chr(len(sig)) + str(sig)
+        pos = mm.find(header)
+        while pos >= 0:
             try:
-                if os.path.exists(fn):
-                    return (cached_open(fn, mode), sig)
-            except (IOError, OSError):
+                count, p = varint_decode(mm, pos + len(header))
+                plen, p = varint_decode(mm, p)
+                yield count, p, plen
+            except IndexError:
                 pass
+            pos = mm.find(header, pos + 1)
+
+    @classmethod
+    def Positions(cls, session, sig, msg_idxs):
+        """
+        Return the word positions recorded under a signature for the given
+        messages (a set). Unlike hits these are not cached, as positional
+        posting lists are big and only a few messages are ever wanted.
+        """
+        if not msg_idxs:
+            return set()
+        limit = POSITION_BASE | ((max(msg_idxs) + 1) << POSITION_BITS)
+        prefix = cls.FindFile(session, sig)
+        if prefix is None:
+            return set()
+        bloom = cls._Bloom(session, prefix)
+        if bloom is not None and sig not in bloom:
+            return set()
+
+        mm = cls._Map(session, prefix)
+        if mm is None:
+            return set(p for p in cls(session, sig, sig=sig).hits()
+                       if ((p - POSITION_BASE) >> POSITION_BITS) in msg_idxs)
+
+        found = set()
+        for count, p, plen in cls._FindRecords(mm, sig):
+            if p + plen <= len(mm):
+                found.update(decode_positions(mm[p:p + plen], msg_idxs,
+                                              limit))
+        return found
+
+    @classmethod
+    def Count(cls, session, sig):
+        """
+        Estimate how many messages a signature matches (its document
+        frequency) from the record headers, without decoding any IDs.
+        """
+        GLOBAL_HITS_CACHE_LOCK.acquire()
+        try:
+            entry = GLOBAL_HITS_CACHE.get((session.config.workdir, sig))
+            if entry is not None:
+                return len(entry[0])
+        finally:
+            GLOBAL_HITS_CACHE_LOCK.release()
+
+        prefix = cls.FindFile(session, sig)
+        if prefix is None:
+            return 0
+        bloom = cls._Bloom(session, prefix)
+        if bloom is not None and sig not in bloom:
+            return 0
+        mm = cls._Map(session, prefix)
+        if mm is None:
+            return len(cls(session, sig, sig=sig).hits())
+        return sum(count for count, p, plen in cls._FindRecords(mm, sig))
+
+    @classmethod
+    def GetFile(cls, session, sig, mode='r'):
+        files = cls.Directory(session)
+        sig = sig[:cls.HASH_LEN]
+        while len(sig) > 0:
+            if sig in files:
+                try:
+                    return (cached_open(cls.SaveFile(session, sig), mode,
+                                        lock=cls.DirLock(session, sig)),
+                            sig)
+                except (IOError, OSError):
+                    pass
 
             if len(sig) > 1:
                 sig = sig[:-1]
@@ -150,7 +1227,10 @@ class PostingList(object):
                 if 'r' in mode:
                     return (None, sig)
                 else:
-                    return (cached_open(fn, mode), sig)
+                    fd = cached_open(cls.SaveFile(session, sig), mode,
+                                     lock=cls.DirLock(session, sig))
+                    cls._AddFile(session, sig)
+                    return (fd, sig)
         # Not reached
         return (None, None)
 
@@ -166,9 +1246,16 @@ class PostingList(object):
     def _parse_line(self, line):
         words = line.strip().split('\t')
         if len(words) > 1:
-            if words[0] not in self.WORDS:
-                self.WORDS[words[0]] = set()
-            self.WORDS[words[0]] |= set(words[1:])
+            self._parse_record(words[0], [int(w, 36) for w in words[1:]])
+
+    def _parse_record(self, sig, mail_ids):
+        if sig not in self.WORDS:
+            self.WORDS[sig] = set(mail_ids)
+        else:
+            self.WORDS[sig].update(mail_ids)
+
+    def _parse_text(self, data):
+        decrypt_and_parse_lines(cStringIO.StringIO(data), self._parse_line, self.config)
 
     def load(self):
         self.size = 0
@@ -176,8 +1263,8 @@ class PostingList(object):
         if fd:
             try:
                 self.lock.acquire()
-                self.size = decrypt_and_parse_lines(fd, self._parse_line,
-                                                    self.config)
+                self.size = parse_records(fd.read(), self._parse_record,
+                                          text_parser=self._parse_text)
             except ValueError:
                 pass
             finally:
@@ -191,8 +1278,7 @@ class PostingList(object):
             data = self.WORDS.get(word, [])
             if ((prefix == 'ALL' or word.startswith(prefix))
                     and len(data) > 0):
-                output.append(('%s\t%s\n'
-                               ) % (word, '\t'.join(['%s' % x for x in data])))
+                output.append(encode_record(word, data))
         return ''.join(output)
 
     def _compact(self, prefix, output, locked=False):
@@ -211,6 +1297,33 @@ class PostingList(object):
                 output = self._fmt_file(prefix)
         return prefix, output
 
+    def _read_tail(self, outfile):
+        fd = cached_open(outfile, 'r')
+        try:
+            fd.seek(self.size)
+            return fd.read()
+        finally:
+            fd.close()
+
+    def _route_tail(self, tail):
+        # Anything appended to the file since we loaded it gets routed to
+        # wherever it belongs now (compaction may have split things up).
+        def route(sig, mail_ids):
+            fd, fn = self.GetFile(self.session, sig, mode='a')
+            fd.write(encode_record(sig, mail_ids))
+            self._Changed(self.session, fn, sigs=[sig])
+        parse_records(tail, route)
+
+    def _replace_file(self, outfile, output):
+        newfile = '%s.new' % outfile
+        fd = open(newfile, 'w')
+        try:
+            fd.write(output)
+        finally:
+            fd.close()
+        uncache_fd(outfile)
+        os.rename(newfile, outfile)
+
     def save(self, prefix=None, compact=True, mode='w', locked=False):
         if not locked:
             self.lock.acquire()
@@ -223,18 +1336,35 @@ class PostingList(object):
                 outfile = self.SaveFile(self.session, prefix)
                 self.session.ui.mark('Writing %d bytes to %s' % (len(output),
                                                                  outfile))
-                if output:
-                    fd = None
-                    try:
-                        fd = cached_open(outfile, mode)
-                        fd.write(output)
-                        return len(output)
-                    finally:
-                        if mode != 'a' and fd:
-                            fd.close()
-                elif os.path.exists(outfile):
-                    os.remove(outfile)
-                    flush_append_cache()
+                # The formatting above is the slow part, only the actual
+                # file operations below need to block other writers.
+                lock = self.DirLock(self.session, prefix)
+                lock.acquire()
+                try:
+                    replacing = (mode != 'a' and prefix == self.filename
+                                 and os.path.exists(outfile))
+                    if replacing:
+                        tail = self._read_tail(outfile)
+                    sigs = [w for w in self.WORDS
+                            if w.startswith(prefix) and self.WORDS[w]]
+                    if output and mode == 'a':
+                        cached_open(outfile, mode, lock=lock).write(output)
+                        self._AddFile(self.session, prefix)
+                        self._Changed(self.session, prefix, sigs=sigs)
+                    elif output:
+                        self._replace_file(outfile, output)
+                        self._AddFile(self.session, prefix)
+                        self._Changed(self.session, prefix)
+                        self._Bloom(self.session, prefix, sigs=sigs)
+                    elif replacing:
+                        uncache_fd(outfile)
+                        os.remove(outfile)
+                        self._RemoveFile(self.session, prefix)
+                    if replacing:
+                        self._route_tail(tail)
+                    return len(output)
+                finally:
+                    lock.release()
             except:
                 self.session.ui.warning('%s' % (sys.exc_info(), ))
             return 0
@@ -255,6 +1385,24 @@ class PostingList(object):
         finally:
             self.lock.release()
 
+    def purge(self, dead):
+        """
+        Remove dead message IDs, and the word positions of dead messages,
+        from all the loaded posting lists.
+        """
+        if not dead:
+            return self
+        self.lock.acquire()
+        try:
+            for mail_ids in self.WORDS.itervalues():
+                mail_ids.difference_update([
+                    i for i in mail_ids if (i in dead) or
+                    (i >= POSITION_BASE and
+                     ((i - POSITION_BASE) >> POSITION_BITS) in dead)])
+            return self
+        finally:
+            self.lock.release()
+
     def remove(self, eids):
         self.lock.acquire()
         try:
@@ -268,27 +1416,32 @@ class PostingList(object):
             self.lock.release()
 
 
-GLOBAL_GPL_LOCK = threading.Lock()
+GLOBAL_GPL_LOCK = threading.RLock()
 
 
 class GlobalPostingList(PostingList):
 
+    MIGRATE_BATCH = 1000
+
     @classmethod
     def _Optimize(cls, session, idx, force=False, lazy=False, quick=False):
         count = 0
-        global GLOBAL_POSTING_LIST
+        pls = GlobalPostingList(session, '')
         if (GLOBAL_POSTING_LIST
                 and (not lazy or len(GLOBAL_POSTING_LIST) > 20480)):
-            keys = sorted(GLOBAL_POSTING_LIST.keys())
-            pls = GlobalPostingList(session, '')
-            for sig in keys:
-                if (count % 25) == 0:
-                    play_nice_with_threads()
-                    session.ui.mark(('Updating search index... %d%% (%s)'
-                                     ) % (count * 100 / len(keys), sig))
-                pls._migrate(sig, compact=quick)
-                count += 1
-            pls.save()
+            # Everything journaled up to the checkpoint gets migrated
+            # below, after which that part of the journal can go.
+            checkpoint, keys = cls.Lock(GLOBAL_GPL_LOCK, cls._Checkpoint,
+                                        session)
+            for i in range(0, len(keys), cls.MIGRATE_BATCH):
+                play_nice_with_threads()
+                session.ui.mark(('Updating search index... %d%% (%s)'
+                                 ) % (count * 100 / len(keys), keys[i]))
+                batch = keys[i:i + cls.MIGRATE_BATCH]
+                pls._migrate(batch, compact=quick)
+                count += len(batch)
+            cls.Lock(GLOBAL_GPL_LOCK, cls._DropJournal, session, checkpoint)
+        TermDictionary.Merge(session, force=(not lazy))
 
         if quick:
             return count
@@ -299,58 +1452,286 @@ class GlobalPostingList(PostingList):
     def SaveFile(cls, session, prefix):
         return os.path.join(session.config.workdir, 'kw-journal.dat')
 
+    @classmethod
+    def DirLock(cls, session, prefix):
+        return GLOBAL_POSTING_LOCK
+
+    @classmethod
+    def _AddFile(cls, session, prefix):
+        pass
+
+    @classmethod
+    def _RemoveFile(cls, session, prefix):
+        pass
+
+    @classmethod
+    def _Changed(cls, session, prefix, sigs=None, postings=None):
+        pass
+
+    @classmethod
+    def _Bloom(cls, session, prefix, sigs=None):
+        return None
+
     @classmethod
     def GetFile(cls, session, sig, mode='r'):
         try:
-            return (cached_open(cls.SaveFile(session, sig), mode),
+            return (cached_open(cls.SaveFile(session, sig), mode,
+                                lock=GLOBAL_POSTING_LOCK),
                     'kw-journal.dat')
         except (IOError, OSError):
             return (None, 'kw-journal.dat')
 
     @classmethod
     def _Append(cls, session, word, mail_ids, compact=True):
-        super(GlobalPostingList, cls)._Append(session, word, mail_ids,
-                                              compact=compact)
-        global GLOBAL_POSTING_LIST
-        GLOBAL_GPL_LOCK.acquire()
-        try:
-            sig = cls.WordSig(word, session.config)
-            if GLOBAL_POSTING_LIST is None:
-                GLOBAL_POSTING_LIST = {}
+        return cls._AppendWords(session, [word], mail_ids, compact=compact)
+
+    @classmethod
+    def _AppendWords(cls, session, words, mail_ids, compact=True):
+        return cls._AppendPostings(session,
+                                   [(word, mail_ids) for word in words],
+                                   compact=compact)
+
+    @classmethod
+    def _AppendPostings(cls, session, postings, compact=True):
+        if TermDictionary.Enabled(session.config):
+            TermDictionary.Add(session, postings)
+        sigs = []
+        for word, mail_ids in postings:
+            try:
+                sigs.append((cls.WordSig(word, session.config), mail_ids))
+            except UnicodeDecodeError:
+                # FIXME: we just ignore garbage
+                pass
+
+        if GLOBAL_POSTING_LIST is None:
+            # Replay the journal before adding anything new to it
+            cls(session, '')
+        for sig, mail_ids in sigs:
             if sig not in GLOBAL_POSTING_LIST:
                 GLOBAL_POSTING_LIST[sig] = set()
-            for mail_id in mail_ids:
-                GLOBAL_POSTING_LIST[sig].add(mail_id)
+            GLOBAL_POSTING_LIST[sig].update(mail_ids)
+
+        journal = cls.SaveFile(session, None)
+        if compact and (random.randint(0, 50) == 1):
+            size = os.path.getsize(journal) if os.path.exists(journal) else 0
+            if size > (1024 * session.config.sys.postinglist_kb):
+                # Rewriting the journal from memory compacts it and
+                # covers anything still waiting in the buffer.
+                return cls(session, '').save(locked=True)
+        cls.Lock(GLOBAL_POSTING_LOCK, cls._Buffer, journal,
+                 ''.join(encode_record(sig, mail_ids)
+                         for sig, mail_ids in sigs))
+
+    @classmethod
+    def _Buffer(cls, journal, data):
+        buf = GLOBAL_JOURNAL_BUFFER.get(journal)
+        if buf is None:
+            buf = GLOBAL_JOURNAL_BUFFER[journal] = [[], 0, time.time()]
+        buf[0].append(data)
+        buf[1] += len(data)
+        if ((buf[1] > 1024 * GLOBAL_JOURNAL_BUFFER_KB) or
+                (time.time() - buf[2] > GLOBAL_JOURNAL_BUFFER_SECONDS)):
+            cls._Flush(journal)
+
+    @classmethod
+    def _Flush(cls, journal=None):
+        for fn in ([journal] if journal else GLOBAL_JOURNAL_BUFFER.keys()):
+            buf = GLOBAL_JOURNAL_BUFFER.pop(fn, None)
+            if buf:
+                try:
+                    fd = cached_open(fn, 'a', lock=GLOBAL_POSTING_LOCK)
+                    if not fd.tell():
+                        fd.write(JOURNAL_MAGIC)
+                    fd.write(encode_frame(cls._NextSeq(fn), ''.join(buf[0])))
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                except (IOError, OSError):
+                    GLOBAL_JOURNAL_BUFFER[fn] = buf
+                    raise
+        TermDictionary.Flush()
+
+    @classmethod
+    def _NextSeq(cls, journal):
+        seq = GLOBAL_JOURNAL_SEQ[journal] = GLOBAL_JOURNAL_SEQ.get(journal,
+                                                                   0) + 1
+        return seq
+
+    @classmethod
+    def _Checkpoint(cls, session):
+        """
+        Flush the journal and return the last sequence number written,
+        along with the signatures which are currently in memory.
+        """
+        journal = cls.SaveFile(session, None)
+        cls.Flush(journal)
+        return (GLOBAL_JOURNAL_SEQ.get(journal, 0),
+                sorted((GLOBAL_POSTING_LIST or {}).keys()))
+
+    @classmethod
+    def _DropJournal(cls, session, checkpoint):
+        """
+        Drop all journal frames up to and including the checkpoint, as
+        their contents have been migrated to the posting list files.
+        """
+        journal = cls.SaveFile(session, None)
+        GLOBAL_POSTING_LOCK.acquire()
+        try:
+            cls._Flush(journal)
+            try:
+                fd = cached_open(journal, 'r')
+            except (IOError, OSError):
+                return
+            try:
+                frames, valid = parse_frames(fd.read())
+            finally:
+                fd.close()
+            output = ''.join(encode_frame(seq, payload)
+                             for seq, payload in frames if seq > checkpoint)
+            if output:
+                cls._WriteJournal(journal, JOURNAL_MAGIC + output)
+            else:
+                uncache_fd(journal)
+                os.remove(journal)
         finally:
-            GLOBAL_GPL_LOCK.release()
+            GLOBAL_POSTING_LOCK.release()
+
+    @classmethod
+    def _WriteJournal(cls, journal, data):
+        newfile = '%s.new' % journal
+        fd = open(newfile, 'wb')
+        try:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        finally:
+            fd.close()
+        uncache_fd(journal)
+        os.rename(newfile, journal)
+
+    @classmethod
+    def Append(cls, *args, **kwargs):
+        return cls.Lock(GLOBAL_GPL_LOCK, cls._Append, *args, **kwargs)
+
+    @classmethod
+    def AppendWords(cls, *args, **kwargs):
+        return cls.Lock(GLOBAL_GPL_LOCK, cls._AppendWords, *args, **kwargs)
+
+    @classmethod
+    def AppendPostings(cls, *args, **kwargs):
+        return cls.Lock(GLOBAL_GPL_LOCK, cls._AppendPostings,
+                        *args, **kwargs)
+
+    @classmethod
+    def Flush(cls, *args, **kwargs):
+        """Write any buffered journal records to disk."""
+        return cls.Lock(GLOBAL_POSTING_LOCK, cls._Flush, *args, **kwargs)
 
     def __init__(self, *args, **kwargs):
         PostingList.__init__(self, *args, **kwargs)
         self.lock = GLOBAL_GPL_LOCK
 
     def _fmt_file(self, prefix):
-        return PostingList._fmt_file(self, 'ALL')
+        records = PostingList._fmt_file(self, 'ALL')
+        if not records:
+            return ''
+        journal = self.SaveFile(self.session, None)
+        return JOURNAL_MAGIC + encode_frame(self._NextSeq(journal), records)
+
+    def _replace_file(self, outfile, output):
+        self._WriteJournal(outfile, output)
 
     def _compact(self, prefix, output, **kwargs):
         return prefix, output
 
+    def _read_tail(self, outfile):
+        # Concurrent appends are already in GLOBAL_POSTING_LIST
+        return ''
+
     def load(self):
         self.filename = 'kw-journal.dat'
         global GLOBAL_POSTING_LIST
-        if GLOBAL_POSTING_LIST:
+        GLOBAL_GPL_LOCK.acquire()
+        try:
+            if GLOBAL_POSTING_LIST is None:
+                self.WORDS = {}
+                self._replay()
+                GLOBAL_POSTING_LIST = self.WORDS
             self.WORDS = GLOBAL_POSTING_LIST
-        else:
-            PostingList.load(self)
-            GLOBAL_POSTING_LIST = self.WORDS
+        finally:
+            GLOBAL_GPL_LOCK.release()
+
+    def _replay(self):
+        journal = self.SaveFile(self.session, None)
+        try:
+            fd = cached_open(journal, 'r')
+        except (IOError, OSError):
+            return
+        try:
+            data = fd.read()
+        finally:
+            fd.close()
+        if not data:
+            return
+
+        if not data.startswith(JOURNAL_MAGIC):
+            # An old-style journal: parse it and convert it.
+            parse_records(data, self._parse_record,
+                          text_parser=self._parse_text)
+            self.save(locked=True)
+            return
+
+        frames, valid = parse_frames(data)
+        for seq, payload in frames:
+            parse_records(payload, self._parse_record)
+        if frames:
+            GLOBAL_JOURNAL_SEQ[journal] = frames[-1][0]
+        if valid < len(data):
+            # A torn (or otherwise damaged) tail: anything after the last
+            # good frame is discarded, so it cannot confuse later replays.
+            self.session.ui.warning(_('Truncating journal %s at %d bytes'
+                                      ) % (journal, valid))
+            GLOBAL_POSTING_LOCK.acquire()
+            try:
+                uncache_fd(journal)
+                fd = open(journal, 'r+b')
+                try:
+                    fd.truncate(valid)
+                finally:
+                    fd.close()
+            finally:
+                GLOBAL_POSTING_LOCK.release()
+
+    def save(self, *args, **kwargs):
+        self.lock.acquire()
+        GLOBAL_POSTING_LOCK.acquire()
+        try:
+            # Everything in the buffer is also in memory, so it will be
+            # part of the rewritten journal.
+            GLOBAL_JOURNAL_BUFFER.pop(self.SaveFile(self.session, None), None)
+            return PostingList.save(self, *args, **kwargs)
+        finally:
+            GLOBAL_POSTING_LOCK.release()
+            self.lock.release()
 
-    def _migrate(self, sig=None, compact=True):
+    def _migrate(self, sigs=None, compact=True):
         self.lock.acquire()
         try:
-            sig = sig or self.sig
-            if sig in self.WORDS and len(self.WORDS[sig]) > 0:
-                PostingList.Append(self.session, sig, self.WORDS[sig],
-                                   sig=sig, compact=compact)
-                del self.WORDS[sig]
+            postings = [(sig, set(self.WORDS[sig]))
+                        for sig in (sigs or [self.sig])
+                        if self.WORDS.get(sig)]
+        finally:
+            self.lock.release()
+
+        PostingList.AppendBatch(self.session, postings, compact=compact)
+
+        # Only forget what we wrote, new postings may have arrived since.
+        self.lock.acquire()
+        try:
+            for sig, mail_ids in postings:
+                if sig in self.WORDS:
+                    self.WORDS[sig] -= mail_ids
+                    if not self.WORDS[sig]:
+                        del self.WORDS[sig]
         finally:
             self.lock.release()
 
@@ -360,6 +1741,67 @@ class GlobalPostingList(PostingList):
         return PostingList.remove(self, eids)
 
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
-                | PostingList(self.session, self.word,
-                              sig=self.sig, config=self.config).hits())
+        # Copying the set is atomic, iterating over it while the indexer
+        # adds to it is not.
+        return (PostingList.Hits(self.session, self.sig)
+                | set(self.WORDS.get(self.sig, ())))
+
+    def positions(self, msg_idxs):
+        pending = set(self.WORDS.get(self.sig, ()))
+        return (PostingList.Positions(self.session, self.sig, msg_idxs)
+                | set(p for p in pending
+                      if ((p - POSITION_BASE) >> POSITION_BITS) in msg_idxs))
+
+    def count(self):
+        return (PostingList.Count(self.session, self.sig)
+                + len(self.WORDS.get(self.sig, ())))
+
+
+def _optimize_worker_init():
+    # We were forked: locks held by other threads of the parent will never
+    # be released here, so we need fresh ones.
+    global GLOBAL_POSTING_LOCK, GLOBAL_OPTIMIZE_LOCK, GLOBAL_GPL_LOCK
+    global GLOBAL_HITS_CACHE_LOCK, GLOBAL_DIRECTORY_LOCKS, GLOBAL_WORKER
+    GLOBAL_POSTING_LOCK = threading.RLock()
+    GLOBAL_OPTIMIZE_LOCK = threading.Lock()
+    GLOBAL_GPL_LOCK = threading.RLock()
+    GLOBAL_HITS_CACHE_LOCK = threading.Lock()
+    GLOBAL_DIRECTORY_LOCKS = {}
+
+    # Descriptors we inherited may hold the parent's buffered writes, so
+    # they must not be flushed (again) by us.
+    drop_append_cache()
+
+    from mailpile.ui import BackgroundInteraction, Session
+    session, dead, force = GLOBAL_OPTIMIZE_STATE
+    worker_session = Session(session.config)
+    worker_session.ui = BackgroundInteraction(session.config)
+    GLOBAL_WORKER = (worker_session, dead, force)
+
+
+def _optimize_worker(c):
+    session, dead, force = GLOBAL_WORKER
+
+    # Writers may have changed the files since we were forked, but not
+    # while the parent holds this directory's lock for us: forget what we
+    # inherited and look at the disk again.
+    GLOBAL_POSTING_FILES.clear()
+    GLOBAL_POSTING_MMAPS.clear()
+    GLOBAL_POSTING_BLOOMS.clear()
+    GLOBAL_HITS_CACHE.clear()
+    GLOBAL_HITS_CACHE_STATS['bytes'] = 0
+    GLOBAL_HITS_CACHE_STATS['generation'] += 1
+    try:
+        filecount = PostingList._OptimizeDir(session, c, dead, force,
+                                             blooms=False)
+    finally:
+        flush_append_cache()
+    return filecount
+
+
+# If 'python postinglist.py' is executed, start the doctest unittest
+if __name__ == "__main__":
+    import doctest
+    import sys
+    if doctest.testmod().failed:
+        sys.exit(1)
@@ -0,0 +1,180 @@
+# Numeric range indexes, for searching and sorting by date or size.
+#
+# The values of all messages are kept sorted in two parallel arrays (the
+# values and the message IDs), so the messages in a range are found with
+# two binary searches and one slice, and walking the arrays gives the sort
+# order. Messages added or changed since the arrays were sorted sit in a
+# small unsorted tail, which is folded back in once it grows too big, so
+# new mail costs O(1) until then instead of a full re-sort. A column has
+# the value of each message by ID, for use as a sort key.
+#
+# Copies for index snapshots share the sorted arrays, which are replaced
+# and never changed, and the tail until either side changes it.
+#
+import array
+import bisect
+
+from mailpile.bitmap import Bitmap
+from mailpile.column import Column
+
+
+# The tail is merged when it grows past this, or past 1/16th of the index
+TAIL_MAX = 4096
+
+
+class RangeIndex(object):
+    """
+    An index of messages by a numeric value (a timestamp or a size).
+
+    >>> ri = RangeIndex([(30, 0), (10, 1), (20, 2), (20, 3)])
+    >>> ri.range(10, 20), ri.range(20, None), ri.count(None, 15)
+    (Bitmap([1, 2, 3]), Bitmap([0, 2, 3]), 1)
+    >>> ri.set(4, 15), ri.set(0, 5), ri.range(None, 19)
+    (False, False, Bitmap([0, 1, 4]))
+    >>> list(ri.ordered()), list(ri.ordered(reverse=True))[:2], ri.keys[4]
+    ([0, 1, 4, 2, 3], [3, 2], 15)
+    >>> snap = ri.copy(); ri.set(1, 40) or ri.merge()
+    >>> ri.range(None, 19), snap.range(None, 19), ri.keys[1], snap.keys[1]
+    (Bitmap([0, 4]), Bitmap([0, 1, 4]), 40, 10)
+    >>> ri.merge(); ri.range(None, 19), ri.range(None, 1), len(ri)
+    (Bitmap([0, 4]), Bitmap([]), 5)
+    >>> import cPickle
+    >>> ri = cPickle.loads(cPickle.dumps(ri, 2)); ri.set(2, 1)
+    False
+    >>> list(ri.ordered()), ri.keys[1]
+    ([2, 0, 4, 3, 1], 40)
+    """
+    def __init__(self, pairs=()):
+        pairs = sorted(pairs)
+        self._sorted = (array.array('l', [v for v, i in pairs]),
+                        array.array('l', [i for v, i in pairs]))
+        self._tail = {}
+        self._tail_shared = False
+        self.keys = Column([0] * (max([i for v, i in pairs] or [-1]) + 1),
+                           typecode='l')
+        for v, i in pairs:
+            self.keys[i] = v
+
+    def __getstate__(self):
+        # Arrays pickle as lists of numbers, their buffers much faster
+        values, ids = self._sorted
+        return {'values': values.tostring(),
+                'ids': ids.tostring(),
+                '_tail': dict(self._tail),
+                'keys': self.keys}
+
+    def __setstate__(self, state):
+        if '_sorted' in state:
+            # Saved by older versions, which pickled the arrays
+            self._sorted = state['_sorted']
+        else:
+            self._sorted = (array.array('l'), array.array('l'))
+            self._sorted[0].fromstring(state['values'])
+            self._sorted[1].fromstring(state['ids'])
+        self._tail = state['_tail']
+        self._tail_shared = False
+        self.keys = state['keys']
+        if not isinstance(self.keys, Column):
+            self.keys = Column(self.keys, typecode='l')
+
+    def copy(self):
+        """A copy which later changes to either index do not affect."""
+        ri = RangeIndex()
+        ri._sorted = self._sorted
+        ri._tail = self._tail
+        ri.keys = self.keys.copy()
+        ri._tail_shared = self._tail_shared = True
+        return ri
+
+    def __len__(self):
+        values, ids = self._sorted
+        return len(values) + len(self._tail)
+
+    def set(self, msg_idx, value):
+        """
+        Record the value of a message, new or changed. Returns True if
+        this merged the tail into the sorted arrays.
+        """
+        if msg_idx >= len(self.keys):
+            self.keys.extend([0] * (msg_idx + 1 - len(self.keys)))
+        self.keys[msg_idx] = value
+        if self._tail_shared:
+            self._tail = dict(self._tail)
+            self._tail_shared = False
+        self._tail[msg_idx] = value
+        if len(self._tail) > max(TAIL_MAX, len(self._sorted[0]) // 16):
+            self.merge()
+            return True
+        return False
+
+    def merge(self):
+        tail = dict(self._tail)
+        values, ids = self._sorted
+        pairs = [(values[i], ids[i]) for i in range(0, len(ids))
+                 if ids[i] not in tail]
+        pairs.extend((v, i) for i, v in tail.iteritems())
+        pairs.sort()
+        # Readers look at the tail before the sorted arrays, so they can
+        # not miss anything while the two are swapped.
+        self._sorted = (array.array('l', [v for v, i in pairs]),
+                        array.array('l', [i for v, i in pairs]))
+        self._tail = {}
+        self._tail_shared = False
+
+    def _slice(self, low, high):
+        values, ids = self._sorted
+        start, end = 0, len(values)
+        if low is not None:
+            start = bisect.bisect_left(values, low)
+        if high is not None:
+            end = bisect.bisect_right(values, high)
+        return ids, start, end
+
+    def range(self, low, high):
+        """Find the messages with low <= value <= high (None: no limit)."""
+        tail = dict(self._tail)
+        ids, start, end = self._slice(low, high)
+        found = Bitmap(ids[start:end])
+        if tail:
+            found -= tail.keys()
+            found |= [i for i, v in tail.iteritems()
+                      if (low is None or v >= low) and
+                      (high is None or v <= high)]
+        return found
+
+    def ordered(self, reverse=False):
+        """Iterate through the message IDs, in order of their values."""
+        tail = dict(self._tail)
+        values, ids = self._sorted
+        extra = sorted((v, i) for i, v in tail.iteritems())
+        if reverse:
+            extra.reverse()
+            positions = xrange(len(ids) - 1, -1, -1)
+        else:
+            positions = xrange(0, len(ids))
+        pos = 0
+        for p in positions:
+            i = ids[p]
+            if i in tail:
+                continue
+            here = (values[p], i)
+            while pos < len(extra) and ((reverse and extra[pos] > here) or
+                                        (not reverse and extra[pos] < here)):
+                yield extra[pos][1]
+                pos += 1
+            yield i
+        for v, i in extra[pos:]:
+            yield i
+
+    def count(self, low, high):
+        """Estimate how many messages are in the range, quickly."""
+        ids, start, end = self._slice(low, high)
+        return max(0, end - start)
+
+
+# If 'python rangeindex.py' is executed, start the doctest unittest
+if __name__ == "__main__":
+    import doctest
+    import sys
+    if doctest.testmod().failed:
+        sys.exit(1)
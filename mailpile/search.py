@@ -1,7 +1,10 @@
+import collections
 import email
+import itertools
 import lxml.html
 import re
 import rfc822
+import sys
 import time
 import threading
 import traceback
@@ -10,11 +13,16 @@ from urllib import quote, unquote
 
 import mailpile.plugins as plugins
 import mailpile.util
+from mailpile.bitmap import Bitmap
+from mailpile.column import Column
 from mailpile.util import *
 from mailpile.mailutils import MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
 from mailpile.mailutils import Email, ParseMessage, HeaderPrint
-from mailpile.postinglist import GlobalPostingList
+from mailpile.postinglist import GlobalPostingList, TermDictionary
+from mailpile.postinglist import encode_record, parse_records
+from mailpile.postinglist import POSITION_BASE, POSITION_BITS
+from mailpile.rangeindex import RangeIndex
 from mailpile.ui import *
 
 
@@ -27,24 +35,53 @@ class SearchResultSet:
         self._index = idx
         self.set_results(results, exclude)
 
-    def set_results(self, results, exclude):
+    def set_results(self, results, exclude, deps=None, tag=None,
+                    hides=False, generation=None):
+        results = Bitmap(results)
         self._results = {
-            'raw': set(results),
-            'excluded': set(exclude) & set(results)
+            'raw': results,
+            'excluded': results & exclude,
+            'deps': set(_keyword(d) for d in (deps or [])),
+            'tag': tag,
+            'hides': hides,
+            'generation': generation
         }
         return self
 
     def __len__(self):
         return len(self._results.get('raw', []))
 
-    def as_set(self, order='raw'):
+    def as_bitmap(self, order='raw'):
         return self._results[order] - self._results['excluded']
 
+    def as_set(self, order='raw'):
+        return set(self.as_bitmap(order=order))
+
     def excluded(self):
         return self._results['excluded']
 
+    def get_facets(self):
+        return self._results.get('facets') or {}
+
+    def set_facets(self, facets):
+        self._results['facets'] = facets
+
+
+def _keyword(kw):
+    if isinstance(kw, str):
+        return kw.decode('utf-8', 'replace')
+    return kw
+
 
-SEARCH_RESULT_CACHE = {}
+# Cached search results, least recently used first. Each entry records
+# the keywords (including tag keywords) its results were computed from,
+# with '*' meaning all messages, so a change to the index only needs to
+# invalidate or patch the entries it can affect.
+SEARCH_RESULT_CACHE = collections.OrderedDict()
+SEARCH_RESULT_CACHE_KB = 4096
+SEARCH_RESULT_CACHE_STATS = {'hits': 0, 'misses': 0, 'bytes': 0,
+                             'dropped': 0, 'patched': 0}
+SEARCH_RESULT_CACHE_LOCK = threading.RLock()
 
 
 class CachedSearchResultSet(SearchResultSet):
@@ -52,27 +89,399 @@ class CachedSearchResultSet(SearchResultSet):
     Cached search result.
     """
     def __init__(self, idx, terms):
-        global SEARCH_RESULT_CACHE
         self.terms = set(terms)
         self._index = idx
-        self._results = SEARCH_RESULT_CACHE.get(self._skey(), {})
-        self._results['_last_used'] = time.time()
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            self._results = SEARCH_RESULT_CACHE.pop(self._skey(), None)
+            self.cached = (self._results is not None)
+            if self.cached:
+                SEARCH_RESULT_CACHE[self._skey()] = self._results
+                SEARCH_RESULT_CACHE_STATS['hits'] += 1
+            else:
+                SEARCH_RESULT_CACHE_STATS['misses'] += 1
+                self._results = {}
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
 
     def _skey(self):
         return ' '.join(self.terms)
 
-    def set_results(self, *args):
-        global SEARCH_RESULT_CACHE
-        SearchResultSet.set_results(self, *args)
-        SEARCH_RESULT_CACHE[self._skey()] = self._results
-        self._results['_last_used'] = time.time()
+    def set_results(self, *args, **kwargs):
+        SearchResultSet.set_results(self, *args, **kwargs)
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            # Results from an older generation may already be stale, as
+            # the changes since were published before they got here.
+            generation = self._results['generation']
+            if generation not in (None, self._index.SNAPSHOT.generation):
+                return self
+            self._Drop(self._skey(), count=False)
+            SEARCH_RESULT_CACHE[self._skey()] = self._results
+            self._Resize(self._results)
+            max_bytes = 1024 * SEARCH_RESULT_CACHE_KB
+            while SEARCH_RESULT_CACHE_STATS['bytes'] > max_bytes:
+                self._Drop(SEARCH_RESULT_CACHE.keys()[0])
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
         return self
 
+    def set_facets(self, facets):
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            SearchResultSet.set_facets(self, facets)
+            if SEARCH_RESULT_CACHE.get(self._skey()) is self._results:
+                self._Resize(self._results)
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
     @classmethod
-    def DropCaches(cls, msg_idxs=None, tags=None):
-        # FIXME: Make this more granular
-        global SEARCH_RESULT_CACHE
-        SEARCH_RESULT_CACHE = {}
+    def _Resize(cls, results):
+        facets = results.get('facets') or {}
+        size = (128 + results['raw'].nbytes() + results['excluded'].nbytes()
+                + sum(64 + len(d) for d in results['deps'])
+                + sum(64 * len(counts) for counts in facets.values()))
+        SEARCH_RESULT_CACHE_STATS['bytes'] += size - results.get('size', 0)
+        results['size'] = size
+
+    @classmethod
+    def _Unfacet(cls, results):
+        # Facet counts include tags, so any tag change makes them stale
+        if results.pop('facets', None) is not None:
+            cls._Resize(results)
+
+    @classmethod
+    def _Drop(cls, key, count=True):
+        results = SEARCH_RESULT_CACHE.pop(key, None)
+        if results is not None:
+            SEARCH_RESULT_CACHE_STATS['bytes'] -= results.get('size', 0)
+            if count:
+                SEARCH_RESULT_CACHE_STATS['dropped'] += 1
+
+    @classmethod
+    def DropCaches(cls, msg_idxs=None, tags=None, keywords=None):
+        """
+        Drop cached results which changes to the index may affect. With
+        no arguments everything goes, otherwise only entries depending on
+        the given keywords or tags, or on all messages, or containing one
+        of the given messages.
+        """
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            if msg_idxs is None and tags is None and keywords is None:
+                drop = SEARCH_RESULT_CACHE.keys()
+            else:
+                kws = set(_keyword(k) for k in (keywords or []))
+                kws |= set(u'%s:in' % t for t in (tags or []))
+                if msg_idxs or keywords:
+                    kws.add(u'*')
+                msgs = Bitmap(msg_idxs or [])
+                drop = [k for k, r in SEARCH_RESULT_CACHE.iteritems()
+                        if (r['deps'] & kws) or (msgs and (r['raw'] & msgs))]
+            for key in drop:
+                cls._Drop(key)
+            if tags:
+                for results in SEARCH_RESULT_CACHE.itervalues():
+                    cls._Unfacet(results)
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
+    @classmethod
+    def UpdateTag(cls, tag_id, msg_idxs, added, hidden, hides=False):
+        """
+        Update cached results after a tag was added to (or removed from)
+        some messages. Results for just that tag are patched in place, as
+        are the suppressed messages of all results if the tag hides
+        messages (hidden is the up to date mask). Any others which depend
+        on the tag are dropped.
+        """
+        kw = u'%s:in' % tag_id
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            for key, r in SEARCH_RESULT_CACHE.items():
+                cls._Unfacet(r)
+                if kw not in r['deps']:
+                    continue
+                if r['tag'] == tag_id:
+                    if added:
+                        r['raw'] = r['raw'] | msg_idxs
+                    else:
+                        r['raw'] = r['raw'] - msg_idxs
+                elif not (hides and r['hides']):
+                    cls._Drop(key)
+                    continue
+                r['excluded'] = r['hides'] and (r['raw'] & hidden) or Bitmap()
+                cls._Resize(r)
+                SEARCH_RESULT_CACHE_STATS['patched'] += 1
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
+    @classmethod
+    def BuryMessages(cls, msg_idxs):
+        """Remove deleted messages from all cached results."""
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            for r in SEARCH_RESULT_CACHE.itervalues():
+                if [i for i in msg_idxs if i in r['raw']]:
+                    r['raw'] = r['raw'] - msg_idxs
+                    r['excluded'] = r['excluded'] - msg_idxs
+                    r.pop('facets', None)
+                    cls._Resize(r)
+                    SEARCH_RESULT_CACHE_STATS['patched'] += 1
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
+    @classmethod
+    def CacheStats(cls):
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            stats = dict(SEARCH_RESULT_CACHE_STATS)
+            stats['entries'] = len(SEARCH_RESULT_CACHE)
+            stats['max_bytes'] = 1024 * SEARCH_RESULT_CACHE_KB
+            return stats
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
+
+def _filled(method):
+    def filled(self, *args, **kwargs):
+        self._fill()
+        return method(self, *args, **kwargs)
+    return filled
+
+
+class LazySortedResults(list):
+    """
+    A sorted list of search results, produced on demand by an iterator
+    which yields them in order. Only as many results as somebody looks at
+    get sorted; the length is counted separately, without sorting.
+
+    >>> r = LazySortedResults(iter([5, 3, 1, 2]), lambda: 4)
+    >>> r[:2], len(r), list.__len__(r)
+    ([5, 3], 4, 2)
+    >>> 2 in r, list.__len__(r), r
+    (True, 4, [5, 3, 1, 2])
+    """
+    def __init__(self, ordered, counter):
+        list.__init__(self)
+        self._ordered = ordered
+        self._counter = counter
+        self._count = None
+
+    def _fill(self, want=None):
+        if self._ordered is None:
+            return
+        have = list.__len__(self)
+        if want is None:
+            list.extend(self, self._ordered)
+            self._ordered = None
+        elif want > have:
+            list.extend(self, itertools.islice(self._ordered, want - have))
+            if list.__len__(self) < want:
+                self._ordered = None
+
+    def __len__(self):
+        if self._ordered is None:
+            return list.__len__(self)
+        if self._count is None:
+            self._count = self._counter()
+        return self._count
+
+    def __nonzero__(self):
+        self._fill(1)
+        return list.__len__(self) > 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if (i.stop is None or i.stop < 0 or
+                    (i.start is not None and i.start < 0)):
+                self._fill()
+            else:
+                self._fill(i.stop)
+        else:
+            self._fill((i >= 0) and (i + 1) or None)
+        return list.__getitem__(self, i)
+
+    def __getslice__(self, i, j):
+        self._fill((j < sys.maxint) and j or None)
+        return list.__getslice__(self, i, j)
+
+    __iter__ = _filled(list.__iter__)
+    __reversed__ = _filled(list.__reversed__)
+    __contains__ = _filled(list.__contains__)
+    __setitem__ = _filled(list.__setitem__)
+    __delitem__ = _filled(list.__delitem__)
+    __setslice__ = _filled(list.__setslice__)
+    __delslice__ = _filled(list.__delslice__)
+    sort = _filled(list.sort)
+    reverse = _filled(list.reverse)
+    __repr__ = _filled(list.__repr__)
+    __eq__ = _filled(list.__eq__)
+    append = _filled(list.append)
+    extend = _filled(list.extend)
+    insert = _filled(list.insert)
+    pop = _filled(list.pop)
+    remove = _filled(list.remove)
+    index = _filled(list.index)
+    count = _filled(list.count)
+
+
+class CompiledFilters(object):
+    """
+    The configured filters, compiled for matching the keywords of one
+    message at a time as it is indexed.
+
+    Each filter's terms are parsed once, the way search() would, into
+    runs of terms: a run starts with a term which is OR-ed with what the
+    filter matched so far and is followed by terms which must (AND) or
+    must not (NOT) match. Plain keywords are looked up in an inverted
+    table (keyword -> terms), so all of a message's keywords are matched
+    against all the filters in one pass. Tags are checked as the filters
+    run, as earlier filters may have added or removed them, and search
+    terms provided by plugins are evaluated by search() on demand.
+    """
+    KEYWORD, TAG, ALL, SEARCH = range(0, 4)
+
+    def __init__(self, idx, filters):
+        self.terms = []
+        self.keywords = {}
+        self.filters = []
+        term_ids = {}
+
+        def term_id(term):
+            if term not in term_ids:
+                term_ids[term] = len(self.terms)
+                self.terms.append(term)
+                if term[0] == self.KEYWORD:
+                    self.keywords.setdefault(term[1], set()).add(
+                        term_ids[term])
+            return term_ids[term]
+
+        for fid, terms, tags, comment in filters:
+            if terms == '*':
+                runs = None
+            else:
+                runs = []
+                for op, term in self._parse(idx, terms.split()):
+                    tid = term_id(self._compile(idx, term))
+                    if not runs:
+                        runs.append((None, [tid], []))
+                    elif op == '+':
+                        runs.append((tid, [], []))
+                    elif op == '-':
+                        runs[-1][2].append(tid)
+                    else:
+                        runs[-1][1].append(tid)
+            self.filters.append((runs, tags))
+
+    @classmethod
+    def _parse(cls, idx, searchterms):
+        # Rewrite the terms as search() does
+        if 'tags' in idx.config:
+            unread = idx.config.get_tags(type='unread')
+            for i, term in enumerate(searchterms):
+                op = term[:1] in ('+', '-') and term[0] or ''
+                if term[len(op):] == 'is:unread' and unread:
+                    searchterms[i] = op + 'in:%s' % unread[0].slug
+                elif term[len(op):].startswith('tag:'):
+                    searchterms[i] = op + 'in:' + term.split(':', 1)[1]
+        if searchterms and searchterms[0] and searchterms[0][0] == '-':
+            searchterms[:0] = ['all:mail']
+        for term in searchterms:
+            if term in STOPLIST:
+                continue
+            if term[0] in ('-', '+'):
+                yield term[0], term[1:].lower()
+            else:
+                yield None, term.lower()
+
+    @classmethod
+    def _compile(cls, idx, term):
+        if term.startswith('"'):
+            return (cls.SEARCH, term)
+        elif ':' in term:
+            if term.startswith('body:'):
+                return (cls.KEYWORD, term[5:])
+            elif term == 'all:mail':
+                return (cls.ALL, None)
+            elif term.startswith('in:'):
+                tag = term.split(':', 1)[1]
+                return (cls.TAG, '%s:in' % (idx.config.get_tag_id(tag)
+                                            or tag))
+            t = term.split(':', 1)
+            if plugins.get_search_term(t[0]):
+                return (cls.SEARCH, term)
+            return (cls.KEYWORD, '%s:%s' % (t[1], t[0]))
+        return (cls.KEYWORD, term)
+
+    def matches(self, idx, keywordmap):
+        """
+        Yield the tags of each filter which matches a message, given the
+        message's keyword map. The map is read again for each filter, so
+        the caller can apply the tags of one filter before the next runs.
+        """
+        present = set()
+        for kw in keywordmap:
+            if kw in self.keywords:
+                present |= self.keywords[kw]
+        searched = {}
+
+        def check(tid):
+            kind, value = self.terms[tid]
+            if kind == self.KEYWORD:
+                return tid in present
+            elif kind == self.TAG:
+                return value in keywordmap
+            elif kind == self.ALL:
+                return True
+            if tid not in searched:
+                searched[tid] = (len(idx.search(None, [value],
+                                                keywords=keywordmap)) > 0)
+            return searched[tid]
+
+        for runs, tags in self.filters:
+            if runs is None:
+                yield tags
+                continue
+            matched = False
+            for plus, ands, nots in runs:
+                matched = (plus is None) or matched or check(plus)
+                matched = (matched and
+                           not [t for t in ands if not check(t)] and
+                           not [t for t in nots if check(t)])
+            if matched:
+                yield tags
+
+
+class IndexSnapshot(object):
+    """
+    A consistent, read-only view of the index as of one generation.
+
+    The index has a single writer, which publishes a new generation each
+    time it has finished a batch of changes (a scan, a command, tagging,
+    sorting). Readers grab the current snapshot once and only look at the
+    messages it covers, through the sort orders, ranges, facets and
+    conversation list it captured, so they never wait for the writer and
+    never see half-indexed mail. Those are copy-on-write copies (see
+    Column and RangeIndex.copy), so a snapshot stays valid after newer
+    ones are published.
+
+    >>> snap = IndexSnapshot(generation=3, messages=2)
+    >>> snap.visible(set([0, 1, 2, 5]))
+    Bitmap([0, 1])
+    """
+    def __init__(self, generation=0, messages=0,
+                 sort_orders=None, threads=None, facets=None, ranges=None):
+        self.generation = generation
+        self.messages = messages
+        self.sort_orders = sort_orders or {}
+        self.threads = threads or []
+        self.facets = facets
+        self.ranges = ranges or {}
+
+    def visible(self, results):
+        """Drop the results this snapshot does not cover."""
+        return Bitmap.Range(0, self.messages) & results
 
 
 class MailIndex:
@@ -100,13 +509,43 @@ class MailIndex:
 
     MAX_INCREMENTAL_SAVES = 25
 
+    # While scanning, new mail is published to searches in batches this big
+    PUBLISH_BATCH = 100
+
+    # Word positions are stored as postings of their own (see postinglist),
+    # the tab in the keyword makes sure no search term can collide with them.
+    POSITION_BITS = POSITION_BITS
+    POSITION_BASE = POSITION_BASE
+    POSITION_KEYWORD = '%s\tpos'
+
+    # Facets other than tags are counted from columns: lists giving the
+    # values of each message, so counting them for a set of results does
+    # not need to parse any metadata. They are built when first needed.
+    FACET_COLUMNS = ('year', 'from', 'mailbox')
+
+    # Numeric values messages can be searched by range for, see
+    # search_range(). Sizes are only known in KB.
+    RANGE_COLUMNS = (
+        ('date', lambda s, msg_info: long(msg_info[s.MSG_DATE], 36)),
+        ('size', lambda s, msg_info: int(msg_info[s.MSG_KB], 36)),
+    )
+    RANGE_KEYWORD = '__%s:%d'
+
+    # The conversation list, sort orders and range columns are saved here
+    # along with the index, so they need not be rebuilt on startup.
+    SORT_ORDERS_PICKLE = 'pickled-sort-orders'
+
     def __init__(self, config):
         self.config = config
         self.INDEX = []
         self.INDEX_SORT = {}
-        self.INDEX_THR = []
+        self.INDEX_THR = Column(typecode='l')
+        self.INDEX_FACETS = None
+        self.INDEX_RANGES = {}
+        self.HIDDEN = None
         self.PTRS = {}
         self.TAGS = {}
+        self.TOMBSTONES = Bitmap()
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
@@ -115,6 +554,16 @@ class MailIndex:
         self.EMAILS_SAVED = 0
         self._saved_changes = 0
         self._lock = threading.Lock()
+        self._unpublished = set()
+        self._unpublished_msgs = set()
+        self._unpublished_tags = set()
+        self._filters = None
+        self._hiding = frozenset()
+        self._lines = 0
+        self._sort_dirty = False
+        self._sort_saves = self._sort_saved = 0
+        self._sort_save_lock = threading.Lock()
+        self.SNAPSHOT = IndexSnapshot()
 
     def l2m(self, line):
         return line.decode('utf-8').split(u'\t')
@@ -143,9 +592,24 @@ class MailIndex:
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self.TOMBSTONES = Bitmap()
+        self.INDEX_SORT = {}
+        self.INDEX_THR = Column(typecode='l')
+        self.INDEX_FACETS = None
+        self.INDEX_RANGES = {}
+        self.HIDDEN = None
+        self.SNAPSHOT = IndexSnapshot(self.SNAPSHOT.generation + 1)
         CachedSearchResultSet.DropCaches()
 
+        # Messages on lines written after the sort orders were saved have
+        # changed since, and need to be sorted again.
+        saved = self._load_sort_orders()
+        lines = [0]
+        changed = set()
+        tag_fields = {}
+
         def process_line(line):
+            lines[0] += 1
             try:
                 line = line.strip()
                 if line.startswith('#'):
@@ -182,8 +646,10 @@ class MailIndex:
                         self.INDEX.append('')
 
                     self.INDEX[pos] = line
+                    if saved and lines[0] > saved['lines']:
+                        changed.add(pos)
                     self.MSGIDS[words[self.MSG_ID]] = pos
-                    self.update_msg_tags(pos, words)
+                    tag_fields[pos] = words[self.MSG_TAGS]
                     for msg_ptr in words[self.MSG_PTRS].split(','):
                         self.PTRS[msg_ptr] = pos
 
@@ -209,26 +675,188 @@ class MailIndex:
         finally:
             self._lock.release()
 
+        # Building each tag's bitmap in one go is much faster than adding
+        # the messages to it one at a time.
+        members = {}
+        for pos, field in tag_fields.iteritems():
+            for tid in field.split(','):
+                if tid:
+                    members.setdefault(tid, []).append(pos)
+        self.TAGS = dict((tid, Bitmap(sorted(msg_idxs)))
+                         for tid, msg_idxs in members.iteritems())
+
+        self.load_tombstones(session)
+        self._lines = lines[0]
+        if (saved and saved['lines'] <= lines[0] and
+                saved['messages'] <= len(self.INDEX)):
+            self.INDEX_THR = saved['threads']
+            if not isinstance(self.INDEX_THR, Column):
+                # Saved by older versions, as an array
+                self.INDEX_THR = Column(self.INDEX_THR, typecode='l')
+            self.INDEX_SORT = saved['sort_orders']
+            self.INDEX_RANGES = saved['ranges']
+            changed |= set(range(saved['messages'], len(self.INDEX)))
+            for msg_idx in sorted(changed):
+                if self.INDEX[msg_idx]:
+                    self._sort_message(msg_idx,
+                                       self.get_msg_at_idx_pos(msg_idx))
+            while len(self.INDEX_THR) < len(self.INDEX):
+                self.INDEX_THR.append(len(self.INDEX_THR))
+            self.publish()
+            if session:
+                session.ui.mark(_('Loaded sort orders, %d messages changed'
+                                  ) % len(changed))
         self.cache_sort_orders(session)
         if session:
             session.ui.mark(_('Loaded metadata, %d messages'
                               ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
 
+    def load_tombstones(self, session=None):
+        def bury(sig, msg_idxs):
+            self.TOMBSTONES.update(msg_idxs)
+        try:
+            fd = open(self.config.tombstones_file(), 'rb')
+            try:
+                parse_records(fd.read(), bury)
+            finally:
+                fd.close()
+        except IOError:
+            pass
+        # Gaps in the index (lost to a crash, for example) are dead too
+        self.TOMBSTONES.update(pos for pos in range(0, len(self.INDEX))
+                               if not self.INDEX[pos])
+        for tid in self.TAGS:
+            self.TAGS[tid] -= self.TOMBSTONES
+
+    def publish(self, msg_idxs=None, tags=None):
+        """
+        Make the changes since the last generation visible to searches,
+        dropping any cached results they may affect.
+
+        Changes to messages are only recorded as they are made, so this
+        should be called once a batch of them is done.
+        """
+        SEARCH_RESULT_CACHE_LOCK.acquire()
+        try:
+            keywords, self._unpublished = self._unpublished, set()
+            msgs, self._unpublished_msgs = self._unpublished_msgs, set()
+            changed, self._unpublished_tags = self._unpublished_tags, set()
+            msgs.update(msg_idxs or [])
+            changed.update(tags or [])
+
+            sort_orders, ranges = self._copy_sort_orders()
+            facets = self.INDEX_FACETS
+            if facets is not None:
+                facets = dict((name, column.copy())
+                              for name, column in facets.iteritems())
+            self.SNAPSHOT = IndexSnapshot(self.SNAPSHOT.generation + 1,
+                                          len(self.INDEX),
+                                          sort_orders,
+                                          self.INDEX_THR.copy(),
+                                          facets,
+                                          ranges)
+            if msgs or changed or keywords:
+                CachedSearchResultSet.DropCaches(msg_idxs=msgs,
+                                                 tags=changed,
+                                                 keywords=keywords)
+        finally:
+            SEARCH_RESULT_CACHE_LOCK.release()
+
+    def publish_changes(self):
+        """Publish a new generation, if anything changed since the last."""
+        if (self._unpublished or self._unpublished_msgs or
+                self._unpublished_tags):
+            self.publish()
+
+    def bury_messages(self, session, msg_idxs):
+        """
+        Mark messages as dead: they are dropped from all search results
+        right away, and purged from the posting lists by compaction.
+        """
+        msg_idxs = Bitmap(msg_idxs) - self.TOMBSTONES
+        if not msg_idxs:
+            return
+        try:
+            self._lock.acquire()
+            fd = open(self.config.tombstones_file(), 'ab')
+            try:
+                fd.write(encode_record('dead', msg_idxs))
+            finally:
+                fd.close()
+            self.TOMBSTONES |= msg_idxs
+            for tid in self.TAGS:
+                self.TAGS[tid] -= msg_idxs
+            if self.HIDDEN is not None:
+                self.HIDDEN -= msg_idxs
+        finally:
+            self._lock.release()
+        self.publish()
+        CachedSearchResultSet.BuryMessages(msg_idxs)
+        if session:
+            session.ui.mark(_('Buried %d messages') % len(msg_idxs))
+
     def update_msg_tags(self, msg_idx_pos, msg_info):
         tags = set([t for t in msg_info[self.MSG_TAGS].split(',') if t])
+        changed = []
         for tid in (set(self.TAGS.keys()) - tags):
-            self.TAGS[tid] -= set([msg_idx_pos])
+            if msg_idx_pos in self.TAGS[tid]:
+                self.TAGS[tid].discard(msg_idx_pos)
+                changed.append(tid)
         for tid in tags:
             if tid not in self.TAGS:
-                self.TAGS[tid] = set()
-            self.TAGS[tid].add(msg_idx_pos)
+                self.TAGS[tid] = Bitmap()
+            if msg_idx_pos not in self.TAGS[tid]:
+                self.TAGS[tid].add(msg_idx_pos)
+                changed.append(tid)
+        if self.HIDDEN is not None and self._hiding.intersection(changed):
+            if self._hiding & tags:
+                self.HIDDEN.add(msg_idx_pos)
+            else:
+                self.HIDDEN.discard(msg_idx_pos)
+        return changed
+
+    def hidden_messages(self, invisible=None):
+        """
+        The messages with tags which hide them from search results.
+
+        The mask is built once, kept up to date as messages are tagged and
+        untagged and rebuilt if the set of hiding tags changes, so hiding
+        messages costs one set difference per search.
+        """
+        if invisible is None:
+            invisible = self.config.get_tags(flag_hides=True)
+        hiding = frozenset(t._key for t in invisible)
+        hidden = self.HIDDEN
+        if hidden is None or hiding != self._hiding:
+            hidden = Bitmap()
+            for tid in hiding:
+                hidden |= self.TAGS.get(tid, ())
+            if self.HIDDEN is not None:
+                # Whatever was suppressed from cached results is now wrong
+                CachedSearchResultSet.DropCaches()
+            self._hiding, self.HIDDEN = hiding, hidden
+        return hidden
+
+    def _hide(self, tag_id, msg_idxs, added):
+        if self.HIDDEN is None or tag_id not in self._hiding:
+            return False
+        if added:
+            self.HIDDEN |= msg_idxs
+        else:
+            self.HIDDEN -= msg_idxs
+            for tid in self._hiding - set([tag_id]):
+                self.HIDDEN |= self.TAGS.get(tid, Bitmap()) & msg_idxs
+        return True
 
     def save_changes(self, session=None):
+        self.publish_changes()
+        GlobalPostingList.Flush()
         mods, self.MODIFIED = self.MODIFIED, set()
         if mods or len(self.EMAILS) > self.EMAILS_SAVED:
             if self._saved_changes >= self.MAX_INCREMENTAL_SAVES:
                 return self.save(session=session)
+            sort_orders = None
             try:
                 self._lock.acquire()
                 if session:
@@ -242,14 +870,20 @@ class MailIndex:
                     fd.write(self.INDEX[pos] + '\n')
                 fd.close()
                 flush_append_cache()
+                self._lines += len(self.EMAILS) - self.EMAILS_SAVED + len(mods)
+                if self._sort_dirty:
+                    sort_orders = self._sort_orders_state()
                 if session:
                     session.ui.mark(_("Saved metadata index changes"))
                 self.EMAILS_SAVED = len(self.EMAILS)
                 self._saved_changes += 1
             finally:
                 self._lock.release()
+            if sort_orders:
+                self._save_sort_orders(sort_orders)
 
     def save(self, session=None):
+        GlobalPostingList.Flush()
         try:
             self._lock.acquire()
             self.MODIFIED = set()
@@ -269,16 +903,23 @@ class MailIndex:
                 fd.write(item + '\n')
             fd.close()
 
+            # The saved sort orders count lines of the old file, so they
+            # must not outlive it if we crash before saving new ones.
+            self._drop_sort_orders()
+
             # Keep the last 5 index files around... just in case.
             backup_file(idxfile, backups=5, min_age_delta=10)
             os.rename(newfile, idxfile)
 
             flush_append_cache()
+            self._lines = 2 + len(self.EMAILS) + len(self.INDEX)
+            sort_orders = self._sort_orders_state()
             self._saved_changes = 0
             if session:
                 session.ui.mark(_("Saved metadata index"))
         finally:
             self._lock.release()
+        self._save_sort_orders(sort_orders)
 
     def update_ptrs_and_msgids(self, session):
         session.ui.mark(_('Updating high level indexes'))
@@ -489,10 +1130,14 @@ class MailIndex:
                 mbox.mark_parsed(i)
 
                 added += 1
+                if not added % self.PUBLISH_BATCH:
+                    self.publish_changes()
                 GlobalPostingList.Optimize(session, self,
                                            lazy=True, quick=True)
 
+        self.publish_changes()
         if added:
+            GlobalPostingList.Flush()
             mbox.save(session)
         session.ui.mark(_('%s: Indexed mailbox: %s'
                           ) % (mailbox_idx, mailbox_fn))
@@ -567,6 +1212,7 @@ class MailIndex:
         print 'Applying %s' % tags
         for tag_id in tags:
             self.add_tag(session, tag_id, msg_idxs=[email.msg_idx_pos])
+        self.publish_changes()
 
     def set_conversation_ids(self, msg_mid, msg, subject_threading=True):
         msg_thr_mid = None
@@ -664,6 +1310,7 @@ class MailIndex:
 
         msg_info[self.MSG_THREAD_MID] = msg_mid
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+        self.publish_changes()
 
     def _add_email(self, email, name=None, eid=None):
         if eid is None:
@@ -718,23 +1365,31 @@ class MailIndex:
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
         return msg_idx_pos, msg_info
 
+    def _compiled_filters(self, session):
+        # Filters are only compiled again when they (or tags) change
+        config = session.config
+        tags = ('tags' in config) and config.tags or {}
+        key = (config.get_filters(),
+               [(tid, tags[tid].slug, tags[tid].name) for tid in tags])
+        if self._filters is None or self._filters[0] != key:
+            self._filters = (key, CompiledFilters(self, key[0]))
+        return self._filters[1]
+
     def filter_keywords(self, session, msg_mid, msg, keywords):
         keywordmap = {}
         msg_idx_list = [msg_mid]
         for kw in keywords:
             keywordmap[kw] = msg_idx_list
 
-        for fid, terms, tags, comment in session.config.get_filters():
-            if (terms == '*' or
-                    len(self.search(None, terms.split(),
-                                    keywords=keywordmap)) > 0):
-                for t in tags.split():
-                    kw = '%s:in' % t[1:]
-                    if t[0] == '-':
-                        if kw in keywordmap:
-                            del keywordmap[kw]
-                    else:
-                        keywordmap[kw] = msg_idx_list
+        filters = self._compiled_filters(session)
+        for tags in filters.matches(self, keywordmap):
+            for t in tags.split():
+                kw = '%s:in' % t[1:]
+                if t[0] == '-':
+                    if kw in keywordmap:
+                        del keywordmap[kw]
+                else:
+                    keywordmap[kw] = msg_idx_list
 
         return set(keywordmap.keys())
 
@@ -753,10 +1408,25 @@ class MailIndex:
                     self.add_tag(session, tag_id, msg_idxs=set(msg_idxs))
 
     def read_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
-                     mailbox=None):
+                     mailbox=None, positions=None):
         keywords = []
         snippet = ''
         payload = [None]
+        position = [0]
+
+        def _words(text):
+            words = re.findall(WORD_REGEXP, text.lower())
+            if positions is not None:
+                # Stop-words are not recorded, but still take up a
+                # position; the gap after each text stops phrases from
+                # matching across parts.
+                for word in words:
+                    if word not in STOPLIST:
+                        positions.setdefault(word, []).append(position[0])
+                    position[0] += 1
+                position[0] += 1
+            return words
+
         for part in msg.walk():
             textpart = payload[0] = None
             ctype = part.get_content_type()
@@ -795,7 +1465,7 @@ class MailIndex:
 
             if textpart:
                 # FIXME: Does this lowercase non-ASCII characters correctly?
-                keywords.extend(re.findall(WORD_REGEXP, textpart.lower()))
+                keywords.extend(_words(textpart))
 
                 # NOTE: As a side effect here, the cryptostate plugin will
                 #       add a 'crypto:has' keyword which we check for below
@@ -825,13 +1495,12 @@ class MailIndex:
             # Index the contents, if configured to do so
             if session.config.prefs.index_encrypted:
                 for text in [t['data'] for t in tree['text_parts']]:
-                    keywords.extend(re.findall(WORD_REGEXP, text.lower()))
+                    keywords.extend(_words(text))
                     for kwe in plugins.get_text_kw_extractors():
                         keywords.extend(kwe(self, msg, 'text/plain', text))
 
         keywords.append('%s:id' % msg_id)
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'subject').lower()))
+        keywords.extend(_words(self.hdr(msg, 'subject')))
         keywords.extend(re.findall(WORD_REGEXP,
                                    self.hdr(msg, 'from').lower()))
         if mailbox:
@@ -863,23 +1532,33 @@ class MailIndex:
 
     def index_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts,
                       mailbox=None, compact=True, filter_hooks=[]):
+        positions = None
+        if session.config.prefs.index_positions:
+            positions = {}
         keywords, snippet = self.read_message(session,
                                               msg_mid, msg_id, msg,
                                               msg_size, msg_ts,
-                                              mailbox=mailbox)
-
-        for hook in filter_hooks:
-            keywords = hook(session, msg_mid, msg, keywords)
-
-        for word in keywords:
-            if word.startswith('__'):
-                continue
-            try:
-                GlobalPostingList.Append(session, word, [msg_mid],
-                                         compact=compact)
-            except UnicodeDecodeError:
-                # FIXME: we just ignore garbage
-                pass
+                                              mailbox=mailbox,
+                                              positions=positions)
+
+        if filter_hooks:
+            # Not indexed, but lets filters check dates and sizes
+            keywords.add(self.RANGE_KEYWORD % ('date', msg_ts))
+            keywords.add(self.RANGE_KEYWORD % ('size', msg_size // 1024))
+            for hook in filter_hooks:
+                keywords = hook(session, msg_mid, msg, keywords)
+            keywords = set(w for w in keywords if not w.startswith('__'))
+
+        msg_idx = int(msg_mid, 36)
+        postings = [(w, [msg_idx]) for w in keywords]
+        if positions:
+            base = self.POSITION_BASE | (msg_idx << self.POSITION_BITS)
+            limit = 1 << self.POSITION_BITS
+            for word, offsets in positions.iteritems():
+                postings.append((self.POSITION_KEYWORD % word,
+                                 [base | o for o in offsets if o < limit]))
+        GlobalPostingList.AppendPostings(session, postings, compact=compact)
+        self._unpublished |= set(keywords)
 
         return keywords, snippet
 
@@ -897,26 +1576,30 @@ class MailIndex:
     def set_msg_at_idx_pos(self, msg_idx, msg_info):
         if msg_idx < len(self.INDEX):
             self.INDEX[msg_idx] = self.m2l(msg_info)
-            self.INDEX_THR[msg_idx] = int(msg_info[self.MSG_THREAD_MID], 36)
         elif msg_idx == len(self.INDEX):
             self.INDEX.append(self.m2l(msg_info))
-            self.INDEX_THR.append(int(msg_info[self.MSG_THREAD_MID], 36))
         else:
             raise IndexError(_('%s is outside the index') % msg_idx)
+        self._sort_message(msg_idx, msg_info)
+
+        if self.INDEX_FACETS is not None:
+            values = self._facet_values(msg_info, {})
+            for name, column in self.INDEX_FACETS.iteritems():
+                while len(column) <= msg_idx:
+                    column.append(())
+                column[msg_idx] = values[name]
 
-        CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx])
         self.MODIFIED.add(msg_idx)
         if msg_idx in self.CACHE:
             del(self.CACHE[msg_idx])
 
-        for order in self.INDEX_SORT:
-            while msg_idx >= len(self.INDEX_SORT[order]):
-                self.INDEX_SORT[order].append(msg_idx)
-
         self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
         for msg_ptr in msg_info[self.MSG_PTRS].split(','):
             self.PTRS[msg_ptr] = msg_idx
-        self.update_msg_tags(msg_idx, msg_info)
+        changed = self.update_msg_tags(msg_idx, msg_info)
+        # Searches see this once the caller publishes its batch
+        self._unpublished_msgs.add(msg_idx)
+        self._unpublished_tags.update(changed)
 
     def get_conversation(self, msg_info=None, msg_idx=None):
         if not msg_info:
@@ -947,7 +1630,6 @@ class MailIndex:
             msg_idxs = set(msg_idxs)
         if not msg_idxs:
             return
-        CachedSearchResultSet.DropCaches()
         session.ui.mark(_('Tagging %d messages (%s)'
                           ) % (len(msg_idxs), tag_id))
         for msg_idx in list(msg_idxs):
@@ -969,7 +1651,11 @@ class MailIndex:
         if tag_id in self.TAGS:
             self.TAGS[tag_id] |= eids
         elif eids:
-            self.TAGS[tag_id] = eids
+            self.TAGS[tag_id] = Bitmap(eids)
+        hides = self._hide(tag_id, eids, True)
+        self.publish()
+        CachedSearchResultSet.UpdateTag(tag_id, eids, True, self.HIDDEN,
+                                        hides=hides)
 
     def remove_tag(self, session, tag_id,
                    msg_info=None, msg_idxs=None, conversation=False):
@@ -979,7 +1665,6 @@ class MailIndex:
             msg_idxs = set(msg_idxs)
         if not msg_idxs:
             return
-        CachedSearchResultSet.DropCaches()
         session.ui.mark(_('Untagging conversations (%s)') % (tag_id, ))
         for msg_idx in list(msg_idxs):
             if conversation:
@@ -1002,34 +1687,153 @@ class MailIndex:
                 eids.add(msg_idx)
         if tag_id in self.TAGS:
             self.TAGS[tag_id] -= eids
+        hides = self._hide(tag_id, eids, False)
+        self.publish()
+        CachedSearchResultSet.UpdateTag(tag_id, eids, False, self.HIDDEN,
+                                        hides=hides)
 
     def search_tag(self, term, hits):
         t = term.split(':', 1)
         t[1] = self.config.get_tag_id(t[1]) or t[1]
         return hits('%s:in' % t[1])
 
+    def search_wildcard(self, session, pattern, hits):
+        """
+        Find messages matching a wildcard pattern (like invoic* or
+        *@example.com:from), by expanding it through the term dictionary
+        into an OR of the most common matching terms.
+        """
+        terms, truncated = TermDictionary.Expand(session, pattern)
+        if terms is None:
+            return hits(pattern)
+        if truncated:
+            session.ui.warning(_('Only searching for the %d most common '
+                                 'matches of %s') % (len(terms), pattern))
+        results = Bitmap()
+        for term in terms:
+            results |= hits(term)
+        return results
+
+    def search_phrase(self, session, phrase, hits, positions=None):
+        """
+        Find messages containing an exact phrase. Candidates are messages
+        which contain all the words, and if word positions are indexed
+        they are verified by intersecting those, never by reading mail.
+        """
+        words = [(offset, word) for offset, word
+                 in enumerate(re.findall(WORD_REGEXP, phrase.lower()))
+                 if word not in STOPLIST]
+        if not words:
+            return Bitmap()
+        results = Bitmap(hits(words[0][1]))
+        for offset, word in words[1:]:
+            results &= hits(word)
+        if positions is None or len(words) < 2 or not results:
+            return results
+
+        # Only the positions within candidate messages are read. Walk the
+        # occurrences of the rarest word, checking whether the other words
+        # are found at the right offsets from it.
+        candidates = set(results - self.TOMBSTONES)
+        wpos = [(offset, positions(word, candidates))
+                for offset, word in words]
+        anchor, apos = min(wpos, key=lambda wp: len(wp[1]))
+        found = Bitmap()
+        for pos in apos:
+            msg_idx = (pos - self.POSITION_BASE) >> self.POSITION_BITS
+            start = pos - anchor
+            if (msg_idx in found or msg_idx not in results or
+                    ((start - self.POSITION_BASE) >> self.POSITION_BITS
+                     ) != msg_idx):
+                continue
+            for offset, opos in wpos:
+                if (start + offset) not in opos:
+                    break
+            else:
+                found.add(msg_idx)
+        return found
+
+    def _column_values(self, msg_info, columns=None):
+        values = []
+        for name, getter in (columns or self.RANGE_COLUMNS):
+            try:
+                values.append((name, getter(self, msg_info)))
+            except (ValueError, TypeError, IndexError):
+                pass
+        return values
+
+    def search_range(self, name, low, high):
+        """
+        Find the messages whose date (a timestamp) or size (in KB) is
+        from low to high, inclusive; None means no limit.
+        """
+        ranges = self.SNAPSHOT.ranges
+        if name not in ranges:
+            return Bitmap()
+        return ranges[name].range(low, high)
+
+    def count_range(self, name, low, high):
+        ranges = self.SNAPSHOT.ranges
+        if name not in ranges:
+            return 0
+        return ranges[name].count(low, high)
+
     def search(self, session, searchterms, keywords=None, order=None):
         # Stash the raw search terms, decide if this is cached or not
+        snapshot = self.SNAPSHOT
         raw_terms = searchterms[:]
         if keywords is None:
             srs = CachedSearchResultSet(self, raw_terms)
-            if len(srs) > 0:
+            if srs.cached:
                 return srs
         else:
             srs = SearchResultSet(self, raw_terms, [], [])
 
-        # Choose how we are going to search
+        # Choose how we are going to search, keeping track of which
+        # keywords the results depend on ('*' for all messages).
+        positions = None
+        deps = set()
         if keywords is not None:
             def hits(term):
                 return [int(h, 36) for h in keywords.get(term, [])]
+
+            def ranges(name, low, high):
+                prefix = '__%s:' % name
+                found = set()
+                for kw in keywords:
+                    if kw.startswith(prefix):
+                        value = long(kw[len(prefix):])
+                        if ((low is None or value >= low) and
+                                (high is None or value <= high)):
+                            found |= set(hits(kw))
+                return found
         else:
             def hits(term):
+                deps.add(term)
                 if term.endswith(':in'):
-                    return self.TAGS.get(term.rsplit(':', 1)[0], [])
+                    return self.TAGS.get(term.rsplit(':', 1)[0], Bitmap())
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    return [int(h, 36) for h
-                            in GlobalPostingList(session, term).hits()]
+                    return GlobalPostingList(session, term).hits()
+
+            def ranges(name, low, high):
+                deps.add('*')
+                return self.search_range(name, low, high)
+
+            if self.config.prefs.index_positions:
+                def positions(word, msg_idxs):
+                    return GlobalPostingList(session, self.POSITION_KEYWORD
+                                             % word).positions(msg_idxs)
+
+        # Search terms (plugins) can search by date or size ranges using
+        # hits.range(name, low, high), see search_range().
+        hits.range = ranges
+
+        def words(term):
+            if '*' in term and keywords is None:
+                deps.add('*')
+                return self.search_wildcard(session, term, hits)
+            return hits(term)
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1048,7 +1852,83 @@ class MailIndex:
         if searchterms and searchterms[0] and searchterms[0][0] == '-':
             searchterms[:0] = ['all:mail']
 
-        r = []
+        def evaluate(term):
+            if term.startswith('"'):
+                return self.search_phrase(session, term, hits,
+                                          positions=positions)
+            elif ':' in term:
+                if term.startswith('body:'):
+                    return words(term[5:])
+                elif term == 'all:mail':
+                    deps.add('*')
+                    return Bitmap.Range(0, snapshot.messages)
+                elif term.startswith('in:'):
+                    return self.search_tag(term, hits)
+                else:
+                    t = term.split(':', 1)
+                    fnc = plugins.get_search_term(t[0])
+                    if fnc:
+                        return fnc(self.config, self, term, hits)
+                    else:
+                        return words('%s:%s' % (t[1], t[0]))
+            else:
+                return words(term)
+
+        # Estimate how many messages each term matches, from the document
+        # frequencies in the index (without reading any posting lists).
+        def count(term):
+            if keywords is not None:
+                return len(keywords.get(term, []))
+            elif term.endswith(':in'):
+                return len(self.TAGS.get(term.rsplit(':', 1)[0], ()))
+            else:
+                return GlobalPostingList(session, term).count()
+
+        def words_cost(term):
+            if '*' in term and keywords is None:
+                return snapshot.messages
+            return count(term)
+
+        costs = {}
+
+        def cost(term):
+            if term in costs:
+                return costs[term]
+            if term.startswith('"'):
+                counts = [count(w) for w in re.findall(WORD_REGEXP, term)
+                          if w not in STOPLIST]
+                c = counts and min(counts) or 0
+            elif term.startswith('body:'):
+                c = words_cost(term[5:])
+            elif term == 'all:mail':
+                c = snapshot.messages
+            elif term.startswith('in:'):
+                c = self.search_tag(term, count)
+            elif ':' in term:
+                t = term.split(':', 1)
+                fnc = plugins.get_search_term_cost(t[0])
+                try:
+                    if fnc:
+                        c = fnc(self.config, self, term, count)
+                    elif plugins.get_search_term(t[0]):
+                        c = snapshot.messages
+                    else:
+                        c = words_cost('%s:%s' % (t[1], t[0]))
+                except ValueError:
+                    # Let the search itself report the problem
+                    c = 0
+            else:
+                c = words_cost(term)
+            costs[term] = c
+            return c
+
+        # Group the terms into runs: each starts with the first term or a
+        # + term (which is OR-ed with the results so far), followed by AND
+        # and NOT terms which narrow them down.  Within a run the order
+        # does not matter, so the planner intersects the smallest sets
+        # first, then uses the NOT terms as filters on what is left, and
+        # stops reading posting lists once nothing is left.
+        runs = []
         for term in searchterms:
             if term in STOPLIST:
                 if session:
@@ -1060,114 +1940,301 @@ class MailIndex:
                 term = term[1:]
             else:
                 op = None
-
-            r.append((op, []))
-            rt = r[-1][1]
             term = term.lower()
 
-            if ':' in term:
-                if term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term.startswith('in:'):
-                    rt.extend(self.search_tag(term, hits))
-                else:
-                    t = term.split(':', 1)
-                    fnc = plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
-                    else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
+            if not runs:
+                runs.append((None, [term], []))
+            elif op == '+':
+                runs.append((term, [], []))
+            elif op == '-':
+                runs[-1][2].append(term)
             else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
-            # Sometimes the scan gets aborted...
-            if keywords is None:
-                results -= set([len(self.INDEX)])
-        else:
-            results = set()
+                runs[-1][1].append(term)
+
+        # Results for a single tag can be patched when tagging
+        tag = None
+        if len(runs) == 1 and len(runs[0][1]) == 1 and not runs[0][2]:
+            if runs[0][1][0].startswith('in:'):
+                tag_id = runs[0][1][0].split(':', 1)[1]
+                tag = self.config.get_tag_id(tag_id) or tag_id
+
+        # Estimating costs reads the posting lists too, so it is only
+        # worth it when there is more than one term to order.
+        results = Bitmap()
+        for plus, ands, nots in runs:
+            if len(ands) > 1:
+                ands.sort(key=cost)
+            if len(nots) > 1:
+                nots.sort(key=cost)
+            if plus is None:
+                results = Bitmap(evaluate(ands.pop(0)))
+            else:
+                results |= evaluate(plus)
+            for term in ands:
+                if not results:
+                    break
+                results &= evaluate(term)
+            for term in nots:
+                if not results:
+                    break
+                results -= evaluate(term)
+
+        if runs and keywords is None:
+            # Messages still being indexed (or whose indexing was aborted)
+            # may already be in the posting lists; leave them out.
+            results = snapshot.visible(results)
+            results -= self.TOMBSTONES
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
-        exclude = []
+        exclude = Bitmap()
+        hides = False
         order = order or (session and session.order) or 'flat-index'
-        if (results and (keywords is None) and
+        if ((keywords is None) and
                 ('tags' in self.config) and
                 (not session or 'all' not in order)):
             invisible = self.config.get_tags(flag_hides=True)
-            exclude_terms = ['in:%s' % i._key for i in invisible]
-            for tag in invisible:
-                tid = tag._key
+            hides = True
+            for t in invisible:
                 for p in ('in:%s', '+in:%s', '-in:%s'):
-                    if ((p % tid) in searchterms or
-                            (p % tag.name) in searchterms or
-                            (p % tag.slug) in searchterms):
-                        exclude_terms = []
-            if len(exclude_terms) > 1:
-                exclude_terms = ([exclude_terms[0]] +
-                                 ['+%s' % e for e in exclude_terms[1:]])
-            # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
-
-        srs.set_results(results, exclude)
+                    if ((p % t._key) in searchterms or
+                            (p % t.name) in searchterms or
+                            (p % t.slug) in searchterms):
+                        hides = False
+            if hides:
+                exclude = self.hidden_messages(invisible)
+                deps |= set('%s:in' % t._key for t in invisible)
+
+        srs.set_results(results, exclude, deps=deps, tag=tag, hides=hides,
+                        generation=snapshot.generation)
         if session:
             session.ui.mark(_('Found %d results (%d suppressed)'
                               ) % (len(results), len(srs.excluded())))
         return srs
 
+    # Reply and forward markers are ignored when sorting by subject
+    SUBJECT_PREFIX_RE = re.compile(r'^(\s*(re|fwd?|aw|sv|antw)(\[\d+\])?:)+',
+                                   re.IGNORECASE)
+
+    # A sort order and a range column by the same name share one index,
+    # so they must agree on the values. Senders and subjects are sorted
+    # by collation keys, so only by their first few characters.
     CACHED_SORT_ORDERS = [
         ('date', True,
-         lambda s, k: long(s.get_msg_at_idx_pos(k)[s.MSG_DATE], 36)),
-        # FIXME: The following are effectively disabled for now
-        ('from', False,
-         lambda s, k: s.get_msg_at_idx_pos(k)[s.MSG_FROM]),
-        ('subject', False,
-         lambda s, k: s.get_msg_at_idx_pos(k)[s.MSG_SUBJECT]),
+         lambda s, msg_info: long(msg_info[s.MSG_DATE], 36)),
+        ('from', True,
+         lambda s, msg_info: collation_key(
+             ExtractEmailAndName(msg_info[s.MSG_FROM] or '')[1])),
+        ('subject', True,
+         lambda s, msg_info: collation_key(msg_info[s.MSG_SUBJECT],
+                                           strip=s.SUBJECT_PREFIX_RE)),
     ]
 
+    def _sort_columns(self, wanted=None):
+        columns = list(self.RANGE_COLUMNS)
+        for order, by_default, getter in self.CACHED_SORT_ORDERS:
+            if ((by_default or (wanted and order in wanted)) and
+                    order not in dict(columns)):
+                columns.append((order, getter))
+        return columns
+
+    def _sort_message(self, msg_idx, msg_info):
+        """Update the conversations, sort orders and ranges for a message."""
+        while len(self.INDEX_THR) <= msg_idx:
+            self.INDEX_THR.append(len(self.INDEX_THR))
+        self.INDEX_THR[msg_idx] = int(msg_info[self.MSG_THREAD_MID], 36)
+        columns = dict(self.INDEX_SORT)
+        columns.update(self.INDEX_RANGES)
+        for name, value in self._column_values(
+                msg_info, self._sort_columns(wanted=self.INDEX_SORT)):
+            if name in columns and columns[name].set(msg_idx, value):
+                # Until then, load() re-sorts the changes since the save
+                self._sort_dirty = True
+
+    def _load_sort_orders(self):
+        try:
+            saved = self.config.load_pickle(self.SORT_ORDERS_PICKLE)
+            for key in ('lines', 'messages', 'threads',
+                        'sort_orders', 'ranges'):
+                saved[key]
+            return saved
+        except:
+            return None
+
+    def _copy_sort_orders(self):
+        # Sort orders and ranges share their RangeIndex objects
+        copies = {}
+        for ri in self.INDEX_SORT.values() + self.INDEX_RANGES.values():
+            if id(ri) not in copies:
+                copies[id(ri)] = ri.copy()
+        return (dict((n, copies[id(ri)])
+                     for n, ri in self.INDEX_SORT.iteritems()),
+                dict((n, copies[id(ri)])
+                     for n, ri in self.INDEX_RANGES.iteritems()))
+
+    def _sort_orders_state(self):
+        # Called with the lock held, right after the index has been saved.
+        # The copies are cheap, pickling them waits until the lock is free.
+        self._sort_dirty = False
+        self._sort_saves += 1
+        sort_orders, ranges = self._copy_sort_orders()
+        return {
+            'save': self._sort_saves,
+            'lines': self._lines,
+            'messages': len(self.INDEX_THR),
+            'threads': self.INDEX_THR.copy(),
+            'sort_orders': sort_orders,
+            'ranges': ranges
+        }
+
+    def _drop_sort_orders(self):
+        try:
+            self._sort_save_lock.acquire()
+            # Saves already under way must not put the file back either
+            self._sort_saves += 1
+            self._sort_saved = self._sort_saves
+            os.remove(os.path.join(self.config.workdir,
+                                   self.SORT_ORDERS_PICKLE))
+        except OSError:
+            pass
+        finally:
+            self._sort_save_lock.release()
+
+    def _save_sort_orders(self, state):
+        try:
+            self._sort_save_lock.acquire()
+            # A save which started later (maybe after the index file was
+            # rewritten, renumbering its lines) may have finished first.
+            if state['save'] < self._sort_saved:
+                return
+            self.config.save_pickle({
+                'lines': state['lines'],
+                'messages': state['messages'],
+                'threads': state['threads'],
+                'sort_orders': state['sort_orders'],
+                'ranges': state['ranges']
+            }, self.SORT_ORDERS_PICKLE)
+            self._sort_saved = state['save']
+        except (IOError, OSError):
+            self._sort_dirty = True
+        finally:
+            self._sort_save_lock.release()
+
     def cache_sort_orders(self, session, wanted=None):
+        """
+        Build any missing sort orders and range columns, and the list of
+        conversations along with them. Once built, they are kept up to
+        date as messages are added or changed, and saved with the index.
+        """
         try:
             self._lock.acquire()
+            columns = [(name, getter) for name, getter
+                       in self._sort_columns(wanted=wanted)
+                       if (name not in self.INDEX_SORT and
+                           name not in self.INDEX_RANGES)]
+            if not columns:
+                return
             keys = range(0, len(self.INDEX))
             if session:
-                session.ui.mark(_('Finding conversations (%d messages)...'
-                                  ) % len(keys))
-            self.INDEX_THR = [
-                int(self.get_msg_at_idx_pos(r)[self.MSG_THREAD_MID], 36)
-                for r in keys]
-            for order, by_default, sorter in self.CACHED_SORT_ORDERS:
-                if (not by_default) and not (wanted and order in wanted):
-                    continue
-                if session:
-                    session.ui.mark(_('Sorting %d messages by %s...'
-                                      ) % (len(keys), _(order)))
-
-                play_nice_with_threads()
-                o = keys[:]
-                o.sort(key=lambda k: sorter(self, k))
-                self.INDEX_SORT[order] = keys[:]
-                self.INDEX_SORT[order+'_fwd'] = o
-
-                play_nice_with_threads()
-                for i in range(0, len(o)):
-                    self.INDEX_SORT[order][o[i]] = i
+                session.ui.mark(_('Sorting %d messages...') % len(keys))
+            # Everything is built aside and then swapped in, as searches
+            # may be using the current orders while we work.
+            threads = Column(typecode='l')
+            pairs = dict((name, []) for name, getter in columns)
+            for msg_idx in keys:
+                msg_info = self.get_msg_at_idx_pos(msg_idx)
+                threads.append(int(msg_info[self.MSG_THREAD_MID], 36))
+                for name, value in self._column_values(msg_info, columns):
+                    pairs[name].append((value, msg_idx))
+            play_nice_with_threads()
+            built = dict((name, RangeIndex(p))
+                         for name, p in pairs.iteritems())
+
+            # Messages added meanwhile are sorted in as usual
+            for msg_idx in range(len(keys), len(self.INDEX)):
+                threads.append(self.INDEX_THR[msg_idx])
+                msg_info = self.get_msg_at_idx_pos(msg_idx)
+                for name, value in self._column_values(msg_info, columns):
+                    built[name].set(msg_idx, value)
+
+            ranges = dict(self.INDEX_RANGES)
+            sort_orders = dict(self.INDEX_SORT)
+            for name, column in built.iteritems():
+                if name in dict(self.RANGE_COLUMNS):
+                    ranges[name] = column
+                if name in [order for order, d, g in self.CACHED_SORT_ORDERS]:
+                    sort_orders[name] = column
+            self.INDEX_THR = threads
+            self.INDEX_SORT = sort_orders
+            self.INDEX_RANGES = ranges
+            self._sort_dirty = True
+            self.publish()
         finally:
             self._lock.release()
 
-    def sort_results(self, session, results, how):
+    def sorted_results(self, session, results, how, count=None):
+        """
+        Sort a set of search results into a list. If only the first count
+        results are needed, the rest are only collapsed into conversations
+        if looked at, and from a large set in date order the first results
+        are found by walking the cached date order from the right end and
+        checking which messages match, without sorting the set at all.
+        """
+        snapshot = self.SNAPSHOT
+        results = snapshot.visible(results)
+        collapse = ('flat' not in how)
+        if (count and how.endswith('date')
+                and 'date' in snapshot.sort_orders
+                and len(results) > session.config.sys.sort_max):
+            ordered = self._walk_date_order(snapshot, results,
+                                            how.startswith('rev'))
+        elif count and collapse:
+            ordered = list(results)
+            if not self.sort_results(session, ordered, how,
+                                     snapshot=snapshot, collapse=False):
+                return ordered
+            ordered = iter(ordered)
+        else:
+            results = list(results)
+            self.sort_results(session, results, how, snapshot=snapshot)
+            return results
+
+        if collapse:
+            ordered = self._collapse(snapshot, ordered)
+            counter = lambda: self._count_conversations(snapshot, results)
+        else:
+            counter = lambda: len(results)
+        sr = LazySortedResults(ordered, counter)
+        sr[:count]
+        session.ui.mark(_('Found the first %d of %d messages by %s'
+                          ) % (list.__len__(sr), len(results), _(how)))
+        return sr
+
+    def _walk_date_order(self, snapshot, results, reverse):
+        for msg_idx in snapshot.sort_orders['date'].ordered(reverse=reverse):
+            if msg_idx in results:
+                yield msg_idx
+
+    def _collapse(self, snapshot, ordered):
+        """Keep the first of each conversation's messages, in order."""
+        seen = set()
+        threads = snapshot.threads
+        for msg_idx in ordered:
+            thread = threads[msg_idx]
+            if thread not in seen:
+                seen.add(thread)
+                yield msg_idx
+
+    def _count_conversations(self, snapshot, results):
+        return len(set(itertools.imap(snapshot.threads.__getitem__,
+                                      results)))
+
+    def sort_results(self, session, results, how, snapshot=None,
+                     collapse=None):
         if not results:
             return
 
+        snapshot = snapshot or self.SNAPSHOT
         count = len(results)
         session.ui.mark(_('Sorting %d messages by %s...') % (count, _(how)))
         try:
@@ -1180,27 +2247,16 @@ class MailIndex:
                 results.sort(key=lambda k: sha1b64('%s%s' % (now, k)))
             else:
                 did_sort = False
-                for order in self.INDEX_SORT:
+                for order in snapshot.sort_orders:
                     if how.endswith(order):
+                        ranks = snapshot.sort_orders[order].keys
                         try:
-                            results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            results.sort(key=ranks.__getitem__)
                         except IndexError:
-                            say = session.ui.error
-                            if session.config.sys.debug:
-                                traceback.print_exc()
-                            for result in results:
-                                if result >= len(self.INDEX) or result < 0:
-                                    say(('Bogus message index: %s'
-                                         ) % result)
-                            say(_('Recovering from bogus sort, '
-                                  'corrupt index?'))
-                            say(_('Please tell team@mailpile.is !'))
-                            clean_results = [r for r in results
-                                             if r >= 0 and r < len(self.INDEX)]
-                            clean_results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
-                            results[:] = clean_results
+                            # Results from before the index was reloaded
+                            results[:] = [r for r in results
+                                          if 0 <= r < snapshot.messages]
+                            results.sort(key=ranks.__getitem__)
                         did_sort = True
                         break
                 if not did_sort:
@@ -1215,16 +2271,120 @@ class MailIndex:
         if how.startswith('rev'):
             results.reverse()
 
-        if 'flat' not in how:
-            # This filters away all but the first result in each conversation.
-            results.reverse()
-            cset = set(dict([(self.INDEX_THR[r], r)
-                             for r in results]).values())
-            results.reverse()
-            results[:] = filter(cset.__contains__, results)
+        if collapse is None:
+            collapse = ('flat' not in how)
+        if collapse:
+            results[:] = list(self._collapse(snapshot, results))
             session.ui.mark(_('Sorted %d messages by %s, %d conversations'
                               ) % (count, how, len(results)))
         else:
             session.ui.mark(_('Sorted %d messages by %s') % (count, _(how)))
 
         return True
+
+    def _facet_values(self, msg_info, interned):
+        try:
+            ts = long(msg_info[self.MSG_DATE], 36)
+            years = (time.localtime(ts).tm_year, )
+        except (ValueError, TypeError, OverflowError):
+            years = ()
+        sender = ExtractEmailAndName(msg_info[self.MSG_FROM] or '')[0]
+        values = {
+            'year': years,
+            'from': sender and (sender.lower(), ) or (),
+            'mailbox': tuple(sorted(set(
+                p[:MBX_ID_LEN] for p in msg_info[self.MSG_PTRS].split(',')
+                if p)))
+        }
+        # Most values are shared by many messages, so share the tuples
+        for name, value in values.iteritems():
+            values[name] = interned.setdefault(value, value)
+        return values
+
+    def _facet_columns(self, session):
+        try:
+            self._lock.acquire()
+            if self.INDEX_FACETS is not None:
+                return
+            if session:
+                session.ui.mark(_('Preparing facets (%d messages)...'
+                                  ) % len(self.INDEX))
+            facets = dict((name, Column()) for name in self.FACET_COLUMNS)
+            interned = {}
+            msg_idx = 0
+            while msg_idx < len(self.INDEX):
+                values = self._facet_values(
+                    self.get_msg_at_idx_pos(msg_idx), interned)
+                for name, column in facets.iteritems():
+                    column.append(values[name])
+                msg_idx += 1
+                if not msg_idx % 10000:
+                    play_nice_with_threads()
+            self.INDEX_FACETS = facets
+            self.publish()
+        finally:
+            self._lock.release()
+
+    def facets(self, session, srs, wanted=None):
+        """
+        Count the results of a search by tag, year, sender and mailbox,
+        returning a dict of {facet: {value: count}} and whether counting
+        finished. Tags are counted by intersecting their bitmaps with the
+        results, the rest from the facet columns. Counting stops once it
+        takes longer than sys.facets_ms; facets which were fully counted
+        are kept with the (cached) search results.
+        """
+        wanted = wanted or (['tag'] + list(self.FACET_COLUMNS))
+        snapshot = self.SNAPSHOT
+        if (snapshot.facets is None
+                and set(wanted) & set(self.FACET_COLUMNS)):
+            self._facet_columns(session)
+            snapshot = self.SNAPSHOT
+
+        cached = srs.get_facets()
+        facets = dict((n, cached[n]) for n in wanted if n in cached)
+        done = dict(cached)
+        results = snapshot.visible(srs.as_bitmap())
+        deadline = time.time() + session.config.sys.facets_ms / 1000.0
+
+        if 'tag' in wanted and 'tag' not in facets:
+            counts = facets['tag'] = {}
+            for tid, tagged in self.TAGS.items():
+                if time.time() > deadline:
+                    break
+                count = len(tagged & results)
+                if count:
+                    counts[tid] = count
+            else:
+                done['tag'] = counts
+
+        columns = [(name, snapshot.facets[name], facets.setdefault(name, {}))
+                   for name in self.FACET_COLUMNS
+                   if name in wanted and name not in facets]
+        if columns and time.time() <= deadline:
+            counted = 0
+            for msg_idx in results:
+                for name, column, counts in columns:
+                    for value in column[msg_idx]:
+                        counts[value] = counts.get(value, 0) + 1
+                counted += 1
+                if not counted % 1000 and time.time() > deadline:
+                    break
+            else:
+                for name, column, counts in columns:
+                    done[name] = counts
+
+        if len(done) > len(cached):
+            srs.set_facets(done)
+        complete = not [n for n in wanted if n in facets and n not in done]
+        if session:
+            session.ui.mark(_('Counted facets of %d results'
+                              ) % len(results))
+        return facets, complete
+
+
+# If 'python search.py' is executed, start the doctest unittest
+if __name__ == "__main__":
+    import doctest
+    if doctest.testmod().failed:
+        sys.exit(1)
@@ -2,7 +2,9 @@
 #
 # Misc. utility functions for Mailpile.
 #
+import array
 import cgi
+import collections
 import datetime
 import hashlib
 import locale
@@ -14,6 +16,7 @@ import string
 import tempfile
 import threading
 import time
+import unicodedata
 import StringIO
 from gettext import gettext as _
 
@@ -23,7 +26,7 @@ except:
     Image = None
 
 
-global APPEND_FD_CACHE, APPEND_FD_CACHE_ORDER, APPEND_FD_CACHE_SIZE
+global APPEND_FD_CACHE, APPEND_FD_CACHE_SIZE
 global WORD_REGEXP, STOPLIST, BORING_HEADERS, DEFAULT_PORT, QUITTING
 
 
@@ -55,6 +58,12 @@ STRHASH_RE = re.compile('[^0-9a-z]+')
 
 B36_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
 
+# Collation keys pack this alphabet 6 bits per character, as many as fit
+# in a (signed) machine integer. Anything else sorts after it.
+COLLATION_ALPHABET = ' 0123456789abcdefghijklmnopqrstuvwxyz'
+COLLATION_WIDTH = (array.array('l').itemsize * 8 - 1) // 6
+COLLATION_RE = re.compile('[^0-9a-z\x80-\xff]+')
+
 
 class WorkerError(Exception):
     pass
@@ -219,6 +228,35 @@ def b36(number):
     return ''.join(reversed(base36))
 
 
+def collation_key(text, strip=None):
+    """
+    Convert text to an integer which sorts like the start of the text,
+    ignoring case, accents and punctuation (and anything matching the
+    strip regular expression).
+
+    >>> collation_key(u'Apple') < collation_key(u'banana') < collation_key(
+    ...     u'Banana split')
+    True
+    >>> collation_key(u'\xc9cole') == collation_key(u'  ecole!')
+    True
+    >>> reply = re.compile('^(re|fwd?):', re.I)
+    >>> collation_key(u'Re: Hello', strip=reply) == collation_key(u'hello')
+    True
+    """
+    if strip is not None:
+        text = strip.sub('', text)
+    if isinstance(text, unicode):
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+        text = text.encode('utf-8')
+    text = COLLATION_RE.sub(' ', text.lower()).strip()[:COLLATION_WIDTH]
+    key = 0
+    for c in text:
+        key <<= 6
+        key |= COLLATION_ALPHABET.find(c) + 1 or 63
+    return key << (6 * (COLLATION_WIDTH - len(text)))
+
+
 def elapsed_datetime(timestamp):
     """
     Return "X days ago" style relative dates for recent dates.
@@ -310,7 +348,8 @@ def decrypt_and_parse_lines(fd, parser, config, newlines=False):
         if line.startswith(GPG_BEGIN_MESSAGE):
             for line in decrypt_gpg([line], fd):
                 _parser(line.decode('utf-8'))
-        elif line.startswith(symencrypt.SymmetricEncrypter.BEGIN_DATA):
+        elif line.startswith((symencrypt.SymmetricEncrypter.MAGIC,
+                              symencrypt.SymmetricEncrypter.BEGIN_DATA)):
             if not config or not config.prefs.obfuscate_index:
                 raise ValueError(_("Symmetric decryption is not available "
                                    "without config and key."))
@@ -376,50 +415,101 @@ def dict_merge(*dicts):
 
 # Indexing messages is an append-heavy operation, and some files are
 # appended to much more often than others.  This implements a simple
-# LRU cache of file descriptors we are appending to.
-APPEND_FD_CACHE = {}
+# LRU cache of file descriptors we are appending to; the OrderedDict
+# keeps the least recently used descriptors first.
+APPEND_FD_CACHE = collections.OrderedDict()
 APPEND_FD_CACHE_SIZE = 500
-APPEND_FD_CACHE_ORDER = []
 APPEND_FD_CACHE_LOCK = threading.Lock()
 
+# The locks which writers to cached descriptors hold (if they told us),
+# so we never close a descriptor somebody else is busy writing to.
+APPEND_FD_OWNERS = {}
+
+
+def _close_cached_fd(filename):
+    owner = APPEND_FD_OWNERS.get(filename)
+    if owner is not None and not owner.acquire(False):
+        return False
+    try:
+        APPEND_FD_OWNERS.pop(filename, None)
+        APPEND_FD_CACHE.pop(filename).close()
+        return True
+    finally:
+        if owner is not None:
+            owner.release()
+
 
 def flush_append_cache(ratio=1, count=None, lock=True):
     try:
         if lock:
             APPEND_FD_CACHE_LOCK.acquire()
-        drop = count or int(ratio * len(APPEND_FD_CACHE_ORDER))
-        for fn in APPEND_FD_CACHE_ORDER[:drop]:
-            try:
-                APPEND_FD_CACHE[fn].close()
-                del APPEND_FD_CACHE[fn]
-            except KeyError:
-                pass
-        APPEND_FD_CACHE_ORDER[:drop] = []
+        drop = count or int(ratio * len(APPEND_FD_CACHE))
+        for fn in APPEND_FD_CACHE.keys():
+            if drop < 1:
+                break
+            if _close_cached_fd(fn):
+                drop -= 1
     finally:
         if lock:
             APPEND_FD_CACHE_LOCK.release()
 
 
+def drop_append_cache():
+    """
+    Forget all cached descriptors without writing out anything they may
+    have buffered. For forked processes, whose cache was inherited: the
+    buffers belong to the parent, which will write them out itself.
+    """
+    global APPEND_FD_CACHE_LOCK
+    APPEND_FD_CACHE_LOCK = threading.Lock()
+    for fd in APPEND_FD_CACHE.values():
+        try:
+            os.close(fd.fileno())
+            fd.close()
+        except (IOError, OSError, ValueError):
+            pass
+    APPEND_FD_CACHE.clear()
+    APPEND_FD_OWNERS.clear()
+
+
+def uncache_fd(filename):
+    """
+    Close and forget any cached descriptor for a file, for use when the
+    file is about to be replaced or removed.
+    """
+    try:
+        APPEND_FD_CACHE_LOCK.acquire()
+        APPEND_FD_OWNERS.pop(filename, None)
+        fd = APPEND_FD_CACHE.pop(filename, None)
+        if fd:
+            fd.close()
+    finally:
+        APPEND_FD_CACHE_LOCK.release()
+
 
-def cached_open(filename, mode):
+def cached_open(filename, mode, lock=None):
+    """
+    Open a file, keeping descriptors for appending open for reuse. The
+    lock is the one writers to the file hold, if any; a descriptor is
+    only closed to make room while that lock is free.
+    """
     try:
         APPEND_FD_CACHE_LOCK.acquire()
         if mode == 'a':
-            fd = None
-            if filename in APPEND_FD_CACHE:
-                while filename in APPEND_FD_CACHE_ORDER:
-                    APPEND_FD_CACHE_ORDER.remove(filename)
-                fd = APPEND_FD_CACHE[filename]
+            # Popping and re-inserting moves the file to the MRU end
+            fd = APPEND_FD_CACHE.pop(filename, None)
             if not fd or fd.closed:
                 if len(APPEND_FD_CACHE) > APPEND_FD_CACHE_SIZE:
                     flush_append_cache(count=1, lock=False)
                 try:
-                    fd = APPEND_FD_CACHE[filename] = open(filename, 'a')
+                    fd = open(filename, 'a')
                 except (IOError, OSError):
                     # Too many open files?  Close a bunch and try again.
                     flush_append_cache(ratio=0.3, lock=False)
-                    fd = APPEND_FD_CACHE[filename] = open(filename, 'a')
-            APPEND_FD_CACHE_ORDER.append(filename)
+                    fd = open(filename, 'a')
+            APPEND_FD_CACHE[filename] = fd
+            if lock is not None:
+                APPEND_FD_OWNERS[filename] = lock
             return fd
         else:
             fd = APPEND_FD_CACHE.get(filename)
@@ -427,7 +517,7 @@ def cached_open(filename, mode):
                 try:
                     if 'w' in mode or '+' in mode:
                         del APPEND_FD_CACHE[filename]
-                        APPEND_FD_CACHE_ORDER.remove(filename)
+                        APPEND_FD_OWNERS.pop(filename, None)
                         fd.close()
                     else:
                         fd.flush()
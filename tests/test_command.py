@@ -64,6 +64,17 @@ class TestCommands(MailPileUnittest):
         self.assertEqual(len(res.result), 1)
         self.assertGreater(res.as_text(), 0)
 
+    def test_autotag_retrain(self):
+        self.mp.tag_add('Retrained')
+        self.mp.search('from:twitter')
+        self.mp.tag('+retrained', 'all')
+        self.mp._config.prefs.autotag.append({'match_tag': 'retrained',
+                                              'corpus_size': 8})
+        res = self.mp.autotag_retrain('retrained')
+        self.assertEqual(res.result['retrained'], ['Retrained'])
+        # Two tagged messages and two others to learn from
+        self.assertEqual(res.result['read_messages'], 4)
+
 
 class TestCommandResult(MailPileUnittest):
     def test_command_result_as_dict(self):
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from tests import MailPileUnittest
+
+
+class TestPickles(MailPileUnittest):
+    DATA = {u'caf\xe9': [u'/home/\xfarsula/Mail', 'plain', 3]}
+
+    def _round_trip(self, obfuscate):
+        config = self.mp._config
+        saved = config.prefs.obfuscate_index
+        try:
+            config.prefs.obfuscate_index = obfuscate
+            config.save_pickle(self.DATA, 'pickled-test')
+            return config.load_pickle('pickled-test')
+        finally:
+            config.prefs.obfuscate_index = saved
+
+    def test_pickle_round_trip(self):
+        self.assertEqual(self._round_trip(''), self.DATA)
+
+    def test_encrypted_pickle_round_trip(self):
+        self.assertEqual(self._round_trip('secret'), self.DATA)
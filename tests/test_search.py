@@ -15,6 +15,39 @@ def checkSearch(query, expected_count=1):
     return TestSearch
 
 
+def checkOrder(order, field, expected):
+    class TestOrder(object):
+        def __init__(self):
+            self.mp = get_shared_mailpile()
+            self.mp.search('all:mail')
+            try:
+                result = self.mp.order(order).result
+            finally:
+                self.mp.order()
+            metadata = result['data']['metadata']
+            values = [metadata[mid][field] for mid in result['thread_ids']]
+            if field == 'from':
+                values = [v['fn'] for v in values]
+            # Values which only differ after the characters compared
+            # sort in any order, so compare only their first word.
+            assert_equal([v.split()[0] for v in values if v], expected)
+    TestOrder.description = "Ordering by %s" % order
+    return TestOrder
+
+
+def checkFacets(query, facet, expected):
+    class TestFacets(object):
+        def __init__(self):
+            self.mp = get_shared_mailpile()
+            results = self.mp.search_facets(*query)
+            values = [f['values'] for f in results.result['facets']
+                      if f['facet'] == facet][0]
+            assert_equal(dict((v['name'], v['count']) for v in values),
+                         expected)
+    TestFacets.description = "Counting %s facets of %s" % (facet, query)
+    return TestFacets
+
+
 def test_generator():
     # All mail
     yield checkSearch(['all:mail'], 5)
@@ -38,3 +71,35 @@ def test_generator():
     yield checkSearch(['brennan', 'from:twitter'])
     # Not found
     yield checkSearch(['subject:Moderation', 'kde-isl'], 0)
+    # Phrase
+    yield checkSearch(['"emerging ideas"'])
+    yield checkSearch(['"brennan feministinn"'], 0)
+    # Prefix
+    yield checkSearch(['brenn*'])
+    yield checkSearch(['twit*'], 2)
+    yield checkSearch(['masculin*', 'twit*'], 0)
+    # Date ranges
+    yield checkSearch(['dates:2013-09..2013-10'], 5)
+    yield checkSearch(['dates:2013-09-17..2013-09-30'], 2)
+    yield checkSearch(['dates:2012..2013-08'], 0)
+    # Size ranges
+    yield checkSearch(['size:100kb..'])
+    yield checkSearch(['size:50kb..100kb'])
+    yield checkSearch(['size:..40kb'], 3)
+    yield checkSearch(['size:1kb..5kb'], 0)
+    # Facets
+    yield checkFacets(['feministinn'], 'from', {'rikk@hi.is': 2})
+    yield checkFacets(['from:twitter'], 'from', {'info@twitter.com': 1,
+                                                 'notify@twitter.com': 1})
+    yield checkFacets(['all:mail'], 'year', {'2013': 6})
+    # Sort orders
+    yield checkOrder('from', 'from',
+                     ['Brennan', u'Ranns\xf3knastofa', u'Ranns\xf3knastofa',
+                      'Twitter'])
+    yield checkOrder('rev-from', 'from',
+                     ['Twitter', u'Ranns\xf3knastofa', u'Ranns\xf3knastofa',
+                      'Brennan'])
+    yield checkOrder('subject', 'subject',
+                     ['Bjarni', 'Brennan', '[Feministinn]', '[Feministinn]'])
+    yield checkOrder('rev-subject', 'subject',
+                     ['[Feministinn]', '[Feministinn]', 'Brennan', 'Bjarni'])